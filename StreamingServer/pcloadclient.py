@@ -0,0 +1,246 @@
+"""Load generator for a point cloud forwarding server: many simultaneous receivers, with statistics.
+
+Runs N receivers at once against cwipc_forward --port or pcserver.py, reads frames
+for a fixed duration, and reports per client and in total:
+
+    throughput      frames/s and Mbit/s received
+    jitter          percentiles of the deviation of inter-frame arrival time from
+                    the nominal frame interval
+    frame age       with --protocol pcserver: percentiles of receive time minus server
+                    send time (client and server on the same host, or with synchronized
+                    clocks). With --protocol forward frames have no send time, and the
+                    age is the receive time minus the time the frame was due in the
+                    client's schedule (first frame time plus frame number times
+                    --interval), so it measures how far a client falls behind.
+
+With --protocol forward (the default, what cwipc_forward sends) every frame is a
+connection that carries one compressed frame and is then closed by the server. With
+--protocol pcserver one connection carries all frames, each with a header (see
+pcserver.py).
+
+With --decode N every Nth frame is decoded with cwipc.codec (in a worker thread,
+so decoding does not distort the arrival times of other frames).
+
+Run a scaling curve from 1 to 100 receivers, 10 seconds each:
+
+    python pcloadclient.py --clients 1,10,25,50,100 --duration 10 --json curve.json localhost 8089
+"""
+import sys
+import time
+import json
+import asyncio
+import argparse
+import threading
+import collections
+from typing import Any, Dict, List, Optional, Tuple
+from pcserver import FOURCC, FRAME_HEADER, PROTOCOLS
+
+def percentile(sorted_values : List[float], p : float) -> Optional[float]:
+    """Return the p-th percentile (0..100) of an already sorted list, by linear interpolation"""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values)-1) * p / 100.0
+    lo = int(k)
+    hi = min(lo+1, len(sorted_values)-1)
+    return sorted_values[lo] + (sorted_values[hi]-sorted_values[lo]) * (k-lo)
+
+PERCENTILES = (50, 90, 99)
+
+def summarize(values : List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    rv : Dict[str, Optional[float]] = {f"p{p}" : percentile(values, p) for p in PERCENTILES}
+    rv["max"] = values[-1] if values else None
+    return rv
+
+class Receiver:
+    """A single receiver and its measurements"""
+
+    def __init__(self, number : int, interval_ms : float, decode_every : int, protocol : str = "forward"):
+        self.number = number
+        self.interval_ms = interval_ms
+        self.decode_every = decode_every
+        self.protocol = protocol
+        self.frames = 0
+        self.bytes = 0
+        self.decoded = 0
+        self.decoded_points = 0
+        self.decode_errors = 0
+        self.arrivals : List[float] = []
+        self.ages_ms : List[float] = []
+        self.gaps = 0
+        self.error : Optional[str] = None
+        self.start = 0.0
+        self.end = 0.0
+        self._decoder : Any = None
+        self._decoder_lock = threading.Lock()
+
+    async def run(self, host : str, port : int, duration : float) -> None:
+        loop = asyncio.get_running_loop()
+        self.start = time.perf_counter()
+        deadline = self.start + duration
+        decodes = []
+        try:
+            if self.protocol == "forward":
+                frames = self._receive_forward(host, port, deadline)
+            else:
+                frames = self._receive_stream(host, port, deadline)
+            async for data in frames:
+                if self.decode_every and self.frames % self.decode_every == 0:
+                    decodes.append(loop.run_in_executor(None, self._decode, data))
+        except OSError as e:
+            if not self.frames:
+                self.error = str(e)
+        self.end = time.perf_counter()
+        for ok, npoints in await asyncio.gather(*decodes):
+            if ok:
+                self.decoded += 1
+                self.decoded_points += npoints
+            else:
+                self.decode_errors += 1
+        if self._decoder is not None:
+            self._decoder.free()
+            self._decoder = None
+
+    def _received(self, data : bytes, nbytes : int, age_ms : Optional[float] = None) -> None:
+        now = time.perf_counter()
+        if age_ms is None:
+            # No send time: compare with the schedule that started at the first frame
+            first = self.arrivals[0] if self.arrivals else now
+            age_ms = 1000.0*(now - first) - self.frames*self.interval_ms
+        self.ages_ms.append(age_ms)
+        self.arrivals.append(now)
+        self.frames += 1
+        self.bytes += nbytes
+
+    async def _receive_stream(self, host : str, port : int, deadline : float):
+        """Yield the frames of a pcserver.py --protocol pcserver stream"""
+        reader, writer = await asyncio.open_connection(host, port)
+        last_number = None
+        try:
+            while time.perf_counter() < deadline:
+                header = await asyncio.wait_for(reader.readexactly(FRAME_HEADER.size), deadline - time.perf_counter())
+                fourcc, number, length, timestamp, sendtime = FRAME_HEADER.unpack(header)
+                if fourcc != FOURCC:
+                    self.error = f"bad fourcc {fourcc!r}, not a pcserver stream"
+                    break
+                data = await reader.readexactly(length)
+                self._received(data, FRAME_HEADER.size + length, time.time()*1000.0 - sendtime/1000.0)
+                if last_number is not None and number != last_number + 1:
+                    self.gaps += number - last_number - 1
+                last_number = number
+                yield data
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _receive_forward(self, host : str, port : int, deadline : float):
+        """Yield frames from a cwipc_forward style server: one connection per frame, read until closed"""
+        while time.perf_counter() < deadline:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                if self.frames:
+                    # The server closed after a non-looping sequence
+                    break
+                raise
+            try:
+                data = await asyncio.wait_for(reader.read(), deadline - time.perf_counter())
+            except (asyncio.TimeoutError, ConnectionError):
+                break
+            finally:
+                writer.close()
+            if not data:
+                break
+            self._received(data, len(data))
+            yield data
+        if len(self.arrivals) > 1:
+            # Frames that were due between the first and last one but never arrived
+            slots = round(1000.0*(self.arrivals[-1] - self.arrivals[0]) / self.interval_ms) + 1
+            self.gaps = max(0, slots - self.frames)
+
+    def _decode(self, data : bytes) -> Tuple[bool, int]:
+        """Decode one frame in an executor thread. Returns success and number of points"""
+        with self._decoder_lock:
+            if self._decoder is None:
+                import cwipc.codec
+                self._decoder = cwipc.codec.cwipc_new_decoder()
+            self._decoder.feed(data)
+            if not self._decoder.available(True):
+                return False, 0
+            pc = self._decoder.get()
+            npoints = pc.count()
+            pc.free()
+            return True, npoints
+
+    def results(self) -> Dict[str, Any]:
+        elapsed = max(self.end - self.start, 1e-9)
+        intervals = [1000.0*(b-a) for a, b in zip(self.arrivals, self.arrivals[1:])]
+        jitter = [abs(i - self.interval_ms) for i in intervals]
+        return dict(
+            client=self.number,
+            error=self.error,
+            frames=self.frames,
+            missing_frames=self.gaps,
+            fps=self.frames / elapsed,
+            mbps=8*self.bytes / elapsed / 1e6,
+            jitter_ms=summarize(jitter),
+            age_ms=summarize(self.ages_ms),
+            decoded=self.decoded,
+            decode_errors=self.decode_errors,
+            mean_decoded_points=self.decoded_points / self.decoded if self.decoded else None,
+        )
+
+async def run_load(host : str, port : int, nclients : int, duration : float, interval_ms : float, decode_every : int, protocol : str = "forward") -> Dict[str, Any]:
+    """Run nclients receivers simultaneously. Returns totals and per-client results"""
+    receivers = [Receiver(i, interval_ms, decode_every, protocol) for i in range(nclients)]
+    await asyncio.gather(*(r.run(host, port, duration) for r in receivers))
+    per_client = [r.results() for r in receivers]
+    all_jitter = [abs(1000.0*(b-a) - interval_ms) for r in receivers for a, b in zip(r.arrivals, r.arrivals[1:])]
+    all_ages = [age for r in receivers for age in r.ages_ms]
+    return dict(
+        clients=nclients,
+        failed=sum(1 for r in receivers if r.error),
+        errors=dict(collections.Counter(r.error for r in receivers if r.error)),
+        frames=sum(r.frames for r in receivers),
+        missing_frames=sum(r.gaps for r in receivers),
+        fps_min=min((c["fps"] for c in per_client), default=0),
+        fps_mean=sum(c["fps"] for c in per_client) / max(1, nclients),
+        mbps_total=sum(c["mbps"] for c in per_client),
+        jitter_ms=summarize(all_jitter),
+        age_ms=summarize(all_ages),
+        per_client=per_client,
+    )
+
+def _fmt(value : Optional[float]) -> str:
+    return f"{value:8.1f}" if value is not None else f"{'-':>8s}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many receivers against a forwarding server and measure throughput, jitter and frame age")
+    parser.add_argument("--clients", default="1", help="Comma-separated numbers of simultaneous clients, run one after the other (default: 1)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per run (default: 10)")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default="forward", help="Server protocol: forward, like cwipc_forward, or pcserver, a pcserver.py --protocol pcserver (default: forward)")
+    parser.add_argument("--interval", type=float, default=33, help="Nominal frame interval in ms, for jitter (default: 33)")
+    parser.add_argument("--decode", type=int, default=0, metavar="N", help="Decode every Nth frame with cwipc.codec (default: no decoding)")
+    parser.add_argument("--json", help="Write all results to this JSON file")
+    parser.add_argument("--per-client", action="store_true", help="Also print a line per client")
+    parser.add_argument("host", nargs="?", default="localhost")
+    parser.add_argument("port", nargs="?", type=int, default=8089)
+    args = parser.parse_args()
+    runs = []
+    print(f"{'clients':>7s} {'fps min':>8s} {'fps avg':>8s} {'Mbit/s':>8s} {'missing':>8s} {'jit p50':>8s} {'jit p99':>8s} {'age p50':>8s} {'age p99':>8s}")
+    for nclients in [int(n) for n in args.clients.split(',')]:
+        result = asyncio.run(run_load(args.host, args.port, nclients, args.duration, args.interval, args.decode, args.protocol))
+        runs.append(result)
+        print(f"{nclients:7d} {result['fps_min']:8.1f} {result['fps_mean']:8.1f} {result['mbps_total']:8.1f} {result['missing_frames']:8d} {_fmt(result['jitter_ms']['p50'])} {_fmt(result['jitter_ms']['p99'])} {_fmt(result['age_ms']['p50'])} {_fmt(result['age_ms']['p99'])}", flush=True)
+        for error, count in result['errors'].items():
+            print(f"{count} clients failed: {error}", file=sys.stderr)
+        if args.per_client:
+            for c in result['per_client']:
+                print(f"  client {c['client']:4d} {c['fps']:8.1f} fps {c['mbps']:8.1f} Mbit/s missing={c['missing_frames']} jitter p99={_fmt(c['jitter_ms']['p99'])} age p99={_fmt(c['age_ms']['p99'])}")
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(dict(host=args.host, port=args.port, protocol=args.protocol, duration=args.duration, runs=runs), fp, indent=1)
+
+if __name__ == "__main__":
+    main()
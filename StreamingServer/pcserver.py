@@ -0,0 +1,299 @@
+"""Local asyncio server for compressed point cloud sequences, for fan-out tests.
+
+Loads a compressed sample sequence (a directory of .cwicpc files, or a .cwipcseq
+archive made with scripts/cwipcseq.py) into memory once, and serves it to any number
+of TCP clients, paced at the sequence frame rate. There are two wire protocols:
+
+--protocol forward (the default) sends what cwipc_forward --port sends: every
+connection gets one compressed frame, without any header, after which the server
+closes the connection. The client connects again for the next frame. Every
+connection gets the next frame that becomes due (frame n is due at server start +
+n*interval), so a client that reconnects late misses frames, like with a live source.
+With --policy drop or disconnect a client that does not take the frame within
+--maxqueue frame intervals loses it, with --policy nodrop the server waits.
+
+--protocol pcserver is private to this server and pcloadclient.py. Every client keeps
+one connection and gets its own copy of the stream, starting at the first frame when
+it connects. Each frame is sent as a FRAME_HEADER followed by the compressed data:
+
+    fourcc      4 bytes, b"CPCF"
+    number      uint32, frame number for this client (0, 1, 2, ...)
+    length      uint32, number of bytes of compressed data that follow
+    timestamp   int64, frame timestamp in ms (increases across loops)
+    sendtime    int64, wall clock time when the frame was sent, in microseconds
+
+Slow clients (whose socket send buffer still holds more than --maxqueue frames when
+the next frame is due) have the new frame dropped, or are disconnected, depending
+on --policy. With --policy nodrop the server waits for a slow client instead.
+
+Counters (frames sent, bytes, queue depth, drops, per client and total) are printed
+every --stats seconds, and returned as JSON to anyone connecting to --stats-port.
+The JSON also has the server start time and interval, and the number and send time
+of the last frame, so receivers of the forward protocol can compute frame ages.
+
+Example, serving the same stream as forward-depth7.sh but without Docker:
+
+    python pcserver.py --port 8089 --loop --stats-port 8090 ../Samples/loot-compressed/depth7
+"""
+import sys
+import os
+import json
+import time
+import struct
+import asyncio
+import argparse
+import contextlib
+from typing import Dict, List
+
+FOURCC = b"CPCF"
+FRAME_HEADER = struct.Struct("<4sIIqq")
+PROTOCOLS = ("forward", "pcserver")
+
+def load_sequence(path : str) -> List[bytes]:
+    """Read all compressed frames of a directory (or .cwipcseq archive) into memory"""
+    if os.path.isdir(path):
+        rv = []
+        for filename in sorted(os.listdir(path)):
+            if os.path.splitext(filename)[1] != '.cwicpc':
+                continue
+            with open(os.path.join(path, filename), 'rb') as fp:
+                rv.append(fp.read())
+        return rv
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+    import cwipcseq
+    with cwipcseq.SequenceArchive(path) as archive:
+        return [bytes(archive.frame(i)) for i in range(len(archive))]
+
+class ClientStats:
+    """Counters for a single client connection"""
+
+    def __init__(self, peer : str):
+        self.peer = peer
+        self.connected = time.time()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_dropped = 0
+        self.queue_bytes = 0
+        self.queue_frames = 0.0
+
+    def as_dict(self) -> Dict:
+        return dict(
+            peer=self.peer,
+            seconds=round(time.time()-self.connected, 3),
+            frames_sent=self.frames_sent,
+            bytes_sent=self.bytes_sent,
+            frames_dropped=self.frames_dropped,
+            queue_bytes=self.queue_bytes,
+            queue_frames=round(self.queue_frames, 2),
+        )
+
+class StreamingServer:
+    """Serves an in-memory sequence to many clients with per-client pacing"""
+
+    def __init__(self, frames : List[bytes], interval : float, loop : bool, policy : str, maxqueue : int, protocol : str = "forward"):
+        self.frames = frames
+        self.protocol = protocol
+        self.interval = interval
+        self.loop = loop
+        self.policy = policy
+        self.maxqueue = maxqueue
+        self.mean_frame_size = sum(len(f) for f in frames) / max(1, len(frames))
+        self.clients : Dict[int, ClientStats] = {}
+        self.total_frames_sent = 0
+        self.total_bytes_sent = 0
+        self.total_frames_dropped = 0
+        self.total_connections = 0
+        self.started = time.time()
+        self.start = 0.0            # Event loop time of frame 0, for the forward protocol
+        self.last_number = -1       # Last frame sent with the forward protocol, and when
+        self.last_sendtime = 0.0
+        self.connections : Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    def start_clock(self) -> None:
+        self.started = time.time()
+        self.start = asyncio.get_running_loop().time()
+
+    async def handle_client(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            if self.protocol == "forward":
+                await self.handle_forward(reader, writer)
+            else:
+                await self.handle_stream(reader, writer)
+        finally:
+            del self.connections[task]
+
+    async def close_connections(self) -> None:
+        """Abort all client connections, and wait for their handlers to notice"""
+        for writer in self.connections.values():
+            writer.transport.abort()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=self.interval + 1)
+
+    async def handle_forward(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        """Send the next frame that becomes due as the only data on this connection, like cwipc_forward"""
+        peer = str(writer.get_extra_info('peername'))
+        stats = ClientStats(peer)
+        self.clients[id(stats)] = stats
+        self.total_connections += 1
+        loop = asyncio.get_running_loop()
+        try:
+            number = int((loop.time() - self.start) / self.interval) + 1 if self.interval > 0 else self.last_number + 1
+            if number >= len(self.frames) and not self.loop:
+                return
+            delay = self.start + number*self.interval - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if writer.transport.is_closing():
+                return
+            data = self.frames[number % len(self.frames)]
+            writer.write(data)
+            stats.queue_bytes = writer.transport.get_write_buffer_size()
+            stats.queue_frames = stats.queue_bytes / self.mean_frame_size
+            self.last_number = max(self.last_number, number)
+            self.last_sendtime = time.time()
+            if self.policy == "nodrop":
+                await writer.drain()
+            else:
+                try:
+                    await asyncio.wait_for(writer.drain(), self.maxqueue*self.interval if self.interval > 0 else None)
+                except asyncio.TimeoutError:
+                    stats.frames_dropped += 1
+                    self.total_frames_dropped += 1
+                    writer.transport.abort()
+                    return
+            stats.frames_sent += 1
+            stats.bytes_sent += len(data)
+            self.total_frames_sent += 1
+            self.total_bytes_sent += len(data)
+        except ConnectionError:
+            pass
+        finally:
+            del self.clients[id(stats)]
+            writer.close()
+
+    async def handle_stream(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        """Send the whole sequence on this connection, with a FRAME_HEADER per frame"""
+        peer = str(writer.get_extra_info('peername'))
+        stats = ClientStats(peer)
+        self.clients[id(stats)] = stats
+        self.total_connections += 1
+        transport = writer.transport
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        number = 0
+        try:
+            while True:
+                index = number % len(self.frames)
+                if number >= len(self.frames) and not self.loop:
+                    break
+                # Per-client pacing: frame n is due at start + n*interval
+                due = start + number*self.interval
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if transport.is_closing():
+                    break
+                buffered = transport.get_write_buffer_size()
+                stats.queue_bytes = buffered
+                stats.queue_frames = buffered / self.mean_frame_size
+                if self.policy != "nodrop" and stats.queue_frames > self.maxqueue:
+                    stats.frames_dropped += 1
+                    self.total_frames_dropped += 1
+                    number += 1
+                    if self.policy == "disconnect":
+                        print(f"pcserver: {peer}: too slow, disconnecting", file=sys.stderr)
+                        break
+                    continue
+                data = self.frames[index]
+                timestamp = int(number*self.interval*1000)
+                writer.write(FRAME_HEADER.pack(FOURCC, number, len(data), timestamp, int(time.time()*1000000)))
+                writer.write(data)
+                stats.frames_sent += 1
+                stats.bytes_sent += FRAME_HEADER.size + len(data)
+                self.total_frames_sent += 1
+                self.total_bytes_sent += FRAME_HEADER.size + len(data)
+                number += 1
+                if self.policy == "nodrop":
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self.clients[id(stats)]
+            writer.close()
+
+    def as_dict(self) -> Dict:
+        return dict(
+            frames=len(self.frames),
+            interval=self.interval,
+            protocol=self.protocol,
+            policy=self.policy,
+            started=self.started,
+            last_frame=self.last_number,
+            last_sendtime=self.last_sendtime,
+            connections_total=self.total_connections,
+            clients=[c.as_dict() for c in self.clients.values()],
+            frames_sent=self.total_frames_sent,
+            bytes_sent=self.total_bytes_sent,
+            frames_dropped=self.total_frames_dropped,
+        )
+
+    async def handle_stats(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter) -> None:
+        writer.write(json.dumps(self.as_dict(), indent=1).encode('utf8') + b"\n")
+        await writer.drain()
+        writer.close()
+
+    async def print_stats(self, period : float) -> None:
+        while True:
+            await asyncio.sleep(period)
+            maxqueue = max((c.queue_frames for c in self.clients.values()), default=0)
+            print(f"pcserver: clients={len(self.clients)} frames_sent={self.total_frames_sent} bytes_sent={self.total_bytes_sent} dropped={self.total_frames_dropped} max_queue_frames={maxqueue:.1f}", file=sys.stderr)
+
+async def serve(args : argparse.Namespace) -> None:
+    frames = load_sequence(args.sequence)
+    if not frames:
+        print(f"pcserver: no frames in {args.sequence}", file=sys.stderr)
+        sys.exit(1)
+    total = sum(len(f) for f in frames)
+    print(f"pcserver: {len(frames)} frames, {total} bytes loaded from {args.sequence}", file=sys.stderr)
+    server = StreamingServer(frames, args.interval/1000.0, args.loop, args.policy, args.maxqueue, args.protocol)
+    server.start_clock()
+    tcpserver = await asyncio.start_server(server.handle_client, args.host, args.port)
+    print(f"pcserver: serving on {args.host}:{args.port} ({args.protocol} protocol)", file=sys.stderr)
+    stats_task = None
+    async with contextlib.AsyncExitStack() as stack:
+        await stack.enter_async_context(tcpserver)
+        if args.stats_port:
+            statsserver = await asyncio.start_server(server.handle_stats, args.host, args.stats_port)
+            await stack.enter_async_context(statsserver)
+        if args.stats:
+            stats_task = asyncio.ensure_future(server.print_stats(args.stats))
+        try:
+            await tcpserver.serve_forever()
+        finally:
+            await server.close_connections()
+            if stats_task is not None:
+                stats_task.cancel()
+                await asyncio.gather(stats_task, return_exceptions=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a compressed point cloud sequence to many TCP clients")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on (default: 0.0.0.0)")
+    parser.add_argument("--port", type=int, default=8089, help="Port to listen on (default: 8089)")
+    parser.add_argument("--protocol", choices=PROTOCOLS, default="forward", help="Wire protocol: forward, one frame per connection like cwipc_forward, or pcserver, one connection with framed frames (default: forward)")
+    parser.add_argument("--interval", type=float, default=33, help="Time between frames in ms (default: 33)")
+    parser.add_argument("--loop", action="store_true", help="Loop the sequence forever")
+    parser.add_argument("--policy", choices=["drop", "disconnect", "nodrop"], default="drop", help="What to do with slow clients (default: drop frames)")
+    parser.add_argument("--maxqueue", type=int, default=3, help="Frames that may be waiting in a client's send buffer before the policy applies (default: 3)")
+    parser.add_argument("--stats", type=float, default=10, help="Print counters every this many seconds, 0 to disable (default: 10)")
+    parser.add_argument("--stats-port", type=int, default=0, help="Port that returns counters as JSON (default: none)")
+    parser.add_argument("sequence", help="Directory with .cwicpc files, or .cwipcseq archive")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
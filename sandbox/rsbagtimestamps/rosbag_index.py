@@ -0,0 +1,423 @@
+"""Minimal ROS1 bag (format 2.0) reader for frame timestamps, without decoding images.
+
+Realsense recordings are ROS1 bag files. For timestamp analysis only a few bytes
+of each image message are needed: the std_msgs/Header at the start of
+sensor_msgs/Image, which holds the frame number (seq) and frame timestamp (stamp).
+This module uses the bag's own index (connection records, chunk info records and the
+index data records after every chunk) to find the image messages, and reads only
+their headers from a memory mapping of the file. Image data is never read (for
+uncompressed chunks) or decoded.
+
+The small diagnostic_msgs/KeyValue metadata messages librealsense writes next to
+every frame are read completely.
+
+There is also a minimal writer, so small synthetic bag files can be created for testing:
+
+    python rosbag_index.py --synthetic test.bag --frames 300 --drop 100,101
+    python rosbag_index.py test.bag
+"""
+import re
+import mmap
+import bisect
+import struct
+import argparse
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+BAG_MAGIC = b"#ROSBAG V2.0\n"
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+# Realsense topics: /device_0/sensor_0/Depth_0/image/data, .../image/metadata and .../info
+STREAM_TOPIC = re.compile(r'^/device_\d+/sensor_\d+/(?P<stream>Depth|Color)_\d+/(?P<kind>image/data|image/metadata|info)$')
+
+_I32 = struct.Struct("<i")
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+_TIME = struct.Struct("<II")
+_IMAGE_HEADER = struct.Struct("<III")   # seq, stamp.sec, stamp.nsec
+_INDEX_ENTRY = struct.Struct("<III")    # time.sec, time.nsec, offset
+
+def parse_header(buf, offset : int, length : int) -> Dict[str, bytes]:
+    """Parse a record header (name=value fields) at offset"""
+    rv = {}
+    end = offset + length
+    while offset < end:
+        (flen,) = _I32.unpack_from(buf, offset)
+        offset += 4
+        field = bytes(buf[offset:offset+flen])
+        offset += flen
+        name, _, value = field.partition(b"=")
+        rv[name.decode('ascii')] = value
+    return rv
+
+def read_record(buf, offset : int) -> Tuple[Dict[str, bytes], int, int, int]:
+    """Return (header, data_offset, data_length, next_record_offset) for the record at offset"""
+    (hlen,) = _I32.unpack_from(buf, offset)
+    header = parse_header(buf, offset+4, hlen)
+    data_offset = offset + 4 + hlen + 4
+    (dlen,) = _I32.unpack_from(buf, offset + 4 + hlen)
+    return header, data_offset, dlen, data_offset + dlen
+
+def _decompress(compression : bytes, data : bytes, size : int, filename : str = "") -> bytes:
+    if compression == b"none":
+        return data
+    if compression == b"bz2":
+        import bz2
+        return bz2.decompress(data)
+    if compression == b"lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError(f"{filename}: has lz4-compressed chunks, which need the lz4 package (pip install lz4)") from None
+        return lz4.frame.decompress(data)
+    raise ValueError(f"Unsupported chunk compression {compression!r}")
+
+class BagIndex:
+    """Index of a ROS1 bag file: connections and, per connection, message positions"""
+
+    def __init__(self, filename : str):
+        self.filename = filename
+        self._fp = open(filename, 'rb')
+        self.buf = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buf[:len(BAG_MAGIC)] != BAG_MAGIC:
+            raise ValueError(f"{filename}: not a ROS bag 2.0 file")
+        header, _, _, _ = read_record(self.buf, len(BAG_MAGIC))
+        if header["op"][0] != OP_BAG_HEADER:
+            raise ValueError(f"{filename}: no bag header record")
+        self.index_pos = _U64.unpack(header["index_pos"])[0]
+        self.conn_count = _I32.unpack(header["conn_count"])[0]
+        self.chunk_count = _I32.unpack(header["chunk_count"])[0]
+        if self.index_pos == 0:
+            raise ValueError(f"{filename}: bag is not indexed (recording was interrupted?)")
+        self.topics : Dict[int, str] = {}
+        self.chunk_positions : List[int] = []
+        offset = self.index_pos
+        while offset < len(self.buf):
+            header, data_offset, data_length, offset = read_record(self.buf, offset)
+            op = header["op"][0]
+            if op == OP_CONNECTION:
+                self.topics[_I32.unpack(header["conn"])[0]] = header["topic"].decode('utf8')
+            elif op == OP_CHUNK_INFO:
+                self.chunk_positions.append(_U64.unpack(header["chunk_pos"])[0])
+        self.chunk_positions.sort()
+        self._chunk_cache : Dict[int, Any] = {}
+
+    def connections(self, pattern : Optional[re.Pattern] = None) -> Dict[int, str]:
+        """Return connection id to topic mapping, optionally only topics matching pattern"""
+        return {conn : topic for conn, topic in self.topics.items() if pattern is None or pattern.match(topic)}
+
+    def _chunk_data(self, chunk_offset : int, header : Dict[str, bytes], data_offset : int, data_length : int):
+        """Return buffer and base offset of the uncompressed chunk data. Uncompressed chunks are not copied"""
+        if header["compression"] == b"none":
+            return self.buf, data_offset
+        if not chunk_offset in self._chunk_cache:
+            size = _U32.unpack(header["size"])[0]
+            self._chunk_cache = {chunk_offset : _decompress(header["compression"], self.buf[data_offset:data_offset+data_length], size, self.filename)}
+        return self._chunk_cache[chunk_offset], 0
+
+    def messages(self, conns : List[int], maxbytes : Optional[Dict[int, int]] = None) -> Iterator[Tuple[int, int, bytes]]:
+        """Yield (conn, receive_time_ns, data) for messages on the given connections, in file order.
+
+        For connections in maxbytes only the first maxbytes[conn] bytes of each message are
+        returned, so the rest of the message (image data) is not touched.
+        """
+        maxbytes = maxbytes or {}
+        wanted = set(conns)
+        for chunk_pos in self.chunk_positions:
+            header, data_offset, data_length, offset = read_record(self.buf, chunk_pos)
+            # Index data records for this chunk follow the chunk record
+            entries = []
+            while offset < len(self.buf):
+                iheader, idata_offset, idata_length, next_offset = read_record(self.buf, offset)
+                if iheader["op"][0] != OP_INDEX_DATA:
+                    break
+                conn = _I32.unpack(iheader["conn"])[0]
+                count = _I32.unpack(iheader["count"])[0]
+                if conn in wanted:
+                    for i in range(count):
+                        sec, nsec, msg_offset = _INDEX_ENTRY.unpack_from(self.buf, idata_offset + i*_INDEX_ENTRY.size)
+                        entries.append((msg_offset, conn, sec*1000000000 + nsec))
+                offset = next_offset
+            if not entries:
+                continue
+            entries.sort()
+            chunk, base = self._chunk_data(chunk_pos, header, data_offset, data_length)
+            for msg_offset, conn, t in entries:
+                (hlen,) = _I32.unpack_from(chunk, base + msg_offset)
+                mdata_offset = base + msg_offset + 4 + hlen + 4
+                (mlen,) = _I32.unpack_from(chunk, mdata_offset - 4)
+                if conn in maxbytes:
+                    mlen = min(mlen, maxbytes[conn])
+                yield conn, t, chunk[mdata_offset:mdata_offset+mlen]
+
+    def close(self) -> None:
+        self._chunk_cache = {}
+        self.buf.close()
+        self._fp.close()
+
+def parse_keyvalue(data) -> Tuple[str, str]:
+    """Parse a diagnostic_msgs/KeyValue message"""
+    (klen,) = _U32.unpack_from(data, 0)
+    key = bytes(data[4:4+klen]).decode('utf8')
+    (vlen,) = _U32.unpack_from(data, 4+klen)
+    value = bytes(data[8+klen:8+klen+vlen]).decode('utf8')
+    return key, value
+
+class StreamFrames:
+    """Frame numbers, timestamps (ms) and metadata of one stream (Depth or Color)"""
+
+    def __init__(self, stream : str):
+        self.stream = stream
+        self.fps = 0
+        self.frame_numbers : List[int] = []
+        self.timestamps : List[float] = []
+        self.metadata : List[Dict[str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+def read_stream_frames(filename : str) -> Dict[str, StreamFrames]:
+    """Return StreamFrames for the Depth and Color streams of a realsense bag file, without decoding images"""
+    index = BagIndex(filename)
+    try:
+        conns = {}
+        for conn, topic in index.connections(STREAM_TOPIC).items():
+            m = STREAM_TOPIC.match(topic)
+            conns[conn] = (m.group('stream'), m.group('kind'))
+        rv = {stream : StreamFrames(stream) for stream, kind in conns.values() if kind == 'image/data'}
+        # Only the std_msgs/Header at the start of an image message is read
+        maxbytes = {conn : _IMAGE_HEADER.size for conn, (stream, kind) in conns.items() if kind == 'image/data'}
+        # Metadata messages for a frame follow its image message, so they are
+        # attached to the most recent frame of that stream.
+        for conn, _, data in index.messages(list(conns), maxbytes):
+            stream, kind = conns[conn]
+            frames = rv.get(stream)
+            if frames is None:
+                continue
+            if kind == 'image/data':
+                seq, sec, nsec = _IMAGE_HEADER.unpack_from(data, 0)
+                frames.frame_numbers.append(seq)
+                frames.timestamps.append(sec*1000.0 + nsec/1000000.0)
+                frames.metadata.append({})
+            elif kind == 'info':
+                # realsense_msgs/StreamInfo starts with uint32 fps
+                (frames.fps,) = _U32.unpack_from(data, 0)
+            elif frames.metadata:
+                key, value = parse_keyvalue(data)
+                frames.metadata[-1][key] = value
+        for frames in rv.values():
+            if not frames.fps and len(frames) > 1:
+                intervals = sorted(b-a for a, b in zip(frames.timestamps, frames.timestamps[1:]))
+                median = intervals[len(intervals)//2]
+                frames.fps = int(round(1000.0 / median)) if median > 0 else 0
+        return rv
+    finally:
+        index.close()
+
+class IndexedFrame:
+    """Stand-in for rs.frame with the timestamp, frame number and metadata read from the bag"""
+
+    def __init__(self, frames : StreamFrames, i : int):
+        self.frames = frames
+        self.i = i
+
+    def get_timestamp(self) -> float:
+        return self.frames.timestamps[self.i]
+
+    def get_frame_number(self) -> int:
+        return self.frames.frame_numbers[self.i]
+
+    def get_frame_metadata(self, key : str) -> Optional[int]:
+        value = self.frames.metadata[self.i].get(key)
+        return int(value) if value is not None else None
+
+    def get_all_metadata(self) -> Dict[str, str]:
+        return self.frames.metadata[self.i]
+
+class IndexedFrameset:
+    """Stand-in for rs.composite_frame"""
+
+    def __init__(self, depth : Optional[IndexedFrame], color : Optional[IndexedFrame]):
+        self.depth = depth
+        self.color = color
+
+    def get_depth_frame(self) -> Optional[IndexedFrame]:
+        return self.depth
+
+    def get_color_frame(self) -> Optional[IndexedFrame]:
+        return self.color
+
+def pair_frames(depth : Optional[StreamFrames], color : Optional[StreamFrames]) -> List[IndexedFrameset]:
+    """Combine depth and color frames into framesets, approximating the rs.pipeline syncer.
+
+    Every depth frame gets the latest color frame that is not more than half a color
+    frame interval newer. If a color frame is missing the previous one is repeated, as
+    the pipeline does. Depth frames before the first color frame are skipped.
+    If one of the streams is None every frame of the other one is a frameset by itself.
+    """
+    if depth is None or color is None:
+        frames = depth if depth is not None else color
+        if frames is None:
+            return []
+        return [IndexedFrameset(IndexedFrame(frames, i) if frames is depth else None, IndexedFrame(frames, i) if frames is color else None) for i in range(len(frames))]
+    tolerance = 500.0 / color.fps if color.fps else 0
+    rv = []
+    for i, ts in enumerate(depth.timestamps):
+        c = bisect.bisect_right(color.timestamps, ts + tolerance) - 1
+        if c < 0:
+            continue
+        rv.append(IndexedFrameset(IndexedFrame(depth, i), IndexedFrame(color, c)))
+    return rv
+
+class IndexedFrameSource:
+    """Replays framesets from the bag index with the wait_for_frames() interface of rs.pipeline"""
+
+    def __init__(self, framesets : List[IndexedFrameset]):
+        self.framesets = framesets
+        self.position = 0
+
+    def wait_for_frames(self) -> IndexedFrameset:
+        if self.position >= len(self.framesets):
+            # rs.pipeline raises RuntimeError when no more frames arrive
+            raise RuntimeError("No more frames in bag index")
+        rv = self.framesets[self.position]
+        self.position += 1
+        return rv
+
+class BagWriter:
+    """Minimal ROS1 bag writer: uncompressed chunks, with index. For synthetic test files"""
+
+    def __init__(self, filename : str, chunk_size : int = 1<<20):
+        self.fp = open(filename, 'wb')
+        self.fp.write(BAG_MAGIC)
+        self.bag_header_pos = self.fp.tell()
+        self._write_bag_header(0, 0, 0)
+        self.chunk_size = chunk_size
+        self.connections : Dict[str, int] = {}
+        self.connection_records : List[bytes] = []
+        self.chunk_infos : List[bytes] = []
+        self._chunk = bytearray()
+        self._chunk_index : Dict[int, List[Tuple[int, int]]] = {}
+        self._chunk_conns_written = set()
+
+    @staticmethod
+    def _field(name : str, value : bytes) -> bytes:
+        field = name.encode('ascii') + b"=" + value
+        return _I32.pack(len(field)) + field
+
+    @classmethod
+    def _record(cls, fields : List[Tuple[str, bytes]], data : bytes) -> bytes:
+        header = b"".join(cls._field(name, value) for name, value in fields)
+        return _I32.pack(len(header)) + header + _I32.pack(len(data)) + data
+
+    def _write_bag_header(self, index_pos : int, conn_count : int, chunk_count : int) -> None:
+        fields = [("op", bytes([OP_BAG_HEADER])), ("index_pos", _U64.pack(index_pos)), ("conn_count", _I32.pack(conn_count)), ("chunk_count", _I32.pack(chunk_count))]
+        # The bag header record is padded to 4096 bytes, so it can be rewritten in place
+        padding = 4096 - len(self._record(fields, b""))
+        self.fp.write(self._record(fields, b" " * padding))
+
+    def _connection_record(self, conn : int, topic : str, msgtype : str) -> bytes:
+        data = self._field("topic", topic.encode()) + self._field("type", msgtype.encode()) + self._field("md5sum", b"*") + self._field("message_definition", b"")
+        return self._record([("op", bytes([OP_CONNECTION])), ("conn", _I32.pack(conn)), ("topic", topic.encode())], data)
+
+    def write(self, topic : str, msgtype : str, time_ns : int, data : bytes) -> None:
+        if not topic in self.connections:
+            conn = len(self.connections)
+            self.connections[topic] = conn
+            self.connection_records.append(self._connection_record(conn, topic, msgtype))
+        conn = self.connections[topic]
+        if not conn in self._chunk_conns_written:
+            self._chunk += self.connection_records[conn]
+            self._chunk_conns_written.add(conn)
+        sec, nsec = divmod(time_ns, 1000000000)
+        self._chunk_index.setdefault(conn, []).append((time_ns, len(self._chunk)))
+        self._chunk += self._record([("op", bytes([OP_MSG_DATA])), ("conn", _I32.pack(conn)), ("time", _TIME.pack(sec, nsec))], data)
+        if len(self._chunk) >= self.chunk_size:
+            self._flush_chunk()
+
+    def _flush_chunk(self) -> None:
+        if not self._chunk_index:
+            return
+        chunk_pos = self.fp.tell()
+        self.fp.write(self._record([("op", bytes([OP_CHUNK])), ("compression", b"none"), ("size", _U32.pack(len(self._chunk)))], bytes(self._chunk)))
+        times = [t for entries in self._chunk_index.values() for t, _ in entries]
+        counts = b""
+        for conn, entries in sorted(self._chunk_index.items()):
+            data = b"".join(_INDEX_ENTRY.pack(*divmod(t, 1000000000), offset) for t, offset in entries)
+            self.fp.write(self._record([("op", bytes([OP_INDEX_DATA])), ("ver", _I32.pack(1)), ("conn", _I32.pack(conn)), ("count", _I32.pack(len(entries)))], data))
+            counts += _I32.pack(conn) + _I32.pack(len(entries))
+        self.chunk_infos.append(self._record([
+            ("op", bytes([OP_CHUNK_INFO])), ("ver", _I32.pack(1)), ("chunk_pos", _U64.pack(chunk_pos)),
+            ("start_time", _TIME.pack(*divmod(min(times), 1000000000))), ("end_time", _TIME.pack(*divmod(max(times), 1000000000))),
+            ("count", _I32.pack(len(self._chunk_index)))], counts))
+        self._chunk = bytearray()
+        self._chunk_index = {}
+        self._chunk_conns_written = set()
+
+    def close(self) -> None:
+        self._flush_chunk()
+        index_pos = self.fp.tell()
+        for record in self.connection_records:
+            self.fp.write(record)
+        for record in self.chunk_infos:
+            self.fp.write(record)
+        self.fp.seek(self.bag_header_pos)
+        self._write_bag_header(index_pos, len(self.connection_records), len(self.chunk_infos))
+        self.fp.close()
+
+def image_message(seq : int, stamp_ms : float, payload_size : int, encoding : bytes = b"z16") -> bytes:
+    """Return a sensor_msgs/Image message with the given header and payload_size bytes of (zero) image data"""
+    sec, nsec = divmod(int(round(stamp_ms*1000000)), 1000000000)
+    frame_id = b"0"
+    return (_IMAGE_HEADER.pack(seq, sec, nsec) + _U32.pack(len(frame_id)) + frame_id +
+        _U32.pack(1) + _U32.pack(payload_size) + _U32.pack(len(encoding)) + encoding + b"\0" + _U32.pack(payload_size) +
+        _U32.pack(payload_size) + bytes(payload_size))
+
+def keyvalue_message(key : str, value : str) -> bytes:
+    k = key.encode()
+    v = value.encode()
+    return _U32.pack(len(k)) + k + _U32.pack(len(v)) + v
+
+def write_synthetic_bag(filename : str, nframes : int = 300, fps : int = 30, start_ms : float = 1700000000000.0, color_offset_ms : float = 1.0, drop : Tuple[int, ...] = (), payload_size : int = 1024) -> None:
+    """Write a small realsense-like bag with Depth and Color streams. Frames in drop are left out of both streams"""
+    writer = BagWriter(filename)
+    interval = 1000.0 / fps
+    for sensor, stream, encoding in ((0, "Depth", b"z16"), (1, "Color", b"rgb8")):
+        stream_info = _U32.pack(fps) + _U32.pack(len(encoding)) + encoding + b"\1"
+        writer.write(f"/device_0/sensor_{sensor}/{stream}_0/info", "realsense_msgs/StreamInfo", int(start_ms*1000000), stream_info)
+    for i in range(nframes):
+        if i in drop:
+            continue
+        for sensor, stream, encoding, offset in ((0, "Depth", b"z16", 0.0), (1, "Color", b"rgb8", color_offset_ms)):
+            ts = start_ms + i*interval + offset
+            topic = f"/device_0/sensor_{sensor}/{stream}_0/image"
+            writer.write(topic + "/data", "sensor_msgs/Image", int(ts*1000000), image_message(i+1, ts, payload_size, encoding))
+            writer.write(topic + "/metadata", "diagnostic_msgs/KeyValue", int(ts*1000000), keyvalue_message("Frame Counter", str(i+1)))
+            writer.write(topic + "/metadata", "diagnostic_msgs/KeyValue", int(ts*1000000), keyvalue_message("Time Of Arrival", str(int(ts)+5)))
+    writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="List realsense streams in a ROS1 bag file, or create a synthetic one")
+    parser.add_argument("--synthetic", action="store_true", help="Create a synthetic bag file instead of reading one")
+    parser.add_argument("--frames", type=int, default=300, help="With --synthetic: number of frames (default: 300)")
+    parser.add_argument("--fps", type=int, default=30, help="With --synthetic: frame rate (default: 30)")
+    parser.add_argument("--drop", default="", help="With --synthetic: comma-separated frame indices to leave out")
+    parser.add_argument("bagfile")
+    args = parser.parse_args()
+    if args.synthetic:
+        drop = tuple(int(i) for i in args.drop.split(',') if i)
+        write_synthetic_bag(args.bagfile, args.frames, args.fps, drop=drop)
+        return
+    for stream, frames in sorted(read_stream_frames(args.bagfile).items()):
+        n = len(frames.timestamps)
+        if n:
+            print(f"{stream}: {n} frames, frame numbers {frames.frame_numbers[0]}..{frames.frame_numbers[-1]}, timestamps {frames.timestamps[0]:.3f}..{frames.timestamps[-1]:.3f}")
+        else:
+            print(f"{stream}: no frames")
+
+if __name__ == "__main__":
+    main()
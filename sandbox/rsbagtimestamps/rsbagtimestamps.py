@@ -1,8 +1,17 @@
 import sys
+import os
 import argparse
-from typing import List, Any, Tuple, TextIO
-import pyrealsense2 as rs
+from typing import List, Any, Tuple, TextIO, Dict
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    # Only needed for playback, not for --metadata-only
+    rs = None
 import time
+import concurrent.futures
+import rosbag_index
+import tsindex
+import syncengine
 
 class BagPipeline:
 
@@ -147,29 +156,121 @@ class BagPipeline:
         print(f"details: cam={self.camnum}, frame={frame_name}, frame_timestamp={frame.get_frame_metadata(rs.frame_metadata_value.frame_timestamp)}", file=sys.stderr)
         print(f"details: cam={self.camnum}, frame={frame_name}, sensor_timestamp={frame.get_frame_metadata(rs.frame_metadata_value.sensor_timestamp)}", file=sys.stderr)
         print(f"details: cam={self.camnum}, frame={frame_name}, time_of_arrival={frame.get_frame_metadata(rs.frame_metadata_value.time_of_arrival)}", file=sys.stderr)
-    
+
+class BagIndexPipeline(BagPipeline):
+    """BagPipeline that reads frame timestamps and metadata from the bag index, without playback.
+
+    Frames are not decoded (and librealsense is not used), so this is much faster than
+    playback. Depth and color frames are paired into framesets by timestamp, which
+    approximates what the librealsense pipeline does. The timestamps are cached in
+    BAGFILE.tsindex.npz, so later runs do not have to read the bag file again.
+    """
+
+    def __init__(self, camnum : int, filename: str, args : argparse.Namespace):
+        self.debug = args.debug
+        self.nodepth = args.nodepth
+        self.nocolor = args.nocolor
+        self.multisync = args.multisync
+        self.camnum = camnum
+        self.filename = filename
+        streams = tsindex.stream_frames(self.filename, args.cache_dir, not args.no_cache)
+        depth = None if self.nodepth else streams.get("Depth")
+        color = None if self.nocolor else streams.get("Color")
+        if depth is None and not self.nodepth:
+            raise RuntimeError(f"{self.filename}: no depth stream")
+        if color is None and not self.nocolor:
+            raise RuntimeError(f"{self.filename}: no color stream")
+        self.depth_fps = depth.fps if depth else 0
+        self.color_fps = color.fps if color else 0
+        self.wanted_depth_duration = int(1000.0 / self.depth_fps) if self.depth_fps else 0
+        self.wanted_color_duration = int(1000.0 / self.color_fps) if self.color_fps else 0
+        print(f"{self.filename}: camera={self.camnum} color_fps={self.color_fps} ({self.wanted_color_duration} ms), depth_fps={self.depth_fps} ({self.wanted_depth_duration} ms), from bag index", file=sys.stderr)
+        self.framesource = rosbag_index.IndexedFrameSource(rosbag_index.pair_frames(depth, color))
+
+        self.current_depth_timestamp = 0
+        self.current_color_timestamp = 0
+        self.current_frame_timestamp = 0
+        self.current_depth_duration = 0
+        self.current_color_duration = 0
+        self.current_frame_duration = 0
+        self.current_late_ms = 0
+        self.current_skipped_ms = 0
+        self.current_frames = None
+
+    def print_detail(self) -> None:
+        if not self.current_frames:
+            print(f"details: cam={self.camnum}", file=sys.stderr)
+            return
+        print(f"details: cam={self.camnum}, frameset={self.framesource.position}", file=sys.stderr)
+        for frame_name, frame in (("depth", self.current_frames.get_depth_frame()), ("color", self.current_frames.get_color_frame())):
+            if frame is None:
+                continue
+            print(f"details: cam={self.camnum}, frame={frame_name}, idx={frame.get_frame_number()}, ts={frame.get_timestamp()}, time={time.ctime(frame.get_timestamp()/1000)}", file=sys.stderr)
+            for key, value in frame.get_all_metadata().items():
+                print(f"details: cam={self.camnum}, frame={frame_name}, {key}={value}", file=sys.stderr)
+
 def main():
     parser = argparse.ArgumentParser(sys.argv[0], "Print timestamps from recorded realsense bag file")
     parser.add_argument("--concurrent", default=False, action="store_true", help="Attempt to synchronise files. Implies --stdout")
     parser.add_argument("--stdout", default=False, action="store_true", help="Send CSV data to stdout. Default: per-camera output in ts-BAGFILE.csv")
     parser.add_argument("--realtime", action="store_true", help="Use librealsense set_real_time(true) for realtime playback")
     parser.add_argument("--syncer", action="store_true", help="Use librealsense rs2::syncer to sync RGB and D streams")
+    parser.add_argument("--engine", choices=["master", "heap"], default="master", help="With --concurrent: sync camera 0 as master with playback (default), or merge extracted timestamps of all cameras (see syncengine.py)")
+    parser.add_argument("--window", type=float, default=None, help="With --engine heap: matching window in ms (default: half the frame interval)")
     parser.add_argument("--multisync", action="store_true", help="Attempt multi-camera sync (for --concurrent)")
     parser.add_argument("--nocolor", action="store_true", help="Ignore color frames")
     parser.add_argument("--nodepth", action="store_true", help="Ignore depth frames")
     parser.add_argument("--detail", action="store_true", help="Print very detailed timestamp information")
     parser.add_argument("--debug", action="store_true", help="Print debug messages")
+    parser.add_argument("--metadata-only", action="store_true", help="Read timestamps and metadata from the bag index, without playback or decoding frames (much faster, no librealsense needed)")
+    parser.add_argument("--cache-dir", help="With --metadata-only: directory for the BAGFILE.tsindex.npz timestamp caches (default: next to the bag files)")
+    parser.add_argument("--no-cache", action="store_true", help="With --metadata-only: do not use or create timestamp caches")
+    parser.add_argument("--jobs", type=int, default=0, help="Without --concurrent: number of bag files to analyse in parallel (default: one per bag file, at most one per core)")
 
     parser.add_argument("bagfile", nargs="*", help="File(s) to print timestamps from")
     args = parser.parse_args()
+    if args.concurrent and args.engine == "heap":
+        stats = syncengine.run(args.bagfile, args.window, sys.stdout, nodepth=args.nodepth, nocolor=args.nocolor, cachedir=args.cache_dir, use_cache=not args.no_cache)
+        syncengine.print_statistics(stats)
+        return
+    if rs is None and not args.metadata_only:
+        print(f"{sys.argv[0]}: pyrealsense2 not available, only --metadata-only can be used", file=sys.stderr)
+        sys.exit(1)
     if args.concurrent:
         printstamps(args.bagfile, args)
     else:
-        for bf in args.bagfile:
-            print(f"{bf}:", file=sys.stderr)
-            printstamps([bf], args)
+        jobs = args.jobs if args.jobs > 0 else min(len(args.bagfile), os.cpu_count() or 1)
+        if args.stdout:
+            # Keep CSV output of the bag files in order
+            jobs = 1
+        summaries = []
+        if jobs <= 1:
+            for bf in args.bagfile:
+                print(f"{bf}:", file=sys.stderr)
+                summaries.append(printstamps([bf], args))
+        else:
+            # Every bag file is played back in its own process, writing its own ts-BAGFILE.csv
+            start_time = time.time()
+            with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+                futures = {pool.submit(printstamps, [bf], args) : bf for bf in args.bagfile}
+                for future in concurrent.futures.as_completed(futures):
+                    summary = future.result()
+                    summaries.append(summary)
+                    print(f"[{len(summaries)}/{len(futures)}] {futures[future]}: done, {summary['frames']} frames, playback {int(summary['playback_duration'])}s, elapsed {int(time.time()-start_time)}s", file=sys.stderr)
+            summaries.sort(key=lambda s: args.bagfile.index(s['filename']))
+        print_report(summaries)
+
+def print_report(summaries : List[Dict[str, Any]]) -> None:
+    """Print a combined report of all analysed bag files"""
+    print(file=sys.stderr)
+    print(f"{'bagfile':40s} {'frames':>7s} {'rec s':>7s} {'play s':>7s} {'d_dur0':>7s} {'rgb_dur0':>8s} {'max d_dur':>9s} {'max rgb_dur':>11s}", file=sys.stderr)
+    for s in summaries:
+        print(f"{s['filename']:40s} {s['frames']:7d} {s['recording_duration']:7.1f} {s['playback_duration']:7.1f} {s['zero_depth_durations']:7d} {s['zero_color_durations']:8d} {s['max_depth_duration']:9d} {s['max_color_duration']:11d}", file=sys.stderr)
+    if summaries:
+        print(f"{'total':40s} {sum(s['frames'] for s in summaries):7d} {'':7s} {max(s['playback_duration'] for s in summaries):7.1f} (longest playback)", file=sys.stderr)
 
-def printstamps(filenames : List[str], args : argparse.Namespace) -> None:
+def printstamps(filenames : List[str], args : argparse.Namespace) -> Dict[str, Any]:
+    """Play back bag files and print their timestamps as CSV. Returns summary of the (first) camera"""
     readers : List[BagPipeline]= []
     csv_output : TextIO
     detail : bool = args.detail
@@ -179,8 +280,9 @@ def printstamps(filenames : List[str], args : argparse.Namespace) -> None:
         csv_name = f"ts-{filenames[0]}.csv"
         csv_output = open(csv_name, "w")
     camnum = 0
+    pipeline_class = BagIndexPipeline if args.metadata_only else BagPipeline
     for filename in filenames:
-        reader = BagPipeline(camnum, filename, args)
+        reader = pipeline_class(camnum, filename, args)
         readers.append(reader)
         camnum += 1
     master_cam = readers[0]
@@ -189,6 +291,7 @@ def printstamps(filenames : List[str], args : argparse.Namespace) -> None:
     playback_start_time = time.time()
     print("camnum,timestamp,d_timestamp,c_timestamp,master_d_offset,mslate,msskipped,rgb_d_offset,dur,d_dur,rgb_dur", file=csv_output)
     earliest_next_timestamp = 0
+    summary = dict(filename=filenames[0], frames=0, zero_depth_durations=0, zero_color_durations=0, max_depth_duration=0, max_color_duration=0)
     while True:
         ok = master_cam.nextframe(earliest_next_timestamp)
         if not ok:
@@ -198,6 +301,12 @@ def printstamps(filenames : List[str], args : argparse.Namespace) -> None:
         frame_duration, depth_duration, color_duration = master_cam.get_durations()
         mslate, msskipped = master_cam.get_resync_params()
         print(f"0,{master_frame_timestamp},{master_depth_timestamp},{master_color_timestamp},0,{mslate},{msskipped},{master_depth_timestamp-master_color_timestamp},{frame_duration},{depth_duration},{color_duration}", file=csv_output)
+        if summary['frames'] > 0:
+            summary['zero_depth_durations'] += depth_duration == 0
+            summary['zero_color_durations'] += color_duration == 0
+            summary['max_depth_duration'] = max(summary['max_depth_duration'], depth_duration)
+            summary['max_color_duration'] = max(summary['max_color_duration'], color_duration)
+        summary['frames'] += 1
         if detail:
             master_cam.print_detail()
         earliest_next_timestamp = master_frame_timestamp
@@ -223,6 +332,11 @@ def printstamps(filenames : List[str], args : argparse.Namespace) -> None:
     recording_duration = (earliest_next_timestamp - recording_start_time) / 1000
     playback_duration = time.time() - playback_start_time
     print(f"Recording duration: {int(recording_duration)} seconds. Playback duration: {int(playback_duration)} seconds", file=sys.stderr)
+    if csv_output is not sys.stdout:
+        csv_output.close()
+    summary['recording_duration'] = recording_duration
+    summary['playback_duration'] = playback_duration
+    return summary
         
 if __name__ == "__main__":
     main()
@@ -0,0 +1,196 @@
+"""Multi-camera synchronisation of extracted frame timestamps.
+
+The frame timestamps of N cameras are merged with a priority queue (one entry per
+camera, so O(n log k) for n frames from k cameras). The earliest pending frame
+starts a frameset, and the next frame of every other camera is added to it if it is
+no more than --window ms later. Cameras without such a frame are missing from that
+frameset. If a camera has a second frame within the window it starts a new frameset.
+
+Per frameset the skew (latest minus earliest timestamp) is computed, and per camera:
+
+    matched     frames that ended up in a complete frameset
+    unmatched   frames that ended up in an incomplete frameset
+    missing     framesets this camera was missing from
+    late        how much later than the first frame of its frameset the frame was
+    skipped     frames that were not the first of this camera within the window
+
+Input is either bag files (timestamps extracted from the bag index, cached in
+BAGFILE.tsindex.npz) or ts-*.csv files written by rsbagtimestamps.py:
+
+    python syncengine.py --window 10 --json sync.json cam1.bag cam2.bag cam3.bag > framesets.csv
+"""
+import sys
+import csv
+import heapq
+import json
+import argparse
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+class Frameset:
+    """Matched frames: per camera the frame timestamp, or None if the camera is missing"""
+
+    def __init__(self, number : int, timestamps : List[Optional[float]]):
+        self.number = number
+        self.timestamps = timestamps
+        present = [ts for ts in timestamps if ts is not None]
+        self.anchor = min(present)
+        self.skew = max(present) - self.anchor
+        self.complete = len(present) == len(timestamps)
+
+def sync_streams(streams : List[Iterable[float]], window : float) -> Iterator[Frameset]:
+    """Merge per-camera timestamp streams (each in increasing order) into framesets"""
+    iterators = [iter(s) for s in streams]
+    ncams = len(iterators)
+    heap : List[Tuple[float, int]] = []
+    for cam, it in enumerate(iterators):
+        ts = next(it, None)
+        if ts is not None:
+            heap.append((ts, cam))
+    heapq.heapify(heap)
+    number = 0
+    while heap:
+        anchor, cam = heapq.heappop(heap)
+        timestamps : List[Optional[float]] = [None] * ncams
+        timestamps[cam] = anchor
+        taken = [cam]
+        # The heap holds one entry per camera, so every frame popped here is from another camera
+        while heap and heap[0][0] <= anchor + window:
+            ts, cam = heapq.heappop(heap)
+            timestamps[cam] = ts
+            taken.append(cam)
+        for cam in taken:
+            ts = next(iterators[cam], None)
+            if ts is not None:
+                heapq.heappush(heap, (ts, cam))
+        yield Frameset(number, timestamps)
+        number += 1
+
+def _percentiles(values : List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return dict(p50=None, p90=None, p99=None, max=None)
+    values = sorted(values)
+    n = len(values)
+    return dict(p50=values[n*50//100], p90=values[min(n-1, n*90//100)], p99=values[min(n-1, n*99//100)], max=values[-1])
+
+class SyncStatistics:
+    """Accumulates statistics over framesets"""
+
+    def __init__(self, ncams : int, window : float):
+        self.ncams = ncams
+        self.window = window
+        self.framesets = 0
+        self.complete = 0
+        self.skews : List[float] = []
+        self.matched = [0] * ncams
+        self.unmatched = [0] * ncams
+        self.missing = [0] * ncams
+        self.skipped = [0] * ncams
+        self.late : List[List[float]] = [[] for _ in range(ncams)]
+        self._previous : List[Optional[float]] = [None] * ncams
+
+    def add(self, frameset : Frameset) -> None:
+        self.framesets += 1
+        if frameset.complete:
+            self.complete += 1
+            self.skews.append(frameset.skew)
+        for cam, ts in enumerate(frameset.timestamps):
+            if ts is None:
+                self.missing[cam] += 1
+                continue
+            if frameset.complete:
+                self.matched[cam] += 1
+            else:
+                self.unmatched[cam] += 1
+            self.late[cam].append(ts - frameset.anchor)
+            previous = self._previous[cam]
+            if previous is not None and ts - previous <= self.window:
+                self.skipped[cam] += 1
+            self._previous[cam] = ts
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(
+            cameras=self.ncams,
+            window=self.window,
+            framesets=self.framesets,
+            complete=self.complete,
+            skew_ms=_percentiles(self.skews),
+            per_camera=[dict(
+                camera=cam,
+                matched=self.matched[cam],
+                unmatched=self.unmatched[cam],
+                missing=self.missing[cam],
+                skipped=self.skipped[cam],
+                late_ms=_percentiles(self.late[cam]),
+            ) for cam in range(self.ncams)],
+        )
+
+def print_statistics(stats : Dict[str, Any], file=sys.stderr) -> None:
+    print(f"{stats['framesets']} framesets, {stats['complete']} complete, window {stats['window']} ms, skew p50={stats['skew_ms']['p50']} p99={stats['skew_ms']['p99']} max={stats['skew_ms']['max']}", file=file)
+    for c in stats['per_camera']:
+        print(f"camera {c['camera']}: matched={c['matched']} unmatched={c['unmatched']} missing={c['missing']} skipped={c['skipped']} late p50={c['late_ms']['p50']} p99={c['late_ms']['p99']} max={c['late_ms']['max']}", file=file)
+
+def write_framesets(framesets : Iterable[Frameset], ncams : int, stats : SyncStatistics, output) -> None:
+    """Write framesets as CSV, while accumulating statistics"""
+    print("frameset,anchor,skew,complete," + ",".join(f"cam{cam}" for cam in range(ncams)), file=output)
+    for fs in framesets:
+        stats.add(fs)
+        cams = ",".join("" if ts is None else f"{ts:.3f}" for ts in fs.timestamps)
+        print(f"{fs.number},{fs.anchor:.3f},{fs.skew:.3f},{int(fs.complete)},{cams}", file=output)
+
+def bag_frame_timestamps(filename : str, nodepth : bool = False, nocolor : bool = False, cachedir : Optional[str] = None, use_cache : bool = True) -> List[float]:
+    """Return frame timestamps (latest of depth and color, like BagPipeline) from a bag file index"""
+    import rosbag_index
+    import tsindex
+    streams = tsindex.stream_frames(filename, cachedir, use_cache)
+    depth = None if nodepth else streams.get("Depth")
+    color = None if nocolor else streams.get("Color")
+    rv = []
+    for frameset in rosbag_index.pair_frames(depth, color):
+        rv.append(max(f.get_timestamp() for f in (frameset.get_depth_frame(), frameset.get_color_frame()) if f is not None))
+    return rv
+
+def csv_frame_timestamps(filename : str) -> List[float]:
+    """Return the frame timestamps of camera 0 from a ts-*.csv file"""
+    with open(filename, newline='') as fp:
+        return [float(row['timestamp']) for row in csv.DictReader(fp) if row['camnum'] == '0']
+
+def load_frame_timestamps(filename : str, **kwargs) -> List[float]:
+    if filename.endswith('.csv'):
+        return csv_frame_timestamps(filename)
+    return bag_frame_timestamps(filename, **kwargs)
+
+def default_window(streams : List[List[float]]) -> float:
+    """Half the median frame interval of the first stream that has one"""
+    for timestamps in streams:
+        if len(timestamps) > 1:
+            intervals = sorted(b-a for a, b in zip(timestamps, timestamps[1:]))
+            return intervals[len(intervals)//2] / 2
+    return 16.0
+
+def run(filenames : List[str], window : Optional[float], output, jsonfile : Optional[str] = None, **kwargs) -> Dict[str, Any]:
+    """Synchronise the frame timestamps of a number of recordings. Returns statistics"""
+    streams = [load_frame_timestamps(fn, **kwargs) for fn in filenames]
+    if window is None:
+        window = default_window(streams)
+    stats = SyncStatistics(len(streams), window)
+    write_framesets(sync_streams(streams, window), len(streams), stats, output)
+    rv = stats.as_dict()
+    rv['files'] = filenames
+    if jsonfile:
+        with open(jsonfile, 'w') as fp:
+            json.dump(rv, fp, indent=1)
+    return rv
+
+def main():
+    parser = argparse.ArgumentParser(description="Synchronise frame timestamps of multiple cameras and report skew, late and skipped frames")
+    parser.add_argument("--window", type=float, default=None, help="Matching window in ms (default: half the frame interval)")
+    parser.add_argument("--nocolor", action="store_true", help="Ignore color frames (bag files only)")
+    parser.add_argument("--nodepth", action="store_true", help="Ignore depth frames (bag files only)")
+    parser.add_argument("--json", help="Write statistics to this JSON file")
+    parser.add_argument("recording", nargs="+", help="Bag files or ts-*.csv files, one per camera")
+    args = parser.parse_args()
+    stats = run(args.recording, args.window, sys.stdout, args.json, nodepth=args.nodepth, nocolor=args.nocolor)
+    print_statistics(stats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""Frame drop and jitter analysis of ts-*.csv files written by rsbagtimestamps.py.
+
+The CSV files are parsed in chunks into NumPy columns, and multiple files are
+analysed in parallel. Per camera (the camnum column, or per file when every file
+holds one camera) this reports:
+
+    drops           frames missing according to d_dur/rgb_dur (a duration of N nominal
+                    frame intervals means N-1 dropped frames), and the lengths of drop runs
+    repeats         runs of zero durations (the same frame delivered again)
+    histograms      counts of d_dur and rgb_dur values, in ms
+    jitter          percentiles of |duration - nominal interval|
+    drift           the depth/color offset (rgb_d_offset) at start and end, and its slope
+    skew            percentiles of the depth timestamp offset to camera 0 (master_d_offset
+                    for --concurrent output, nearest frame in the first file otherwise)
+
+    python tsanalyzer.py --json summary.json ts-*.csv
+"""
+import sys
+import os
+import io
+import json
+import argparse
+import concurrent.futures
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+CHUNK_SIZE = 1<<22
+PERCENTILES = (50, 90, 99, 99.9)
+MAX_HISTOGRAM_MS = 1000
+
+def _parse_chunk(lines : bytes, ncolumns : int) -> np.ndarray:
+    """Parse complete CSV lines into a (rows, ncolumns) float64 array. Raises ValueError for invalid lines"""
+    return np.loadtxt(io.BytesIO(lines), delimiter=",", dtype=np.float64, ndmin=2).reshape(-1, ncolumns)
+
+def load_columns(path : str, chunk_size : int = CHUNK_SIZE) -> Tuple[Dict[str, np.ndarray], List[Tuple[int, str]]]:
+    """Read a ts-*.csv file in chunks. Returns the columns (plus a "line" column with
+    1-based line numbers) and a list of (line number, text) of invalid lines"""
+    chunks = []
+    line_numbers = []
+    invalid : List[Tuple[int, str]] = []
+    with open(path, 'rb') as fp:
+        header = fp.readline().decode('utf8').strip().split(',')
+        ncolumns = len(header)
+        lineno = 1
+        remainder = b""
+        while True:
+            data = fp.read(chunk_size)
+            block = remainder + data
+            if data:
+                cut = block.rfind(b"\n") + 1
+                block, remainder = block[:cut], block[cut:]
+            if block.strip():
+                lines = block.splitlines()
+                try:
+                    rows = _parse_chunk(block, ncolumns)
+                    if rows.shape[0] != len(lines):
+                        raise ValueError("empty or short lines")
+                    chunks.append(rows)
+                    line_numbers.append(np.arange(lineno+1, lineno+1+len(lines)))
+                except ValueError:
+                    # Slow path: parse line by line, skipping invalid ones
+                    good = []
+                    good_numbers = []
+                    for i, line in enumerate(lines):
+                        fields = line.split(b",")
+                        try:
+                            if len(fields) != ncolumns:
+                                raise ValueError(line)
+                            good.append([float(f) for f in fields])
+                            good_numbers.append(lineno+1+i)
+                        except ValueError:
+                            if line.strip():
+                                invalid.append((lineno+1+i, line.decode('utf8', 'replace')))
+                    chunks.append(np.array(good, dtype=np.float64).reshape(-1, ncolumns))
+                    line_numbers.append(np.array(good_numbers, dtype=np.int64))
+                lineno += len(lines)
+            if not data:
+                break
+    table = np.concatenate(chunks) if chunks else np.zeros((0, ncolumns))
+    columns = {name : table[:, i] for i, name in enumerate(header)}
+    columns["line"] = np.concatenate(line_numbers) if line_numbers else np.zeros(0, dtype=np.int64)
+    return columns, invalid
+
+def consecutive_zeros(columns : Dict[str, np.ndarray]) -> np.ndarray:
+    """Return indices i where rows i and i+1 both have a zero d_dur, or both a zero rgb_dur.
+    The first row (which has no previous frame) is not considered"""
+    d_zero = columns["d_dur"][1:] == 0
+    rgb_zero = columns["rgb_dur"][1:] == 0
+    both = (d_zero[:-1] & d_zero[1:]) | (rgb_zero[:-1] & rgb_zero[1:])
+    return np.nonzero(both)[0] + 1
+
+def _runs(mask : np.ndarray) -> np.ndarray:
+    """Return lengths of runs of True in a boolean array"""
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.diff(padded)
+    return np.nonzero(edges == -1)[0] - np.nonzero(edges == 1)[0]
+
+def _percentiles(values : np.ndarray) -> Dict[str, Optional[float]]:
+    if len(values) == 0:
+        return {f"p{p}" : None for p in PERCENTILES}
+    return {f"p{p}" : float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))}
+
+def _histogram(durations : np.ndarray) -> Dict[str, int]:
+    counts = np.bincount(np.clip(durations, 0, MAX_HISTOGRAM_MS).astype(np.int64))
+    return {str(ms) : int(counts[ms]) for ms in np.nonzero(counts)[0]}
+
+def nominal_interval(durations : np.ndarray) -> float:
+    positive = durations[durations > 0]
+    return float(np.median(positive)) if len(positive) else 0.0
+
+def analyze_stream(durations : np.ndarray, interval : float) -> Dict[str, Any]:
+    """Drops, repeats, histogram and jitter of one duration column (first frame excluded)"""
+    if interval <= 0:
+        return dict(interval=interval, frames=len(durations))
+    dropped = np.maximum(np.rint(durations / interval) - 1, 0).astype(np.int64)
+    # Jitter only of frames that were neither repeated nor preceded by a drop
+    normal = durations[(durations > 0) & (dropped == 0)]
+    drop_runs = dropped[dropped > 0]
+    repeat_runs = _runs(durations == 0)
+    return dict(
+        interval=interval,
+        frames=len(durations),
+        dropped_frames=int(dropped.sum()),
+        drop_events=len(drop_runs),
+        longest_drop=int(drop_runs.max()) if len(drop_runs) else 0,
+        drop_run_lengths={str(n) : int(c) for n, c in zip(*np.unique(drop_runs, return_counts=True))},
+        repeated_frames=int(repeat_runs.sum()),
+        repeat_runs=len(repeat_runs),
+        consecutive_repeats=int(np.sum(repeat_runs[repeat_runs > 1] - 1)),
+        histogram_ms=_histogram(durations),
+        jitter_ms=_percentiles(np.abs(normal - interval)),
+    )
+
+def analyze_drift(timestamps : np.ndarray, offsets : np.ndarray) -> Dict[str, Any]:
+    """Depth/color offset at start and end, and its linear drift in ms per minute"""
+    if len(offsets) == 0:
+        return {}
+    n = max(1, min(len(offsets) // 10, 300))
+    rv = dict(start_ms=float(np.median(offsets[:n])), end_ms=float(np.median(offsets[-n:])), max_abs_ms=float(np.abs(offsets).max()))
+    minutes = (timestamps - timestamps[0]) / 60000.0
+    if len(offsets) > 1 and minutes[-1] > 0:
+        rv["slope_ms_per_minute"] = float(np.polyfit(minutes, offsets, 1)[0])
+    return rv
+
+def analyze_camera(columns : Dict[str, np.ndarray], skew : Optional[np.ndarray] = None) -> Dict[str, Any]:
+    rows = len(columns["timestamp"])
+    rv : Dict[str, Any] = dict(frames=rows)
+    if rows == 0:
+        return rv
+    rv["start"] = float(columns["timestamp"][0])
+    rv["duration_s"] = float(columns["timestamp"][-1] - columns["timestamp"][0]) / 1000.0
+    for name in ("d_dur", "rgb_dur"):
+        durations = columns[name][1:]
+        rv[name] = analyze_stream(durations, nominal_interval(durations))
+    rv["drift"] = analyze_drift(columns["timestamp"], columns["rgb_d_offset"])
+    if skew is not None and len(skew):
+        rv["skew_ms"] = _percentiles(np.abs(skew))
+        rv["skew_ms"]["mean"] = float(np.mean(skew))
+    return rv
+
+def analyze_file(path : str) -> Dict[str, Any]:
+    """Analyse all cameras in one CSV file"""
+    return _analyze_file(path)[0]
+
+def _analyze_file(path : str) -> Tuple[Dict[str, Any], np.ndarray]:
+    """Analyse all cameras in one CSV file. Also returns the sorted depth timestamps of camera 0"""
+    columns, invalid = load_columns(path)
+    cameras = {}
+    camnums = np.unique(columns["camnum"]).astype(np.int64) if len(columns["camnum"]) else []
+    for camnum in camnums:
+        selection = columns["camnum"] == camnum
+        cam_columns = {name : values[selection] for name, values in columns.items()}
+        skew = cam_columns["master_d_offset"] if camnum != 0 else None
+        cameras[str(camnum)] = analyze_camera(cam_columns, skew)
+    d_timestamps = np.sort(columns["d_timestamp"][columns["camnum"] == 0])
+    return dict(file=path, rows=len(columns["line"]), invalid_lines=len(invalid), cameras=cameras), d_timestamps
+
+def file_skew(reference : np.ndarray, timestamps : np.ndarray) -> np.ndarray:
+    """Offset of every timestamp to the nearest reference timestamp (both sorted)"""
+    if len(reference) == 0 or len(timestamps) == 0:
+        return np.zeros(0)
+    i = np.clip(np.searchsorted(reference, timestamps), 1, len(reference)-1) if len(reference) > 1 else np.zeros(len(timestamps), dtype=np.int64)
+    before = reference[np.maximum(i-1, 0)]
+    after = reference[i]
+    nearest = np.where(np.abs(timestamps - before) <= np.abs(timestamps - after), before, after)
+    # Only where the recordings overlap
+    overlap = (timestamps >= reference[0]) & (timestamps <= reference[-1])
+    return (timestamps - nearest)[overlap]
+
+def analyze(paths : List[str], jobs : int = 0) -> Dict[str, Any]:
+    """Analyse a number of CSV files in parallel. With per-camera files the skew to the first file is added"""
+    jobs = jobs if jobs > 0 else min(len(paths), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max(1, jobs)) as pool:
+        results = list(pool.map(_analyze_file, paths))
+    files = [f for f, _ in results]
+    if len(paths) > 1 and all(list(f["cameras"]) == ["0"] for f in files):
+        timestamps = [ts for _, ts in results]
+        for f, ts in zip(files[1:], timestamps[1:]):
+            skew = file_skew(timestamps[0], ts)
+            if len(skew):
+                f["cameras"]["0"]["skew_ms"] = _percentiles(np.abs(skew))
+                f["cameras"]["0"]["skew_ms"]["mean"] = float(np.mean(skew))
+                f["skew_reference"] = paths[0]
+    return dict(files=files)
+
+def _fmt(value : Optional[float], precision : int = 1) -> str:
+    return f"{value:7.{precision}f}" if value is not None else f"{'-':>7s}"
+
+def print_summary(summary : Dict[str, Any], file=sys.stdout) -> None:
+    print(f"{'file':30s} {'cam':>3s} {'frames':>7s} {'d_drop':>6s} {'c_drop':>6s} {'d_rep2':>6s} {'c_rep2':>6s} {'d_jit99':>7s} {'c_jit99':>7s} {'drift/m':>7s} {'skew99':>7s}", file=file)
+    for f in summary["files"]:
+        for cam, c in f["cameras"].items():
+            d = c.get("d_dur", {})
+            rgb = c.get("rgb_dur", {})
+            jitter_d = d.get("jitter_ms", {}).get("p99")
+            jitter_rgb = rgb.get("jitter_ms", {}).get("p99")
+            drift = c.get("drift", {}).get("slope_ms_per_minute")
+            skew = c.get("skew_ms", {}).get("p99")
+            print(f"{os.path.basename(f['file'])[:30]:30s} {cam:>3s} {c['frames']:7d} {d.get('dropped_frames', 0):6d} {rgb.get('dropped_frames', 0):6d} {d.get('consecutive_repeats', 0):6d} {rgb.get('consecutive_repeats', 0):6d} {_fmt(jitter_d)} {_fmt(jitter_rgb)} {_fmt(drift, 3)} {_fmt(skew)}", file=file)
+        if f["invalid_lines"]:
+            print(f"{f['file']}: {f['invalid_lines']} invalid lines skipped", file=file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse frame drops, repeats, jitter, depth/color drift and camera skew in ts-*.csv files")
+    parser.add_argument("--jobs", type=int, default=0, help="Number of files to analyse in parallel (default: one per file, at most one per core)")
+    parser.add_argument("--json", help="Write the full summary (including histograms) to this JSON file")
+    parser.add_argument("csvfile", nargs="+", help="ts-*.csv files from rsbagtimestamps.py")
+    args = parser.parse_args()
+    summary = analyze(args.csvfile, args.jobs)
+    print_summary(summary)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(summary, fp, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Persistent per-bag cache of frame numbers, timestamps and metadata.
+
+Extracting the timestamps from a bag file (see rosbag_index.py) has to be done only
+once. The result is stored next to the bag file as BAGFILE.tsindex.npz, one set of
+columns per stream:
+
+    Depth/frame_numbers     int64
+    Depth/timestamps        float64, ms
+    Depth/fps               int64, scalar
+    Depth/meta/<key>        float64 (NaN where missing) or unicode strings, per metadata key
+
+plus a key (bag size, mtime and a hash of the first and last megabyte) to detect
+that the bag file has changed. Analyses of the same bag with other flags (--multisync,
+--nocolor, --concurrent, ...) then only load these columns.
+
+    python tsindex.py *.bag          # build (or check) the caches
+"""
+import sys
+import os
+import hashlib
+import argparse
+from typing import Dict, Optional
+import numpy as np
+import rosbag_index
+
+VERSION = 1
+HASH_BYTES = 1<<20
+SUFFIX = ".tsindex.npz"
+
+def bag_key(filename : str) -> str:
+    """Return a key identifying the bag file contents: size, mtime and hash of its first and last megabyte"""
+    st = os.stat(filename)
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        h.update(fp.read(HASH_BYTES))
+        if st.st_size > HASH_BYTES:
+            fp.seek(max(HASH_BYTES, st.st_size - HASH_BYTES))
+            h.update(fp.read(HASH_BYTES))
+    return f"{VERSION}:{st.st_size}:{st.st_mtime_ns}:{h.hexdigest()}"
+
+def cache_filename(filename : str, cachedir : Optional[str] = None) -> str:
+    if cachedir:
+        return os.path.join(cachedir, os.path.basename(filename) + SUFFIX)
+    return filename + SUFFIX
+
+def _metadata_column(values : list):
+    """Return a numeric column if all values are numbers, otherwise a string column"""
+    try:
+        return np.array([float(v) if v is not None else np.nan for v in values], dtype=np.float64)
+    except ValueError:
+        return np.array(["" if v is None else v for v in values], dtype=np.str_)
+
+def save(streams : Dict[str, rosbag_index.StreamFrames], path : str, key : str) -> None:
+    columns = dict(key=np.array(key))
+    for name, frames in streams.items():
+        columns[f"{name}/frame_numbers"] = np.array(frames.frame_numbers, dtype=np.int64)
+        columns[f"{name}/timestamps"] = np.array(frames.timestamps, dtype=np.float64)
+        columns[f"{name}/fps"] = np.array(frames.fps, dtype=np.int64)
+        keys = sorted(set(k for metadata in frames.metadata for k in metadata))
+        for k in keys:
+            columns[f"{name}/meta/{k}"] = _metadata_column([metadata.get(k) for metadata in frames.metadata])
+    tmpname = path + ".tmp.npz"
+    np.savez(tmpname, **columns)
+    os.replace(tmpname, path)
+
+def load(path : str, key : Optional[str] = None) -> Optional[Dict[str, rosbag_index.StreamFrames]]:
+    """Load a cache file. Returns None if it does not exist or does not match key"""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if key is not None and str(data["key"]) != key:
+            return None
+        rv : Dict[str, rosbag_index.StreamFrames] = {}
+        for column in data.files:
+            if column == "key":
+                continue
+            name, _, field = column.partition("/")
+            frames = rv.setdefault(name, rosbag_index.StreamFrames(name))
+            values = data[column]
+            if field == "frame_numbers":
+                frames.frame_numbers = values.tolist()
+            elif field == "timestamps":
+                frames.timestamps = values.tolist()
+            elif field == "fps":
+                frames.fps = int(values)
+        for name, frames in rv.items():
+            frames.metadata = [{} for _ in range(len(frames.timestamps))]
+            prefix = f"{name}/meta/"
+            for column in data.files:
+                if not column.startswith(prefix):
+                    continue
+                k = column[len(prefix):]
+                values = data[column]
+                if values.dtype.kind == 'f':
+                    # Metadata values are integers in librealsense
+                    for metadata, v in zip(frames.metadata, values.tolist()):
+                        if v == v:
+                            metadata[k] = str(int(v))
+                else:
+                    for metadata, v in zip(frames.metadata, values.tolist()):
+                        if v:
+                            metadata[k] = v
+    return rv
+
+def stream_frames(filename : str, cachedir : Optional[str] = None, use_cache : bool = True) -> Dict[str, rosbag_index.StreamFrames]:
+    """Return rosbag_index.read_stream_frames(filename), from the cache if it is current"""
+    if not use_cache:
+        return rosbag_index.read_stream_frames(filename)
+    path = cache_filename(filename, cachedir)
+    key = bag_key(filename)
+    rv = load(path, key)
+    if rv is not None:
+        return rv
+    rv = rosbag_index.read_stream_frames(filename)
+    try:
+        save(rv, path, key)
+    except OSError as e:
+        print(f"{filename}: cannot write timestamp cache: {e}", file=sys.stderr)
+    return rv
+
+def main():
+    parser = argparse.ArgumentParser(description="Build timestamp caches for bag files")
+    parser.add_argument("--cache-dir", help="Directory for the cache files (default: next to the bag files)")
+    parser.add_argument("bagfile", nargs="+")
+    args = parser.parse_args()
+    for filename in args.bagfile:
+        path = cache_filename(filename, args.cache_dir)
+        if load(path, bag_key(filename)) is not None:
+            print(f"{path}: up to date")
+            continue
+        streams = stream_frames(filename, args.cache_dir)
+        print(f"{path}: {', '.join(f'{name} {len(frames)} frames' for name, frames in sorted(streams.items()))}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Compute the bounds of a whole PLY sequence, and the transform the converters should use.
+
+Every frame is read in a worker process and reduced to its bounding box, coordinate
+sum, point count and a random subsample of its points. PLY files are read in chunks
+of CHUNK_POINTS points (see plyreader.iter_ply), so a worker never holds a whole
+frame; cwipcdump files are read whole. From these the global bounding box, centroid and
+robust (percentile) extents are computed, and from those the SCALE_FACTOR and
+TRANSLATE_X/Y/Z used by convert_loot.py and convert_ply2dump.py:
+
+    scaled = source / SCALE_FACTOR + TRANSLATE
+
+The robust height of the sequence becomes --height meters, the robust x/z extent is
+centered on 0 and the robust lowest y becomes 0 (the floor).
+
+    python analyze_bounds.py --json loot.transform.json ../loot/loot/Ply
+    python convert_loot.py --transform loot.transform.json ../loot/loot/Ply lootPly lootCwicpc
+"""
+import sys
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from typing import Any, Dict, Iterator, List, Tuple
+import numpy as np
+
+CHUNK_POINTS = 1<<20
+SAMPLES_PER_FRAME = 20000
+PERCENTILE = 0.1    # Robust extents are the PERCENTILE and 100-PERCENTILE percentiles
+DEFAULT_HEIGHT = 1.8
+
+def read_xyz_chunks(filename : str) -> Tuple[int, Iterator[np.ndarray]]:
+    """Return the number of points of a PLY (or cwipcdump) file and an iterator over (N, 3) float32 coordinate chunks"""
+    import cwipc_numpy
+    if filename.endswith('.ply'):
+        import plyreader
+        count = plyreader.vertex_count(filename)
+        return count, (cwipc_numpy.xyz_view(chunk) for chunk in plyreader.iter_ply(filename, CHUNK_POINTS))
+    import cwipc
+    pc = cwipc.cwipc_read_debugdump(filename)
+    points = cwipc_numpy.cwipc_to_numpy(pc)
+    pc.free()
+    xyz = cwipc_numpy.xyz_view(points)
+    return len(xyz), (xyz[start:start+CHUNK_POINTS] for start in range(0, len(xyz), CHUNK_POINTS))
+
+def frame_bounds(task : Tuple[int, str, int]) -> Dict[str, Any]:
+    """Reduce one frame to min, max, sum, count and a subsample of its points"""
+    index, filename, nsamples = task
+    n, chunks = read_xyz_chunks(filename)
+    rng = np.random.default_rng(index)
+    picks = np.sort(rng.choice(n, nsamples, replace=False)) if n > nsamples else None
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    total = np.zeros(3)
+    samples = []
+    start = 0
+    for chunk in chunks:
+        lo = np.minimum(lo, chunk.min(axis=0))
+        hi = np.maximum(hi, chunk.max(axis=0))
+        total += chunk.sum(axis=0, dtype=np.float64)
+        if picks is None:
+            samples.append(np.array(chunk, dtype=np.float32))
+        else:
+            first, last = np.searchsorted(picks, [start, start + len(chunk)])
+            samples.append(np.array(chunk[picks[first:last] - start], dtype=np.float32))
+        start += len(chunk)
+    sample = np.concatenate(samples) if samples else np.zeros((0, 3), dtype=np.float32)
+    return dict(index=index, count=n, min=lo, max=hi, sum=total, sample=sample)
+
+def derive_transform(robust_min : np.ndarray, robust_max : np.ndarray, height : float) -> Dict[str, float]:
+    """Return SCALE_FACTOR and TRANSLATE_X/Y/Z for the convention scaled = source / SCALE_FACTOR + TRANSLATE"""
+    scale_factor = float(robust_max[1] - robust_min[1]) / height
+    center = (robust_min + robust_max) / 2
+    return dict(
+        SCALE_FACTOR=scale_factor,
+        TRANSLATE_X=float(-center[0] / scale_factor),
+        TRANSLATE_Y=float(-robust_min[1] / scale_factor),
+        TRANSLATE_Z=float(-center[2] / scale_factor),
+    )
+
+def analyze(filenames : List[str], jobs : int, height : float = DEFAULT_HEIGHT, samples_per_frame : int = SAMPLES_PER_FRAME, percentile : float = PERCENTILE) -> Dict[str, Any]:
+    """Analyse all frames in parallel. Returns bounds, centroid, percentile extents and transform"""
+    lo = np.full(3, np.inf)
+    hi = np.full(3, -np.inf)
+    total = np.zeros(3)
+    count = 0
+    samples = []
+    tasks = [(i, fn, samples_per_frame) for i, fn in enumerate(filenames)]
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap_unordered(frame_bounds, tasks):
+            lo = np.minimum(lo, result['min'])
+            hi = np.maximum(hi, result['max'])
+            total += result['sum']
+            count += result['count']
+            samples.append(result['sample'])
+    sample = np.concatenate(samples)
+    robust_min = np.percentile(sample, percentile, axis=0)
+    robust_max = np.percentile(sample, 100-percentile, axis=0)
+    return dict(
+        frames=len(filenames),
+        points=count,
+        min=lo.tolist(),
+        max=hi.tolist(),
+        centroid=(total / max(1, count)).tolist(),
+        percentile=percentile,
+        robust_min=robust_min.tolist(),
+        robust_max=robust_max.tolist(),
+        height=height,
+        transform=derive_transform(robust_min, robust_max, height),
+    )
+
+def load_transform(filename : str) -> Dict[str, float]:
+    """Return the transform (SCALE_FACTOR, TRANSLATE_X/Y/Z) from a JSON file written by this script"""
+    with open(filename) as fp:
+        data = json.load(fp)
+    return data.get('transform', data)
+
+TRANSFORM_KEYS = ('SCALE_FACTOR', 'TRANSLATE_X', 'TRANSLATE_Y', 'TRANSLATE_Z')
+
+def apply_transform(module : Any, transform : Dict[str, float]) -> None:
+    """Set the SCALE_FACTOR and TRANSLATE_X/Y/Z constants of a converter module from a transform dict.
+
+    A CWIPC_POINTSIZE of the module (VOXEL_SIZE/SCALE_FACTOR) is recomputed too.
+    """
+    for key in TRANSFORM_KEYS:
+        setattr(module, key, transform[key])
+    if hasattr(module, 'CWIPC_POINTSIZE'):
+        module.CWIPC_POINTSIZE = module.VOXEL_SIZE / module.SCALE_FACTOR
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute bounds of a PLY sequence and the SCALE_FACTOR/TRANSLATE to use when converting it")
+    parser.add_argument("--height", type=float, default=DEFAULT_HEIGHT, help=f"Height in meters of the converted sequence (default: {DEFAULT_HEIGHT})")
+    parser.add_argument("--percentile", type=float, default=PERCENTILE, help=f"Robust extents ignore this percentage of points on either side (default: {PERCENTILE})")
+    parser.add_argument("--samples", type=int, default=SAMPLES_PER_FRAME, help=f"Points sampled per frame for the percentiles (default: {SAMPLES_PER_FRAME})")
+    parser.add_argument("--jobs", type=int, default=0, help="Number of frames to read in parallel (default: 0, number of cores)")
+    parser.add_argument("--json", help="Write the result to this JSON file (can be passed to --transform of the converters)")
+    parser.add_argument("source", help="Directory with source PLY files")
+    args = parser.parse_args()
+    filenames = [os.path.join(args.source, fn) for fn in sorted(os.listdir(args.source)) if os.path.splitext(fn)[1] in ('.ply', '.cwipcdump')]
+    if not filenames:
+        print(f"{sys.argv[0]}: no PLY files in {args.source}", file=sys.stderr)
+        sys.exit(1)
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    startTime = time.time()
+    result = analyze(filenames, jobs, args.height, args.samples, args.percentile)
+    result['source'] = args.source
+    print(f"{args.source}: {result['frames']} frames, {result['points']} points in {time.time()-startTime:.1f} seconds")
+    for axis, name in enumerate("xyz"):
+        print(f"{name}: {result['min'][axis]:.3f}..{result['max'][axis]:.3f}, robust {result['robust_min'][axis]:.3f}..{result['robust_max'][axis]:.3f}, centroid {result['centroid'][axis]:.3f}")
+    for key, value in result['transform'].items():
+        print(f"{key} = {value:.6g}")
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(result, fp, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Measure cwipc.codec encoder rate and speed over a grid of parameters.
+
+For every combination of octree_bits, jpeg_quality and tile count, all frames of
+a sample sequence are encoded with an encoder group (one encoder per tile) and
+decoded again. Per combination the mean encode and decode time per frame, the
+compressed size per frame and the decoded point count are recorded.
+
+Example:
+
+    python bench_encoder.py --octree-bits 6,7,8,9,10 --jpeg-quality 60,85 --tiles 0,4 \\
+        --frames 30 --csv loot-sweep.csv ../Samples/loot-150K-4tiles
+
+A tile count of 0 means a single encoder for the whole cloud. For N > 0 there is
+one encoder per tile, using the first N cameraMasks from the sequence's
+tileconfig.json (or 1, 2, 4, ... if there is none).
+"""
+import sys
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+from typing import Any, Dict, List
+
+def parse_intlist(value : str) -> List[int]:
+    return [int(v) for v in value.split(',')]
+
+def load_frames(dirname : str, maxframes : int) -> List[Any]:
+    """Read up to maxframes cwipcdump or ply frames from a directory into memory"""
+    import cwipc
+    rv = []
+    timestamp = 0
+    for filename in sorted(os.listdir(dirname)):
+        pathname = os.path.join(dirname, filename)
+        ext = os.path.splitext(filename)[1]
+        if ext == '.cwipcdump':
+            rv.append(cwipc.cwipc_read_debugdump(pathname))
+        elif ext == '.ply':
+            rv.append(cwipc.cwipc_read(pathname, timestamp))
+        else:
+            continue
+        timestamp += 33
+        if maxframes and len(rv) >= maxframes:
+            break
+    return rv
+
+def tile_masks(dirname : str, ntiles : int) -> List[int]:
+    """Return the tilenumbers for the encoders of an ntiles configuration"""
+    if ntiles == 0:
+        return [0]
+    tileconfig = os.path.join(dirname, 'tileconfig.json')
+    if os.path.exists(tileconfig):
+        import tiling
+        _, masks, _ = tiling.tile_normals(tiling.load_tileconfig(tileconfig))
+        masks = [int(m) for m in masks]
+    else:
+        masks = [1<<i for i in range(ntiles)]
+    if len(masks) < ntiles:
+        raise ValueError(f"{dirname}: only {len(masks)} tiles available, {ntiles} requested")
+    return masks[:ntiles]
+
+def run_config(frames : List[Any], octree_bits : int, jpeg_quality : int, tilenumbers : List[int], decode : bool) -> Dict[str, Any]:
+    """Encode (and decode) all frames with one parameter combination. Returns mean measurements per frame"""
+    import cwipc.codec
+    enc_group = cwipc.codec.cwipc_new_encodergroup()
+    encoders = []
+    for tilenumber in tilenumbers:
+        params = cwipc.codec.cwipc_encoder_params(False, 1, 1.0, octree_bits, jpeg_quality, 16, tilenumber, 0)
+        encoders.append(enc_group.addencoder(params=params))
+    decoder = cwipc.codec.cwipc_new_decoder() if decode else None
+    encode_seconds = 0.0
+    decode_seconds = 0.0
+    nbytes = 0
+    npoints_in = 0
+    npoints_out = 0
+    for pc in frames:
+        t0 = time.perf_counter()
+        enc_group.feed(pc)
+        encoded = []
+        for encoder in encoders:
+            ok = encoder.available(True)
+            assert ok
+            encoded.append(encoder.get_bytes())
+        encode_seconds += time.perf_counter() - t0
+        nbytes += sum(len(data) for data in encoded)
+        npoints_in += pc.count()
+        if decoder:
+            for data in encoded:
+                t0 = time.perf_counter()
+                decoder.feed(data)
+                ok = decoder.available(True)
+                assert ok
+                decoded = decoder.get()
+                decode_seconds += time.perf_counter() - t0
+                npoints_out += decoded.count()
+                decoded.free()
+    enc_group.free()
+    if decoder:
+        decoder.free()
+    nframes = len(frames)
+    return dict(
+        octree_bits=octree_bits,
+        jpeg_quality=jpeg_quality,
+        tiles=len(tilenumbers) if tilenumbers != [0] else 0,
+        frames=nframes,
+        encode_ms=1000*encode_seconds/nframes,
+        decode_ms=1000*decode_seconds/nframes if decoder else None,
+        bytes=nbytes/nframes,
+        points_in=npoints_in/nframes,
+        points_out=npoints_out/nframes if decoder else None,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cwipc encoder over a grid of octree_bits, jpeg_quality and tile counts")
+    parser.add_argument("--octree-bits", type=parse_intlist, default=[6, 7, 8, 9, 10], help="Comma-separated octree depths (default: 6,7,8,9,10)")
+    parser.add_argument("--jpeg-quality", type=parse_intlist, default=[60, 85], help="Comma-separated JPEG qualities (default: 60,85)")
+    parser.add_argument("--tiles", type=parse_intlist, default=[0], help="Comma-separated tile counts, 0 is untiled (default: 0)")
+    parser.add_argument("--frames", type=int, default=30, help="Number of frames to use, 0 for all (default: 30)")
+    parser.add_argument("--nodecode", action="store_true", help="Only measure encoding")
+    parser.add_argument("--csv", help="Write results as CSV to this file")
+    parser.add_argument("--json", help="Write results as JSON to this file")
+    parser.add_argument("sequence", help="Directory with cwipcdump or ply frames (for example ../Samples/loot-150K-4tiles)")
+    args = parser.parse_args()
+
+    frames = load_frames(args.sequence, args.frames)
+    if not frames:
+        print(f"{sys.argv[0]}: no cwipcdump or ply files in {args.sequence}", file=sys.stderr)
+        sys.exit(1)
+    print(f"{args.sequence}: {len(frames)} frames loaded", file=sys.stderr)
+    results = []
+    print(f"{'octree':>6s} {'jpeg':>4s} {'tiles':>5s} {'enc ms':>8s} {'dec ms':>8s} {'bytes':>10s} {'points':>9s}")
+    for octree_bits, jpeg_quality, ntiles in itertools.product(args.octree_bits, args.jpeg_quality, args.tiles):
+        result = run_config(frames, octree_bits, jpeg_quality, tile_masks(args.sequence, ntiles), not args.nodecode)
+        results.append(result)
+        dec_ms = f"{result['decode_ms']:8.1f}" if result['decode_ms'] is not None else f"{'-':>8s}"
+        points = f"{result['points_out']:9.0f}" if result['points_out'] is not None else f"{'-':>9s}"
+        print(f"{octree_bits:6d} {jpeg_quality:4d} {ntiles:5d} {result['encode_ms']:8.1f} {dec_ms} {result['bytes']:10.0f} {points}", flush=True)
+    for pc in frames:
+        pc.free()
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(dict(sequence=args.sequence, results=results), fp, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import time
+import numpy as np
+import cwipc_numpy
+
+def legacy_o3d_to_points(points, colors, maxtiles):
+    """The per-point loop formerly in o3d_to_cwipc, up to (not including) cwipc_from_points"""
+    rv = []
+    pointsandcolors = zip(list(points), list(colors))
+    for (x, y, z), (r, g, b) in pointsandcolors:
+        side = 0
+        if maxtiles == 2:
+            side = 1 if x < 0 else 2
+        elif maxtiles == 4:
+            if x < 0 and z < 0:
+                side = 1
+            elif x < 0 and z >= 0:
+                side = 2
+            elif x >= 0 and z < 0:
+                side = 3
+            else:
+                side = 4
+        r = int(r*255)
+        g = int(g*255)
+        b = int(b*255)
+        rv.append((x, y, z, r, g, b, side))
+    return rv
+
+def legacy_points_to_o3d(pcpoints):
+    """The per-point loop formerly in cwipc_to_o3d, up to (not including) Vector3dVector"""
+    points = []
+    colors = []
+    for p in pcpoints:
+        points.append((p['x'], p['y'], p['z']))
+        colors.append((float(p['r'])/255.0, float(p['g'])/255.0, float(p['b'])/255.0))
+    return points, colors
+
+class FakeO3D:
+    """Stand-in with the open3d attributes o3d_to_numpy uses, for when open3d is not installed"""
+    def __init__(self, points, colors):
+        self.points = points
+        self.colors = colors
+
+def timeit(label, npoints, func, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t1 = time.perf_counter()
+        if best is None or t1-t0 < best:
+            best = t1-t0
+    print(f"{label:40s} {best*1000:10.1f} ms {npoints/best:14.0f} points/s")
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-point loops against the cwipc_numpy bridge")
+    parser.add_argument("--npoints", type=int, default=1000000, help="Number of points (default: 1000000)")
+    parser.add_argument("--legacy-npoints", type=int, default=0, help="Number of points for the (slow) legacy loops (default: same as --npoints)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, best is reported (default: 3)")
+    parser.add_argument("--maxtiles", type=int, default=4, help="Legacy tiling to apply (default: 4)")
+    args = parser.parse_args()
+    npoints = args.npoints
+    legacy_npoints = args.legacy_npoints or npoints
+
+    rng = np.random.default_rng(0)
+    xyz = rng.uniform(-1, 1, size=(npoints, 3))
+    rgb = rng.uniform(0, 1, size=(npoints, 3))
+    o3dpc = FakeO3D(xyz, rgb)
+    try:
+        import open3d
+        o3dpc = open3d.geometry.PointCloud()
+        o3dpc.points = open3d.utility.Vector3dVector(xyz)
+        o3dpc.colors = open3d.utility.Vector3dVector(rgb)
+        have_open3d = True
+    except ImportError:
+        have_open3d = False
+    try:
+        import cwipc
+        have_cwipc = True
+    except ImportError:
+        have_cwipc = False
+    print(f"npoints={npoints}, legacy npoints={legacy_npoints}, open3d={have_open3d}, cwipc={have_cwipc}")
+
+    legacy = timeit("legacy o3d -> point tuples", legacy_npoints, lambda: legacy_o3d_to_points(xyz[:legacy_npoints], rgb[:legacy_npoints], args.maxtiles), 1)
+    def new_o3d_to_numpy():
+        points = cwipc_numpy.o3d_to_numpy(o3dpc)
+        points['tile'] = cwipc_numpy.quadrant_tiles(points, args.maxtiles)
+        return points
+    new = timeit("numpy o3d -> point array", npoints, new_o3d_to_numpy, args.repeat)
+    print(f"{'speedup':40s} {(legacy/legacy_npoints)/(new/npoints):10.1f} x")
+
+    points = new_o3d_to_numpy()
+    legacy = timeit("legacy point records -> o3d lists", legacy_npoints, lambda: legacy_points_to_o3d(points[:legacy_npoints]), 1)
+    if have_open3d:
+        new = timeit("numpy point array -> o3d", npoints, lambda: cwipc_numpy.numpy_to_o3d(points), args.repeat)
+    else:
+        def new_numpy_to_arrays():
+            xyz = np.empty((len(points), 3), dtype=np.float64)
+            xyz[:] = cwipc_numpy.xyz_view(points)
+            rgb = np.empty((len(points), 3), dtype=np.float64)
+            np.divide(cwipc_numpy.rgb_view(points), 255.0, out=rgb)
+        new = timeit("numpy point array -> float64 arrays", npoints, new_numpy_to_arrays, args.repeat)
+    print(f"{'speedup':40s} {(legacy/legacy_npoints)/(new/npoints):10.1f} x")
+
+    if have_cwipc:
+        tuples = legacy_o3d_to_points(xyz[:legacy_npoints], rgb[:legacy_npoints], args.maxtiles)
+        timeit("legacy cwipc_from_points(tuples)", legacy_npoints, lambda: cwipc.cwipc_from_points(tuples, 0).free(), 1)
+        timeit("numpy_to_cwipc", npoints, lambda: cwipc_numpy.numpy_to_cwipc(points, 0).free(), args.repeat)
+        pc = cwipc_numpy.numpy_to_cwipc(points, 0)
+        timeit("legacy pc.get_points() loop", legacy_npoints, lambda: [(p.x, p.y, p.z, p.r, p.g, p.b) for p in pc.get_points()[:legacy_npoints]], 1)
+        pcs = [cwipc_numpy.numpy_to_cwipc(points, 0) for _ in range(args.repeat)]
+        converted = []
+        def pop_to_numpy():
+            converted.append(pcs.pop())
+            cwipc_numpy.cwipc_to_numpy(converted[-1])
+        timeit("cwipc_to_numpy", npoints, pop_to_numpy, args.repeat)
+        # Freed after timing, so free() is not part of the measurement
+        for converted_pc in converted:
+            converted_pc.free()
+        pc.free()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Manifest of generated files, for incremental and resumable dataset builds.
+
+For every output file the manifest records which source file it was made from
+(with the source's content hash) and the parameters used to make it. A later run
+only needs to regenerate outputs for which the source hash or the parameters
+changed, or that are missing. Because entries are recorded as soon as an output has
+been written, and the manifest is saved every SAVE_INTERVAL seconds (and at the end),
+an interrupted run resumes where it stopped, redoing at most the outputs of the last
+few seconds.
+
+Source hashes are cached by size and modification time, so an unchanged tree
+of sources is not re-hashed on every run.
+"""
+import os
+import json
+import time
+import hashlib
+from typing import Any, Dict, Optional
+
+MANIFEST_VERSION = 1
+SAVE_INTERVAL = 10  # Seconds between saves by Manifest.checkpoint()
+
+def _normalize(params : Any) -> Any:
+    """Return params as they will be after a JSON round trip (tuples become lists, etc)"""
+    return json.loads(json.dumps(params, sort_keys=True))
+
+def hash_file(pathname : str, blocksize : int = 1<<20) -> str:
+    """Return sha256 hex digest of a file's content"""
+    h = hashlib.sha256()
+    with open(pathname, 'rb') as fp:
+        while True:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+class Manifest:
+    """Record of output files, their sources and their parameters"""
+
+    def __init__(self, filename : str):
+        self.filename = filename
+        self.basedir = os.path.dirname(os.path.abspath(filename))
+        self.sources : Dict[str, Dict[str, Any]] = {}
+        self.outputs : Dict[str, Dict[str, Any]] = {}
+        self.dirty = False
+        self.last_save = time.monotonic()
+        if os.path.exists(filename):
+            with open(filename) as fp:
+                data = json.load(fp)
+            if data.get("version") == MANIFEST_VERSION:
+                self.sources = data.get("sources", {})
+                self.outputs = data.get("outputs", {})
+
+    def _key(self, pathname : str) -> str:
+        return os.path.relpath(os.path.abspath(pathname), self.basedir).replace(os.sep, '/')
+
+    def source_hash(self, pathname : str) -> str:
+        """Return content hash of a source file, using the cached value if size and mtime are unchanged"""
+        st = os.stat(pathname)
+        key = self._key(pathname)
+        entry = self.sources.get(key)
+        if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+            return entry["sha256"]
+        digest = hash_file(pathname)
+        self.sources[key] = dict(size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=digest)
+        self.dirty = True
+        return digest
+
+    def is_current(self, dest_pathname : str, source_hash : str, params : Any) -> bool:
+        """Return True if dest_pathname exists and was made from this source with these parameters"""
+        entry = self.outputs.get(self._key(dest_pathname))
+        if not entry:
+            return False
+        if entry["source_sha256"] != source_hash or entry["params"] != _normalize(params):
+            return False
+        try:
+            return os.path.getsize(dest_pathname) == entry["size"]
+        except OSError:
+            return False
+
+    def record(self, dest_pathname : str, source_pathname : str, source_hash : str, params : Any) -> None:
+        """Record that dest_pathname has been written from source_pathname with params"""
+        self.outputs[self._key(dest_pathname)] = dict(
+            source=self._key(source_pathname),
+            source_sha256=source_hash,
+            params=_normalize(params),
+            size=os.path.getsize(dest_pathname),
+        )
+        self.dirty = True
+
+    def save(self) -> None:
+        """Write the manifest (atomically, so an interrupted save leaves the previous one intact)"""
+        if not self.dirty:
+            return
+        data = dict(version=MANIFEST_VERSION, sources=self.sources, outputs=self.outputs)
+        tmpfilename = self.filename + '.tmp'
+        with open(tmpfilename, 'w') as fp:
+            json.dump(data, fp, indent=1, sort_keys=True)
+        os.replace(tmpfilename, self.filename)
+        self.dirty = False
+        self.last_save = time.monotonic()
+
+    def checkpoint(self, interval : float = SAVE_INTERVAL) -> None:
+        """Save the manifest if the last save was at least interval seconds ago"""
+        if time.monotonic() - self.last_save >= interval:
+            self.save()
+
+def default_manifest_filename(*dirnames : Optional[str]) -> str:
+    """Return default manifest pathname: next to the first of the given output directories"""
+    for dirname in dirnames:
+        if dirname:
+            return os.path.normpath(dirname) + '.manifest.json'
+    return 'manifest.json'
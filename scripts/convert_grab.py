@@ -5,46 +5,60 @@ import numpy as np
 import cwipc
 import cwipc.codec
 import cwipc.util
-import re
 import time
+import cwipc_numpy
+import sequence_source
+import stage_pipeline
+import build_manifest
+import tiling
 
 VOXEL_SIZE = 0 # 3.5    # Larger numbers mean smaller output size
 
-TILES=(0, 1, 2, 4, 8)
+TILES=(0, 1, 2, 4, 8)    # Default tile masks, if there is no tileconfig.json in the source directory
 ALSO_LOW=True   # Set to True to also do low quality cwicpc
     
-class PlyReader:
-    def __init__(self):
-        self.epoch = None
-        
-    def grab(self, filename):
-        match = re.match(r'.*pointcloud-([0-9]+).ply', filename)
-        timestamp = int(match.group(1))
-        if self.epoch == None:
-            self.epoch = timestamp
-        pc = cwipc.cwipc_read(filename, timestamp-self.epoch)
-        return pc
-        
+PREFETCH=4     # Number of grabbed frames read ahead of the encoder
+
+ENCODER_PARAMS = (False, 1, 1.0, 9, 85, 16, 0, 0)       # Positional arguments to cwipc_encoder_params
+ENCODER_PARAMS_LOW = (False, 1, 1.0, 7, 60, 16, 0, 0)
+
+def grab_source(grab_source_dir, select=None):
+    """Return a SequenceSource for the pointcloud-TIMESTAMP.ply files of cwipc_grab, read ahead, with timestamps relative to the first.
+
+    With select(name, pathname, timestamp) only the frames for which it returns True are read.
+    """
+    source = sequence_source.SequenceSource(grab_source_dir, PREFETCH, decode=True, extensions=('.ply',), timestamp_pattern=sequence_source.GRAB_TIMESTAMP)
+    if select:
+        source.frames = [frame for frame in source.frames if select(*frame)]
+    return source
+
+def frame_outputs(filename, ply_dest_dir, cwicpc_dest_dir):
+    """Return list of (kind, dest-pathname, encoder-params) for all outputs of a single frame, in encoder order"""
+    basename = os.path.splitext(filename)[0]
+    rv = [('ply', os.path.join(ply_dest_dir, filename), None)]
+    qualities = [('', ENCODER_PARAMS)]
+    if ALSO_LOW:
+        qualities.append(('-low', ENCODER_PARAMS_LOW))
+    for quality_suffix, params in qualities:
+        rv.append(('cwicpc', os.path.join(cwicpc_dest_dir + quality_suffix, basename + '.cwicpc'), params))
+        for i in TILES:
+            if i == 0: continue
+            tile_params = params[:6] + (i,) + params[7:]
+            rv.append(('cwicpc', os.path.join(cwicpc_dest_dir + str(i) + quality_suffix, basename + '.cwicpc'), tile_params))
+    return rv
+
+def output_params(output, timestamp):
+    """Return all parameters that influence the content of an output file"""
+    kind, _, encoder_params = output
+    return dict(kind=kind, timestamp=timestamp, VOXEL_SIZE=VOXEL_SIZE, TILES=TILES, encoder=encoder_params)
+
 def draw_o3d(o3dpc):
     """Draw open3d pointcloud"""
     open3d.draw_geometries([o3dpc])
         
 def cwipc_to_o3d(pc):
     """Convert cwipc pointcloud to open3d pointcloud"""
-    # Note that this method is inefficient, it can probably be done
-    # in-place with some numpy magic
-    pcpoints = pc.get_points()
-    points = []
-    colors = []
-    for p in pcpoints:
-        points.append((p.x, p.y, p.z))  
-        colors.append((float(p.r)/255.0, float(p.g)/255.0, float(p.b)/255.0))
-    points_v = open3d.Vector3dVector(points)
-    colors_v = open3d.Vector3dVector(colors)
-    rv = open3d.PointCloud()
-    rv.points = points_v
-    rv.colors = colors_v
-    return rv
+    return cwipc_numpy.cwipc_to_o3d(pc)
     
 def write_ply_cwipc(filename, pc):
     """Write cwipc pointcloud to PLY file"""
@@ -57,87 +71,85 @@ def main():
     grab_source_dir = sys.argv[1]
     ply_dest_dir = sys.argv[2]
     cwicpc_dest_dir = sys.argv[3]
-    os.mkdir(ply_dest_dir)
-    os.mkdir(cwicpc_dest_dir)
-    for i in TILES:
-        if i == 0: continue
-        os.mkdir(cwicpc_dest_dir+str(i))
-    if ALSO_LOW:
-        os.mkdir(cwicpc_dest_dir+'-low')
-        for i in TILES:
-            if i == 0: continue
-            os.mkdir(cwicpc_dest_dir+str(i)+'-low')
+    global TILES
+    tileconfig = os.path.join(grab_source_dir, 'tileconfig.json')
+    if os.path.exists(tileconfig):
+        _, masks, _ = tiling.tile_normals(tiling.load_tileconfig(tileconfig))
+        TILES = (0,) + tuple(int(mask) for mask in masks)
+        print(f"{tileconfig}: tile masks {TILES}")
+    os.makedirs(ply_dest_dir, exist_ok=True)
+    for kind, dest_pathname, _ in frame_outputs('', ply_dest_dir, cwicpc_dest_dir):
+        os.makedirs(os.path.dirname(dest_pathname), exist_ok=True)
+    manifest = build_manifest.Manifest(build_manifest.default_manifest_filename(ply_dest_dir, cwicpc_dest_dir))
     
     startTime = time.time()
-    count = 0
-    timestamp = 0
-    allfiles = os.listdir(grab_source_dir)
-    allfiles.sort()
     
-    # Setup the encoder group and the encoders
+    # Setup the encoder group and the encoders, in the order of frame_outputs()
     
     enc_group = cwipc.codec.cwipc_new_encodergroup()
-    params = cwipc.codec.cwipc_encoder_params(False, 1, 1.0, 9, 85, 16, 0, 0)
     encoders = []
-    encoders.append(enc_group.addencoder(params=params))
-    for i in TILES:
-        if i == 0: continue
-        params.tilenumber = i
+    for kind, _, params in frame_outputs('', ply_dest_dir, cwicpc_dest_dir):
+        if kind != 'cwicpc': continue
         encoders.append(
-            enc_group.addencoder(params=params) 
+            enc_group.addencoder(params=cwipc.codec.cwipc_encoder_params(*params))
         )
-    if ALSO_LOW:
-        params_low = cwipc.codec.cwipc_encoder_params(False, 1, 1.0, 7, 60, 16, 0, 0)
-        encoders.append(enc_group.addencoder(params=params_low))
-        for i in TILES:
-            if i == 0: continue
-            params_low.tilenumber = i
-            encoders.append(
-                enc_group.addencoder(params=params_low) 
-            )
-    reader = PlyReader()
-    for filename in allfiles:
-        if os.path.splitext(filename)[1] != '.ply':
-            continue
-        pathname = os.path.join(grab_source_dir, filename)
-        print(pathname, '...')
-        basename = os.path.splitext(filename)[0]
-        ply_dest_pathname = os.path.join(ply_dest_dir, filename)
-        
-        cwicpc_dest_pathnames = []
-        cwicpc_dest_pathnames.append(os.path.join(cwicpc_dest_dir, basename + '.cwicpc'))
-        for i in TILES:
-            if i == 0: continue
-            cwicpc_dest_pathnames.append(
-                os.path.join(cwicpc_dest_dir + str(i), basename + '.cwicpc')
-            )
-        if ALSO_LOW:
-            cwicpc_dest_pathnames.append(os.path.join(cwicpc_dest_dir + '-low', basename + '.cwicpc'))
-            for i in TILES:
-                if i == 0: continue
-                cwicpc_dest_pathnames.append(
-                    os.path.join(cwicpc_dest_dir + str(i) + '-low', basename + '.cwicpc')
-                )
-        
-        pc = reader.grab(pathname)
-        timestamp = pc.timestamp()
-        print('xxxjack grabbed timestamp', timestamp)
 
-        # Save as a plyfile
-        write_ply_cwipc(ply_dest_pathname, pc)
-        
-        # compress and save
+    # Frames are only converted if one of their outputs is missing or was made from a
+    # different source or with different parameters.
+    source_hashes = {}
+    def is_stale(name, pathname, timestamp):
+        source_hash = source_hashes[name] = manifest.source_hash(pathname)
+        return not all(
+            manifest.is_current(output[1], source_hash, output_params(output, timestamp))
+            for output in frame_outputs(name, ply_dest_dir, cwicpc_dest_dir)
+        )
+    source = grab_source(grab_source_dir, is_stale)
+    manifest.save()
+    print("%d frames to convert" % len(source))
+
+    def read_stage(frame):
+        print(frame.pathname, '...')
+        pc = frame.pc
+        print('xxxjack grabbed timestamp', pc.timestamp())
+        return frame, pc
+
+    def encode_stage(item):
+        frame, pc = item
         enc_group.feed(pc)
+        encoded = []
         for i in range(len(encoders)):
             ok = encoders[i].available(True)
             assert ok
-            data = encoders[i].get_bytes()
-            with open(cwicpc_dest_pathnames[i], 'wb') as ofp:
-                ofp.write(data)
+            encoded.append(encoders[i].get_bytes())
+        return frame, pc, encoded
 
-        pc.free()
+    def write_stage(item):
+        frame, pc, encoded = item
+        outputs = frame_outputs(frame.name, ply_dest_dir, cwicpc_dest_dir)
+
+        # Save as a plyfile
+        write_ply_cwipc(outputs[0][1], pc)
         
-        count += 1
+        # save compressed
+        for i in range(len(encoded)):
+            with open(outputs[i+1][1], 'wb') as ofp:
+                ofp.write(encoded[i])
+
+        pc.free()
+        for output in outputs:
+            manifest.record(output[1], frame.pathname, source_hashes[frame.name], output_params(output, frame.timestamp))
+        manifest.checkpoint()
+
+    try:
+        stats = stage_pipeline.run_pipeline(source, [
+            ("read", read_stage),
+            ("encode", encode_stage),
+            ("write", write_stage)
+            ])
+    finally:
+        manifest.save()
+    stage_pipeline.print_stats(stats)
+    count = stats[-1].count
         
     now = time.time()
     print("Converted %d pointclouds in %f seconds" % (count, now-startTime))
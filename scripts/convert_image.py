@@ -1,50 +1,154 @@
 import argparse
 import sys
+import os
+import time
+import multiprocessing
+from typing import List, Optional, Tuple
+import numpy as np
 from PIL import Image
-import cwipc
+import cwipc_numpy
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+TIME_INCREMENT = 33 # Increment in timestamp between successive pointclouds
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert image to point cloud")
+    parser = argparse.ArgumentParser(description="Convert image(s) to point cloud(s)")
     parser.add_argument("--pointsize", action="store", default=0.01, type=float, help="Width/height of one pixel (in meters)")
     parser.add_argument("--bottom", action="store", default=0, type=float, help="Y coordinate of bottom of image (in meters)")
-    parser.add_argument("input", type=str, action="store", help="Input image (.png, .jpg, etc)")
-    parser.add_argument("output", type=str, action="store", help="Output point cloud (.ply or .cwipcdump)")
+    parser.add_argument("--depth", action="store", help="Depth map image (or directory of depth maps, one per input image). Pixels with depth 0 are left out")
+    parser.add_argument("--depth-scale", action="store", default=0.001, type=float, help="Meters per depth map unit (default: 0.001, millimeters)")
+    parser.add_argument("--downsample", action="store", default=1, type=int, help="Average blocks of NxN pixels into one point (default: 1)")
+    parser.add_argument("--jobs", action="store", default=0, type=int, help="Number of images to convert in parallel (default: 0, number of cores)")
+    parser.add_argument("input", type=str, nargs="+", help="Input image(s) (.png, .jpg, etc) or directory with images")
+    parser.add_argument("output", type=str, action="store", help="Output point cloud (.ply or .cwipcdump). For multiple images a pattern with a number, like ply/frame_%%04d.ply")
     args = parser.parse_args()
-    convert(args.input, args.output, args.pointsize, args.bottom)
+    inputs = list_images(args.input)
+    depths = list_images([args.depth]) if args.depth else [None] * len(inputs)
+    if len(depths) == 1 and len(inputs) > 1:
+        depths = depths * len(inputs)
+    if len(depths) != len(inputs):
+        print(f"{sys.argv[0]}: {len(inputs)} images but {len(depths)} depth maps", file=sys.stderr)
+        sys.exit(1)
+    if len(inputs) == 1 and not '%' in args.output:
+        outputs = [args.output]
+    else:
+        if not '%' in args.output:
+            print(f"{sys.argv[0]}: multiple images need an output pattern with %d", file=sys.stderr)
+            sys.exit(1)
+        outputs = [args.output % i for i in range(len(inputs))]
+    for output in outputs:
+        if os.path.splitext(output)[1] not in ('.ply', '.cwipcdump'):
+            print(f"{sys.argv[0]}: Unknown extension in {output}, .ply and .cwipcdump supported", file=sys.stderr)
+            sys.exit(1)
+    tasks = [(input, output, depth, i*TIME_INCREMENT if len(inputs) > 1 else 0) for i, (input, output, depth) in enumerate(zip(inputs, outputs, depths))]
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    jobs = min(jobs, len(tasks))
+    options = (args.pointsize, args.bottom, args.depth_scale, args.downsample)
+    startTime = time.time()
+    if jobs <= 1:
+        for task in tasks:
+            _convert_task(task + options)
+    else:
+        with multiprocessing.Pool(jobs) as pool:
+            for _ in pool.imap(_convert_task, [task + options for task in tasks]):
+                pass
+    print(f"Converted {len(tasks)} images in {time.time()-startTime:.3f} seconds ({jobs} jobs)")
 
-def convert(input : str, output : str, pointsize : float, bottom : float):
-    print(f"Input={input}, Output={output}, pointsize={pointsize}, bottom={bottom}")
-    with Image.open(input) as im:
-        w = im.width
-        h = im.height
-        print(f"Image: {w}x{h} pixels")
-        left_x = -(w/2.0)*pointsize
-        right_x = (w/2.0)*pointsize
-        bottom_y = bottom
-        top_y = bottom + h*pointsize
-        print(f"X-range: {left_x}..{right_x}")
-        print(f"Y-range: {top_y}..{bottom_y}")
-        print(f"Z-range: 0")
-        points = []
-        for y in range(0, h):
-            for x in range(0, w):
-                pt_x = left_x + (x*pointsize)
-                pt_y = top_y - (y*pointsize)
-                pt_z = 0.0
-                pt_r, pt_g, pt_b = im.getpixel((x, y))
-                pt_mask = 0
-                points.append((pt_x, pt_y, pt_z, pt_r, pt_g, pt_b, pt_mask))
-        pc = cwipc.cwipc_from_points(points, 0)
-        pc._set_cellsize(pointsize)
-        if output.endswith(".ply"):
-            cwipc.cwipc_write(output, pc)
-        elif output.endswith(".cwipcdump"):
-            cwipc.cwipc_write_debugdump(output, pc)
+def list_images(names : List[str]) -> List[str]:
+    """Expand directories into their (sorted) image files"""
+    rv = []
+    for name in names:
+        if os.path.isdir(name):
+            rv += [os.path.join(name, fn) for fn in sorted(os.listdir(name)) if os.path.splitext(fn)[1].lower() in IMAGE_EXTENSIONS]
         else:
-            print(f"{sys.argv[0]}: Unknown extension in {output}, .ply and .cwipcdump supported")
-            
+            rv.append(name)
+    return rv
+
+def _convert_task(task : Tuple) -> None:
+    input, output, depth, timestamp, pointsize, bottom, depth_scale, downsample = task
+    convert(input, output, pointsize, bottom, depth=depth, depth_scale=depth_scale, downsample=downsample, timestamp=timestamp)
+
+def _block_mean(array : np.ndarray, n : int, weights : Optional[np.ndarray] = None) -> np.ndarray:
+    """Average (h, w, ...) array over nxn blocks, cropping to a multiple of n. Optionally weighted"""
+    h = array.shape[0] // n * n
+    w = array.shape[1] // n * n
+    array = array[:h, :w].astype(np.float64)
+    shape = (h//n, n, w//n, n) + array.shape[2:]
+    if weights is None:
+        return array.reshape(shape).mean(axis=(1, 3))
+    weights = weights[:h, :w].astype(np.float64).reshape(shape[:4] + (1,) * (array.ndim - 2))
+    total = (array.reshape(shape) * weights).sum(axis=(1, 3))
+    count = weights.sum(axis=(1, 3))
+    return np.where(count > 0, total / np.maximum(count, 1), 0)
+
+def image_to_points(rgb : np.ndarray, pointsize : float, bottom : float = 0, depth : Optional[np.ndarray] = None, depth_scale : float = 0.001, downsample : int = 1) -> np.ndarray:
+    """Convert an (h, w, 3) uint8 image to a vertical plane of points, one point per pixel
+    pointsize meters apart, centered on x=0 with the bottom row at y=bottom.
 
+    With a depth map (h, w), z is depth*depth_scale and pixels with depth 0 are left out.
+    With downsample n every nxn block of pixels becomes one point of n*pointsize.
+    """
+    if depth is not None and depth.shape[:2] != rgb.shape[:2]:
+        raise ValueError(f"depth map is {depth.shape[1]}x{depth.shape[0]}, image is {rgb.shape[1]}x{rgb.shape[0]}")
+    if downsample > 1:
+        # Only pixels with depth contribute, so blocks on a silhouette do not get background color
+        valid = depth > 0 if depth is not None else None
+        rgb = np.rint(_block_mean(rgb, downsample, valid)).astype(np.uint8)
+        if depth is not None:
+            depth = _block_mean(depth, downsample, valid)
+    bh, bw = rgb.shape[:2]
+    # Pixel (i, j) of the (cropped) image would be at left_x + i*pixelsize, top_y - j*pixelsize.
+    # A block becomes one point at the center of its pixels.
+    pixelsize = pointsize
+    pointsize = pointsize * downsample
+    left_x = -(bw*downsample/2.0)*pixelsize + (downsample-1)/2.0*pixelsize
+    top_y = bottom + bh*downsample*pixelsize - (downsample-1)/2.0*pixelsize
+    points = cwipc_numpy.empty_points(bw*bh)
+    ys, xs = np.mgrid[0:bh, 0:bw]
+    points['x'] = left_x + xs.ravel()*pointsize
+    points['y'] = top_y - ys.ravel()*pointsize
+    if depth is None:
+        points['z'] = 0
+    else:
+        points['z'] = depth.ravel() * depth_scale
+    cwipc_numpy.rgb_view(points)[:] = rgb.reshape(-1, 3)
+    points['tile'] = 0
+    if depth is not None:
+        points = points[depth.ravel() > 0]
+    return points
 
+def read_image(input : str) -> np.ndarray:
+    with Image.open(input) as im:
+        return np.asarray(im.convert("RGB"))
+
+def read_depth(input : str) -> np.ndarray:
+    with Image.open(input) as im:
+        if im.mode in ("RGB", "RGBA", "P"):
+            im = im.convert("L")
+        return np.asarray(im)
+
+def convert(input : str, output : str, pointsize : float, bottom : float, depth : Optional[str] = None, depth_scale : float = 0.001, downsample : int = 1, timestamp : int = 0):
+    import cwipc
+    print(f"Input={input}, Output={output}, pointsize={pointsize}, bottom={bottom}")
+    rgb = read_image(input)
+    h, w = rgb.shape[:2]
+    print(f"Image: {w}x{h} pixels")
+    print(f"X-range: {-(w/2.0)*pointsize}..{(w/2.0)*pointsize}")
+    print(f"Y-range: {bottom + h*pointsize}..{bottom}")
+    depth_map = read_depth(depth) if depth else None
+    if depth_map is None:
+        print(f"Z-range: 0")
+    points = image_to_points(rgb, pointsize, bottom, depth_map, depth_scale, downsample)
+    if depth_map is not None and len(points):
+        print(f"Z-range: {points['z'].min()}..{points['z'].max()}")
+    pc = cwipc_numpy.numpy_to_cwipc(points, timestamp, pointsize*downsample)
+    if output.endswith(".ply"):
+        cwipc.cwipc_write(output, pc)
+    elif output.endswith(".cwipcdump"):
+        cwipc.cwipc_write_debugdump(output, pc)
+    else:
+        print(f"{sys.argv[0]}: Unknown extension in {output}, .ply and .cwipcdump supported")
+    pc.free()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,11 +1,19 @@
 import sys
 import os
-import open3d
+import argparse
+import multiprocessing
+import shutil
 import numpy as np
 import cwipc
 import cwipc.codec
 import cwipc.util
 import time
+import cwipc_numpy
+import plyreader
+import stage_pipeline
+import build_manifest
+import tiling
+import analyze_bounds
 
 VOXEL_SIZE = 2.8    # Larger numbers mean smaller output size
 SCALE_FACTOR = 500  # Conversion factor from loot xyz values to our xyz values
@@ -14,80 +22,50 @@ TRANSLATE_X = -0.45 # Conversion (after scaling) of X values
 TRANSLATE_Y = 0     # Conversion (after scaling) of Y values
 TRANSLATE_Z = -0.45 # Conversion (after scaling) of Z values
 TIME_INCREMENT = 33 # Increment in timestamp between successive pointclouds
-O3D_BROKEN = True
+PLY_READER = 'plyreader'    # Source PLY reader, recorded in the manifest
 
 MAXTILES=4  # Number of tiles (in addition to tile 0) to encode
+TILEINFO=None   # tileInfo from tileconfig.json (--tileconfig), overrides MAXTILES
+TILE_OVERLAP=0  # Angle (degrees) of overlap between tiles when using TILEINFO
 ALSO_LOW=True   # Set to True to also do low quality cwicpc
 
-def read_loot_ply_o3d(filename):
-    """Read PLY file using open3d, scale it and downsample it. Returns open3d pointcloud"""
-    if O3D_BROKEN:
-        pc = cwipc.cwipc_read(filename, 0)
-        original = cwipc_to_o3d(pc)
-        pc.free()
-        del pc
-    else:
-        original = open3d.io.read_point_cloud(filename)
-    downsampled = open3d.geometry.PointCloud.voxel_down_sample(original, voxel_size=VOXEL_SIZE)
-    points = np.asarray(downsampled.points)
-    translate = np.array([TRANSLATE_X, TRANSLATE_Y, TRANSLATE_Z])
-    points /= SCALE_FACTOR
-    points += translate
-    return downsampled
+def read_loot_ply(filename):
+    """Read PLY file (memory-mapped, see plyreader.py). Returns point array"""
+    return plyreader.read_ply(filename)
+
+def downsample_points(original):
+    """Downsample (like open3d voxel_down_sample) and scale point array. Returns new point array"""
+    points = cwipc_numpy.voxel_down_sample(original, VOXEL_SIZE)
+    xyz = cwipc_numpy.xyz_view(points)
+    xyz /= SCALE_FACTOR
+    xyz += np.array([TRANSLATE_X, TRANSLATE_Y, TRANSLATE_Z], dtype=np.float32)
+    return points
+
+def read_loot_ply_downsampled(filename):
+    """Read PLY file, downsample and scale it. Returns point array"""
+    return downsample_points(read_loot_ply(filename))
     
 def write_ply_o3d(filename, o3dpc):
     """Write PLY file from open3d pointcloud"""
+    import open3d
     open3d.io.write_point_cloud(filename, o3dpc, write_ascii=True)
     
 def draw_o3d(o3dpc):
     """Draw open3d pointcloud"""
+    import open3d
     open3d.visualization.draw_geometries([o3dpc])
     
-def o3d_to_cwipc(o3dpc, timestamp):
-    """Convert open3d pointcloud to cwipc pointcloud"""
-    # Note that this method is inefficient, it can probably be done
-    # in-place with some numpy magic
-    points = list(o3dpc.points)
-    colors = list(o3dpc.colors)
-    rv = []
-    pointsandcolors = zip(points, colors)
-    for (x, y, z), (r, g, b) in pointsandcolors:
-        if MAXTILES > 0:
-            if MAXTILES == 2:
-                side = 1 if x < 0 else 2
-            elif MAXTILES == 4:
-                if x < 0 and z < 0:
-                    side = 1
-                elif x < 0 and z >= 0:
-                    side = 2
-                elif x >= 0 and z < 0:
-                    side = 3
-                else:
-                    side = 4
-        r = int(r*255)
-        g = int(g*255)
-        b = int(b*255)
-        rv.append((x, y, z, r, g, b, side))
-    rv = cwipc.cwipc_from_points(rv, timestamp)
-    rv._set_cellsize(CWIPC_POINTSIZE)
-    return rv
+def points_to_cwipc(points, timestamp):
+    """Assign tiles to point array and convert it to cwipc pointcloud"""
+    if TILEINFO:
+        points['tile'] = tiling.assign_tiles(points, TILEINFO, TILE_OVERLAP)
+    else:
+        points['tile'] = cwipc_numpy.quadrant_tiles(points, MAXTILES)
+    return cwipc_numpy.numpy_to_cwipc(points, timestamp, CWIPC_POINTSIZE)
     
 def cwipc_to_o3d(pc):
     """Convert cwipc pointcloud to open3d pointcloud"""
-    # Note that this method is inefficient, it can probably be done
-    # in-place with some numpy magic
-    pcpoints = pc.get_points()
-    points = []
-    colors = []
-    for p in pcpoints:
-        points.append((p.x, p.y, p.z))  
-        colors.append((float(p.r)/255.0, float(p.g)/255.0, float(p.b)/255.0))
-    points_v = open3d.utility.Vector3dVector(points)
-    colors_v = open3d.utility.Vector3dVector(colors)
-    rv = open3d.geometry.PointCloud()
-    rv.points = points_v
-    rv.colors = colors_v
-    return rv
+    return cwipc_numpy.cwipc_to_o3d(pc)
     
 def write_ply_cwipc(filename, pc):
     """Write cwipc pointcloud to PLY file"""
@@ -97,125 +75,278 @@ def write_dump_cwipc(filename, pc):
     """Write cwipc pointcloud to cwipcdump file"""
     cwipc.cwipc_write_debugdump(filename, pc)
     
-def main():
-    if len(sys.argv) != 5:
-        print('Usage: %s loot-source-ply-dir dest-ply-dir dest-cwicpc-dir dest-cwipcdump-dir' % sys.argv[0])
-        print('Use - to skip an output format')
-        sys.exit(1)
-    loot_source_dir = sys.argv[1]
-    ply_dest_dir = sys.argv[2]
-    cwicpc_dest_dir = sys.argv[3]
-    cwipcdump_dest_dir = sys.argv[4]
-    if ply_dest_dir == '-': 
-        ply_dest_dir = None
-    if cwicpc_dest_dir == '-': 
-        cwicpc_dest_dir = None
-    if cwipcdump_dest_dir == '-': 
-        cwipcdump_dest_dir = None
+# Positional arguments to cwipc_encoder_params:
+ENCODER_PARAM_NAMES = ('do_inter_frame', 'gop_size', 'exp_factor', 'octree_bits', 'jpeg_quality', 'macroblock_size', 'tilenumber', 'voxelsize')
+ENCODER_PARAMS = (False, 1, 1.0, 9, 85, 16, 0, 0)
+ENCODER_PARAMS_LOW = (False, 1, 1.0, 7, 60, 16, 0, 0)
+
+def encoder_configs():
+    """Return list of (directory-suffix, encoder-params) for all encoders, in encoder order"""
+    rv = []
+    qualities = [('', ENCODER_PARAMS)]
+    if ALSO_LOW:
+        qualities.append(('-low', ENCODER_PARAMS_LOW))
+    for quality_suffix, params in qualities:
+        params = dict(zip(ENCODER_PARAM_NAMES, params))
+        rv.append((quality_suffix, params))
+        if TILEINFO:
+            # Directories are numbered by tile, the encoder selects points by camera mask
+            _, masks, _ = tiling.tile_normals(TILEINFO)
+            for i, mask in enumerate(masks):
+                rv.append((str(i+1) + quality_suffix, dict(params, tilenumber=int(mask))))
+        elif MAXTILES > 0:
+            for i in range(1, MAXTILES+1):
+                rv.append((str(i) + quality_suffix, dict(params, tilenumber=i)))
+    return rv
+
+def make_dest_dirs(ply_dest_dir, cwicpc_dest_dir, cwipcdump_dest_dir):
+    """Create the output directories, if they don't exist yet"""
     if ply_dest_dir: 
-        os.mkdir(ply_dest_dir)
+        os.makedirs(ply_dest_dir, exist_ok=True)
     if cwicpc_dest_dir: 
-        os.mkdir(cwicpc_dest_dir)
-        if MAXTILES > 0:
-            for i in range(1,MAXTILES+1):
-                os.mkdir(cwicpc_dest_dir+str(i))
-        if ALSO_LOW:
-            os.mkdir(cwicpc_dest_dir+'-low')
-            if MAXTILES > 0:
-                for i in range(1,MAXTILES+1):
-                    os.mkdir(cwicpc_dest_dir+str(i)+'-low')
-        
+        for suffix, _ in encoder_configs():
+            os.makedirs(cwicpc_dest_dir + suffix, exist_ok=True)
     if cwipcdump_dest_dir: 
-        os.mkdir(cwipcdump_dest_dir)
-        
-        
-    startTime = time.time()
-    count = 0
-    timestamp = 0
-    allfiles = os.listdir(loot_source_dir)
-    allfiles.sort()
-    
-    # Setup the encoder group and the encoders
-    
+        os.makedirs(cwipcdump_dest_dir, exist_ok=True)
+
+def make_encoders(encoder_indices):
+    """Setup the encoder group and the encoders for the given indices into encoder_configs(). Returns group and list of encoders"""
+    configs = encoder_configs()
     enc_group = cwipc.codec.cwipc_new_encodergroup()
-    params = cwipc.codec.cwipc_encoder_params(False, 1, 1.0, 9, 85, 16, 0, 0)
     encoders = []
-    encoders.append(enc_group.addencoder(params=params))
-    if MAXTILES > 0:
-        for i in range(1, MAXTILES+1):
-            params.tilenumber = i
-            encoders.append(
-                enc_group.addencoder(params=params) 
-            )
-    if ALSO_LOW:
-        params_low = cwipc.codec.cwipc_encoder_params(False, 1, 1.0, 7, 60, 16, 0, 0)
-        encoders.append(enc_group.addencoder(params=params_low))
-        if MAXTILES > 0:
-            for i in range(1, MAXTILES+1):
-                params_low.tilenumber = i
-                encoders.append(
-                    enc_group.addencoder(params=params_low) 
-                )
-            
-    for filename in allfiles:
-        if os.path.splitext(filename)[1] != '.ply':
-            continue
-        pathname = os.path.join(loot_source_dir, filename)
+    for i in encoder_indices:
+        _, params = configs[i]
+        encoders.append(
+            enc_group.addencoder(params=cwipc.codec.cwipc_encoder_params(*params.values()))
+        )
+    return enc_group, encoders
+
+class EncoderCache:
+    """Encoder groups, one per distinct set of encoders needed (usually all of them, or only the stale ones)"""
+
+    def __init__(self):
+        self.groups = {}
+
+    def get(self, encoder_indices):
+        encoder_indices = tuple(encoder_indices)
+        if not encoder_indices in self.groups:
+            self.groups[encoder_indices] = make_encoders(encoder_indices)
+        return self.groups[encoder_indices]
+
+def frame_outputs(pathname, ply_dest_dir, cwicpc_dest_dir, cwipcdump_dest_dir):
+    """Return list of outputs (kind, dest-pathname, encoder-index) for one source frame"""
+    filename = os.path.basename(pathname)
+    basename = os.path.splitext(filename)[0]
+    rv = []
+    if ply_dest_dir:
+        rv.append(('ply', os.path.join(ply_dest_dir, filename), None))
+    if cwipcdump_dest_dir:
+        rv.append(('cwipcdump', os.path.join(cwipcdump_dest_dir, basename + '.cwipcdump'), None))
+    if cwicpc_dest_dir:
+        for i, (suffix, _) in enumerate(encoder_configs()):
+            rv.append(('cwicpc', os.path.join(cwicpc_dest_dir + suffix, basename + '.cwicpc'), i))
+    return rv
+
+def output_params(output, timestamp):
+    """Return all parameters that influence the content of an output file"""
+    kind, _, encoder_index = output
+    rv = dict(
+        kind=kind,
+        timestamp=timestamp,
+        VOXEL_SIZE=VOXEL_SIZE,
+        SCALE_FACTOR=SCALE_FACTOR,
+        CWIPC_POINTSIZE=CWIPC_POINTSIZE,
+        TRANSLATE_X=TRANSLATE_X,
+        TRANSLATE_Y=TRANSLATE_Y,
+        TRANSLATE_Z=TRANSLATE_Z,
+        PLY_READER=PLY_READER,
+        MAXTILES=MAXTILES,
+        TILEINFO=TILEINFO,
+        TILE_OVERLAP=TILE_OVERLAP,
+    )
+    if encoder_index is not None:
+        rv['encoder'] = encoder_configs()[encoder_index][1]
+    return rv
+
+def list_source_files(loot_source_dir):
+    """Return sorted list of PLY filenames in the source directory"""
+    allfiles = os.listdir(loot_source_dir)
+    allfiles.sort()
+    return [filename for filename in allfiles if os.path.splitext(filename)[1] == '.ply']
+
+def encode_frame(pc, outputs, encoder_cache):
+    """Compress a cwipc pointcloud with the encoders needed for outputs. Returns dict mapping encoder index to compressed data"""
+    encoder_indices = [encoder_index for kind, _, encoder_index in outputs if kind == 'cwicpc']
+    if not encoder_indices:
+        return {}
+    enc_group, encoders = encoder_cache.get(encoder_indices)
+    rv = {}
+    enc_group.feed(pc)
+    for i in range(len(encoders)):
+        ok = encoders[i].available(True)
+        assert ok
+        rv[encoder_indices[i]] = encoders[i].get_bytes()
+    return rv
+
+def write_frame(pc, encoded, outputs):
+    """Write the outputs for a single frame, and free the pointcloud"""
+    for kind, dest_pathname, encoder_index in outputs:
+        if kind == 'ply':
+            # Save as a plyfile
+            write_ply_cwipc(dest_pathname, pc)
+        elif kind == 'cwipcdump':
+            # Save as dump
+            write_dump_cwipc(dest_pathname, pc)
+        else:
+            # save compressed
+            with open(dest_pathname, 'wb') as ofp:
+                ofp.write(encoded[encoder_index])
+    pc.free()
+
+def convert_frame(pathname, timestamp, outputs, encoder_cache):
+    """Convert a single source frame to the given outputs"""
+    # Read original loot, downsample and scale.
+    points = read_loot_ply_downsampled(pathname)
+
+    # Convert to cwipc
+    pc = points_to_cwipc(points, timestamp)
+
+    # compress
+    encoded = encode_frame(pc, outputs, encoder_cache)
+
+    write_frame(pc, encoded, outputs)
+
+def convert_pipelined(tasks, queue_size, done_callback):
+    """Convert all frames in a single process, with read, transform, encode and write overlapping in separate threads"""
+    encoder_cache = EncoderCache()
+
+    def read_stage(task):
+        pathname, timestamp, outputs = task
         print(pathname, '...')
-        basename = os.path.splitext(filename)[0]
-        if ply_dest_dir:
-            ply_dest_pathname = os.path.join(ply_dest_dir, filename)
-        if cwipcdump_dest_dir:
-            cwipcdump_dest_pathname = os.path.join(cwipcdump_dest_dir, basename + '.cwipcdump')
-       
-        if cwicpc_dest_dir:
-            cwicpc_dest_pathnames = []
-            cwicpc_dest_pathnames.append(os.path.join(cwicpc_dest_dir, basename + '.cwicpc'))
-            if MAXTILES > 0:
-                for i in range(1,MAXTILES+1):
-                    cwicpc_dest_pathnames.append(
-                        os.path.join(cwicpc_dest_dir + str(i), basename + '.cwicpc')
-                    )
-            if ALSO_LOW:
-                cwicpc_dest_pathnames.append(os.path.join(cwicpc_dest_dir + '-low', basename + '.cwicpc'))
-                if MAXTILES > 0:
-                    for i in range(1,MAXTILES+1):
-                        cwicpc_dest_pathnames.append(
-                            os.path.join(cwicpc_dest_dir + str(i) + '-low', basename + '.cwicpc')
-                        )
-            
-        # Read original loot, downsample and scale.
-        o3dpc = read_loot_ply_o3d(pathname)
-
-        # Convert to cwipc
-        pc = o3d_to_cwipc(o3dpc, timestamp)
-
-        # Save as a plyfile
-        if ply_dest_dir:
-            write_ply_cwipc(ply_dest_pathname, pc)
-        # Save as dump
-        if cwipcdump_dest_dir:
-            write_dump_cwipc(cwipcdump_dest_pathname, pc)
-        # compress and save
-        if cwicpc_dest_dir:
-            enc_group.feed(pc)
-            for i in range(len(encoders)):
-                ok = encoders[i].available(True)
-                assert ok
-                data = encoders[i].get_bytes()
-                with open(cwicpc_dest_pathnames[i], 'wb') as ofp:
-                    ofp.write(data)
-
-        pc.free()
+        return task, read_loot_ply(pathname)
+
+    def transform_stage(item):
+        task, original = item
+        pathname, timestamp, outputs = task
+        return task, points_to_cwipc(downsample_points(original), timestamp)
+
+    def encode_stage(item):
+        task, pc = item
+        pathname, timestamp, outputs = task
+        return task, pc, encode_frame(pc, outputs, encoder_cache)
+
+    def write_stage(item):
+        task, pc, encoded = item
+        pathname, timestamp, outputs = task
+        write_frame(pc, encoded, outputs)
+        done_callback(task)
+
+    stats = stage_pipeline.run_pipeline(tasks, [
+        ("read", read_stage), 
+        ("transform", transform_stage), 
+        ("encode", encode_stage), 
+        ("write", write_stage)
+        ], queue_size)
+    stage_pipeline.print_stats(stats)
+    return stats[-1].count
+
+# Per-process encoders for --jobs worker processes
+_worker_encoder_cache = None
+
+def _worker_init(tileinfo, tile_overlap, transform):
+    """Initialize a worker process: every worker has its own encoders"""
+    global _worker_encoder_cache, TILEINFO, TILE_OVERLAP
+    TILEINFO = tileinfo
+    TILE_OVERLAP = tile_overlap
+    if transform:
+        analyze_bounds.apply_transform(sys.modules[__name__], transform)
+    _worker_encoder_cache = EncoderCache()
+
+def _worker_convert(task):
+    """Convert one frame in a worker process. Only the pathname, timestamp and output list are sent to the worker."""
+    pathname, timestamp, outputs = task
+    convert_frame(pathname, timestamp, outputs, _worker_encoder_cache)
+    return task
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert 8i loot-style PLY sequence to cwipc ply, cwicpc and cwipcdump")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of frames to convert in parallel (default: 1, 0 means number of cores)")
+    parser.add_argument("--queue-size", type=int, default=2, help="Maximum number of frames waiting between two stages when not using --jobs (default: 2)")
+    parser.add_argument("--manifest", help="Manifest recording sources and parameters of all outputs (default: next to first output directory)")
+    parser.add_argument("--force", action="store_true", help="Regenerate all outputs, even those that are up to date")
+    parser.add_argument("--tileconfig", help="Assign tiles using the tileInfo normals and cameraMasks from this tileconfig.json (default: MAXTILES quadrants)")
+    parser.add_argument("--overlap", type=float, default=0, help="With --tileconfig: points within this many degrees of a second tile also belong to it (default: 0)")
+    parser.add_argument("--transform", help="Use SCALE_FACTOR and TRANSLATE_X/Y/Z from this JSON file, made with analyze_bounds.py (default: the values for loot)")
+    parser.add_argument("loot_source_dir", help="Directory with source PLY files")
+    parser.add_argument("ply_dest_dir", help="Output directory for PLY files, or - to skip")
+    parser.add_argument("cwicpc_dest_dir", help="Output directory for compressed files, or - to skip. Per-tile and low-quality directories get a suffix")
+    parser.add_argument("cwipcdump_dest_dir", nargs="?", default="-", help="Output directory for cwipcdump files, or - to skip (default: -)")
+    args = parser.parse_args()
+    loot_source_dir = args.loot_source_dir
+    ply_dest_dir = None if args.ply_dest_dir == '-' else args.ply_dest_dir
+    cwicpc_dest_dir = None if args.cwicpc_dest_dir == '-' else args.cwicpc_dest_dir
+    cwipcdump_dest_dir = None if args.cwipcdump_dest_dir == '-' else args.cwipcdump_dest_dir
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    global TILEINFO, TILE_OVERLAP
+    transform = None
+    if args.transform:
+        transform = analyze_bounds.load_transform(args.transform)
+        analyze_bounds.apply_transform(sys.modules[__name__], transform)
+    if args.tileconfig:
+        TILEINFO = tiling.load_tileconfig(args.tileconfig)
+        TILE_OVERLAP = args.overlap
+    make_dest_dirs(ply_dest_dir, cwicpc_dest_dir, cwipcdump_dest_dir)
+    if args.tileconfig:
+        for dirname in (ply_dest_dir, cwipcdump_dest_dir):
+            if dirname:
+                shutil.copyfile(args.tileconfig, os.path.join(dirname, 'tileconfig.json'))
+    manifest = build_manifest.Manifest(args.manifest or build_manifest.default_manifest_filename(ply_dest_dir, cwicpc_dest_dir, cwipcdump_dest_dir))
         
-        timestamp += TIME_INCREMENT
-        count += 1
+    startTime = time.time()
+    count = 0
+    # Timestamps depend only on the position of a frame in the sorted sequence, so they
+    # are the same however many jobs are used.
+    # Only outputs that are missing or were made from a different source or with different
+    # parameters are (re)generated.
+    tasks = []
+    source_hashes = {}
+    skipped = 0
+    for index, filename in enumerate(list_source_files(loot_source_dir)):
+        pathname = os.path.join(loot_source_dir, filename)
+        timestamp = index*TIME_INCREMENT
+        source_hash = source_hashes[pathname] = manifest.source_hash(pathname)
+        outputs = [
+            output for output in frame_outputs(pathname, ply_dest_dir, cwicpc_dest_dir, cwipcdump_dest_dir)
+            if args.force or not manifest.is_current(output[1], source_hash, output_params(output, timestamp))
+        ]
+        if outputs:
+            tasks.append((pathname, timestamp, outputs))
+        else:
+            skipped += 1
+    manifest.save()
+    print("%d frames up to date, %d frames to convert" % (skipped, len(tasks)))
+
+    def done_callback(task):
+        pathname, timestamp, outputs = task
+        for output in outputs:
+            manifest.record(output[1], pathname, source_hashes[pathname], output_params(output, timestamp))
+        manifest.checkpoint()
+    
+    try:
+        if jobs == 1:
+            count = convert_pipelined(tasks, args.queue_size, done_callback)
+        else:
+            with multiprocessing.Pool(jobs, _worker_init, (TILEINFO, TILE_OVERLAP, transform)) as pool:
+                # imap returns results in frame order, so progress output is the same as for the serial run
+                for task in pool.imap(_worker_convert, tasks):
+                    print(task[0], 'done')
+                    done_callback(task)
+                    count += 1
+    finally:
+        manifest.save()
         
     now = time.time()
-    print("Converted %d pointclouds in %f seconds" % (count, now-startTime))
+    print("Converted %d pointclouds in %f seconds (%d jobs)" % (count, now-startTime, jobs))
     
 if __name__ == '__main__':
     main()
-    
-    
-    
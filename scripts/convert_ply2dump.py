@@ -1,11 +1,16 @@
 import sys
 import os
+import argparse
 import open3d
 import numpy as np
 import cwipc
 import cwipc.codec
 import cwipc.util
 import time
+import cwipc_numpy
+import stage_pipeline
+import build_manifest
+import analyze_bounds
 
 VOXEL_SIZE = 1    # Larger numbers mean smaller output size
 SCALE_FACTOR = 550  # Conversion factor from loot xyz values to our xyz values
@@ -43,47 +48,13 @@ def draw_o3d(o3dpc):
     
 def o3d_to_cwipc(o3dpc, timestamp):
     """Convert open3d pointcloud to cwipc pointcloud"""
-    # Note that this method is inefficient, it can probably be done
-    # in-place with some numpy magic
-    points = list(o3dpc.points)
-    colors = list(o3dpc.colors)
-    rv = []
-    pointsandcolors = zip(points, colors)
-    for (x, y, z), (r, g, b) in pointsandcolors:
-        if MAXTILES > 0:
-            if MAXTILES == 2:
-                side = 1 if x < 0 else 2
-            elif MAXTILES == 4:
-                if x < 0 and z < 0:
-                    side = 1
-                elif x < 0 and z >= 0:
-                    side = 2
-                elif x >= 0 and z < 0:
-                    side = 3
-                else:
-                    side = 4
-        r = int(r*255)
-        g = int(g*255)
-        b = int(b*255)
-        rv.append((x, y, z, r, g, b, side))
-    return cwipc.cwipc_from_points(rv, timestamp)
+    points = cwipc_numpy.o3d_to_numpy(o3dpc)
+    points['tile'] = cwipc_numpy.quadrant_tiles(points, MAXTILES)
+    return cwipc_numpy.numpy_to_cwipc(points, timestamp)
     
 def cwipc_to_o3d(pc):
     """Convert cwipc pointcloud to open3d pointcloud"""
-    # Note that this method is inefficient, it can probably be done
-    # in-place with some numpy magic
-    pcpoints = pc.get_points()
-    points = []
-    colors = []
-    for p in pcpoints:
-        points.append((p.x, p.y, p.z))  
-        colors.append((float(p.r)/255.0, float(p.g)/255.0, float(p.b)/255.0))
-    points_v = open3d.Vector3dVector(points)
-    colors_v = open3d.Vector3dVector(colors)
-    rv = open3d.PointCloud()
-    rv.points = points_v
-    rv.colors = colors_v
-    return rv
+    return cwipc_numpy.cwipc_to_o3d(pc)
     
 def write_ply_cwipc(filename, pc):
     """Write cwipc pointcloud to PLY file"""
@@ -93,49 +64,89 @@ def write_dump_cwipc(filename, pc):
     """Write cwipc pointcloud to PLY file"""
     cwipc.cwipc_write_debugdump(filename, pc)
     
+def output_params(timestamp, pointsize):
+    """Return all parameters that influence the content of a cwipcdump file"""
+    return dict(
+        kind='cwipcdump',
+        timestamp=timestamp,
+        pointsize=pointsize,
+        SCALE_FACTOR=SCALE_FACTOR,
+        TRANSLATE_X=TRANSLATE_X,
+        TRANSLATE_Y=TRANSLATE_Y,
+        TRANSLATE_Z=TRANSLATE_Z,
+        MAXTILES=MAXTILES,
+    )
+
 def main():
-    if len(sys.argv) < 3:
-        print('Usage: %s source-ply-dir dest-dump-dir [pointsize]' % sys.argv[0])
-        sys.exit(1)
-    loot_source_dir = sys.argv[1]
-    dump_dest_dir = sys.argv[2]
-    pointsize = 0
-    if len(sys.argv) > 3:
-        pointsize = float(sys.argv[3])
-    if not os.path.exists(dump_dest_dir):
-        os.mkdir(dump_dest_dir)
+    parser = argparse.ArgumentParser(description="Convert PLY sequence to cwipcdump files")
+    parser.add_argument("--transform", help="Use SCALE_FACTOR and TRANSLATE_X/Y/Z from this JSON file, made with analyze_bounds.py (default: the values for loot)")
+    parser.add_argument("--manifest", help="Manifest recording sources and parameters of all outputs (default: next to the output directory)")
+    parser.add_argument("--force", action="store_true", help="Regenerate all outputs, even those that are up to date")
+    parser.add_argument("loot_source_dir", help="Directory with source PLY files")
+    parser.add_argument("dump_dest_dir", help="Output directory for cwipcdump files")
+    parser.add_argument("pointsize", nargs="?", type=float, default=0, help="Cellsize of the points (default: 0)")
+    args = parser.parse_args()
+    if args.transform:
+        analyze_bounds.apply_transform(sys.modules[__name__], analyze_bounds.load_transform(args.transform))
+    loot_source_dir = args.loot_source_dir
+    dump_dest_dir = args.dump_dest_dir
+    pointsize = args.pointsize
+    os.makedirs(dump_dest_dir, exist_ok=True)
+    manifest = build_manifest.Manifest(args.manifest or build_manifest.default_manifest_filename(dump_dest_dir))
 
     startTime = time.time()
-    count = 0
-    timestamp = 0
     allfiles = os.listdir(loot_source_dir)
     allfiles.sort()
     
-            
-    for filename in allfiles:
-        if os.path.splitext(filename)[1] != '.ply':
-            continue
+    def dest_pathname(filename):
+        return os.path.join(dump_dest_dir, os.path.splitext(filename)[0] + '.cwipcdump')
+
+    def read_stage(task):
+        filename, timestamp, source_hash = task
         pathname = os.path.join(loot_source_dir, filename)
         print(pathname, '...')
-        basename = os.path.splitext(filename)[0]
-        dump_dest_pathname = os.path.join(dump_dest_dir, basename + '.cwipcdump')
         # Read original loot, downsample and scale.
-        o3dpc = read_loot_ply_o3d(pathname)
+        return task, read_loot_ply_o3d(pathname)
 
+    def transform_stage(item):
+        task, o3dpc = item
+        filename, timestamp, source_hash = task
         # Convert to cwipc
         pc = o3d_to_cwipc(o3dpc, timestamp)
-        
         # Set the pointsize (guessed)
         pc._set_cellsize(pointsize)
-        
-        #save as dump
-        write_dump_cwipc(dump_dest_pathname, pc)
-
+        return task, pc
 
+    def write_stage(item):
+        task, pc = item
+        filename, timestamp, source_hash = task
+        #save as dump
+        write_dump_cwipc(dest_pathname(filename), pc)
         pc.free()
-        
-        timestamp += TIME_INCREMENT
-        count += 1
+        manifest.record(dest_pathname(filename), os.path.join(loot_source_dir, filename), source_hash, output_params(timestamp, pointsize))
+        manifest.checkpoint()
+
+    # Only dumps that are missing or were made from a different source or with different
+    # parameters are (re)generated.
+    plyfiles = [filename for filename in allfiles if os.path.splitext(filename)[1] == '.ply']
+    tasks = []
+    for index, filename in enumerate(plyfiles):
+        timestamp = index*TIME_INCREMENT
+        source_hash = manifest.source_hash(os.path.join(loot_source_dir, filename))
+        if args.force or not manifest.is_current(dest_pathname(filename), source_hash, output_params(timestamp, pointsize)):
+            tasks.append((filename, timestamp, source_hash))
+    manifest.save()
+    print("%d frames up to date, %d frames to convert" % (len(plyfiles)-len(tasks), len(tasks)))
+    try:
+        stats = stage_pipeline.run_pipeline(tasks, [
+            ("read", read_stage),
+            ("transform", transform_stage),
+            ("write", write_stage)
+            ])
+    finally:
+        manifest.save()
+    stage_pipeline.print_stats(stats)
+    count = stats[-1].count
         
     now = time.time()
     print("Converted %d pointclouds in %f seconds" % (count, now-startTime))
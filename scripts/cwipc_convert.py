@@ -0,0 +1,372 @@
+"""Convert point cloud sequences with a configurable chain of stages.
+
+This replaces the hard-coded constants of convert_loot.py, convert_ply2dump.py and
+convert_grab.py with a chain built from the command line or a JSON config file:
+
+    read -> transform -> voxelize -> tile -> write/encode
+
+Example, equivalent to convert_loot.py:
+
+    python cwipc_convert.py --time-increment 33 \\
+        --stage voxelize:size=2.8 \\
+        --stage transform:scale=500,translate=[-0.45,0,-0.45],cellsize=0.0056 \\
+        --stage tile:maxtiles=4 \\
+        --stage write:format=ply,dir=lootPly \\
+        --stage encode:dir=lootCwicpc,tiles=[0,1,2,3,4] \\
+        --stage encode:dir=lootCwicpc,suffix=-low,octree_bits=7,jpeg_quality=60,tiles=[0,1,2,3,4] \\
+        ../loot/loot/Ply
+
+or with the same chain in a JSON file:
+
+    {
+        "input": "../loot/loot/Ply",
+        "stages": [
+            {"stage": "read", "time_increment": 33},
+            {"stage": "voxelize", "size": 2.8},
+            ...
+        ]
+    }
+
+The read stage is always first, wherever it appears: it sets the reader parameters
+(input, time_increment and pointsize for images), and the input argument and
+--time-increment override it. PLY files are read with plyreader.
+
+Stage parameter values are parsed as JSON where possible, and used as strings otherwise.
+Modules like cwipc.codec and PIL are only imported when a stage that needs them runs.
+"""
+import sys
+import os
+import re
+import json
+import abc
+import time
+import argparse
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import cwipc_numpy
+import plyreader
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+class Frame:
+    """A single point cloud as it moves through the stages"""
+
+    def __init__(self, name : str, points : np.ndarray, timestamp : int, cellsize : float = 0):
+        self.name = name
+        self.points = points
+        self.timestamp = timestamp
+        self.cellsize = cellsize
+        self._pc = None
+
+    def cwipc(self):
+        """Return (cached) cwipc pointcloud for the current points"""
+        if self._pc is None:
+            self._pc = cwipc_numpy.numpy_to_cwipc(self.points, self.timestamp, self.cellsize)
+        return self._pc
+
+    def invalidate(self) -> None:
+        """Forget the cached cwipc pointcloud, because the points have changed"""
+        if self._pc is not None:
+            self._pc.free()
+            self._pc = None
+
+class Stage(abc.ABC):
+    """Base class for stages. Subclasses implement process()"""
+    name = "stage"
+
+    @abc.abstractmethod
+    def process(self, frame : Frame) -> Frame:
+        """Process a frame, and return it (or a new frame)"""
+
+    def close(self) -> None:
+        pass
+
+class TransformStage(Stage):
+    """Scale and then translate all points, optionally set cellsize"""
+    name = "transform"
+
+    def __init__(self, scale : float = 1, translate : List[float] = [0, 0, 0], cellsize : Optional[float] = None):
+        self.scale = scale
+        self.translate = np.array(translate, dtype=np.float32)
+        self.cellsize = cellsize
+
+    def process(self, frame : Frame) -> Frame:
+        xyz = cwipc_numpy.xyz_view(frame.points)
+        xyz /= self.scale
+        xyz += self.translate
+        if self.cellsize is not None:
+            frame.cellsize = self.cellsize
+        elif frame.cellsize:
+            frame.cellsize /= self.scale
+        frame.invalidate()
+        return frame
+
+class VoxelizeStage(Stage):
+    """Voxel downsampling like open3d's (see cwipc_numpy.voxel_down_sample). Tile numbers are lost, so tile after voxelizing"""
+    name = "voxelize"
+
+    def __init__(self, size : float):
+        self.size = size
+
+    def process(self, frame : Frame) -> Frame:
+        frame.points = cwipc_numpy.voxel_down_sample(frame.points, self.size)
+        frame.invalidate()
+        return frame
+
+class TileStage(Stage):
+    """Assign tile numbers to points, from tileconfig.json normals or by legacy x/z quadrants"""
+    name = "tile"
+
+    def __init__(self, maxtiles : int = 4, tileconfig : Optional[str] = None, overlap : float = 0):
+        self.maxtiles = maxtiles
+        self.tileinfo = None
+        self.overlap = overlap
+        if tileconfig:
+            import tiling
+            self.tileinfo = tiling.load_tileconfig(tileconfig)
+
+    def process(self, frame : Frame) -> Frame:
+        if self.tileinfo:
+            import tiling
+            frame.points['tile'] = tiling.assign_tiles(frame.points, self.tileinfo, self.overlap)
+        else:
+            frame.points['tile'] = cwipc_numpy.quadrant_tiles(frame.points, self.maxtiles)
+        frame.invalidate()
+        return frame
+
+class WriteStage(Stage):
+    """Write uncompressed frames as ply or cwipcdump"""
+    name = "write"
+
+    def __init__(self, dir : str, format : str = "ply"):
+        if not format in ("ply", "cwipcdump"):
+            raise ValueError(f"write: unknown format {format}, ply and cwipcdump supported")
+        self.dir = dir
+        self.format = format
+        os.makedirs(dir, exist_ok=True)
+
+    def process(self, frame : Frame) -> Frame:
+        import cwipc
+        pathname = os.path.join(self.dir, f"{frame.name}.{self.format}")
+        if self.format == "ply":
+            cwipc.cwipc_write(pathname, frame.cwipc())
+        else:
+            cwipc.cwipc_write_debugdump(pathname, frame.cwipc())
+        return frame
+
+class EncodeStage(Stage):
+    """Compress frames with one encoder per tile, into directory dir+tile+suffix (no tile number for tile 0)"""
+    name = "encode"
+
+    def __init__(self, dir : str, tiles : List[int] = [0], suffix : str = "", octree_bits : int = 9, jpeg_quality : int = 85, macroblock_size : int = 16, voxelsize : float = 0):
+        import cwipc.codec
+        self.dirs = []
+        self.enc_group = cwipc.codec.cwipc_new_encodergroup()
+        self.encoders = []
+        for tile in tiles:
+            params = cwipc.codec.cwipc_encoder_params(False, 1, 1.0, octree_bits, jpeg_quality, macroblock_size, tile, voxelsize)
+            self.encoders.append(self.enc_group.addencoder(params=params))
+            dirname = dir + (str(tile) if tile else "") + suffix
+            os.makedirs(dirname, exist_ok=True)
+            self.dirs.append(dirname)
+
+    def process(self, frame : Frame) -> Frame:
+        self.enc_group.feed(frame.cwipc())
+        for encoder, dirname in zip(self.encoders, self.dirs):
+            ok = encoder.available(True)
+            assert ok
+            with open(os.path.join(dirname, frame.name + ".cwicpc"), "wb") as ofp:
+                ofp.write(encoder.get_bytes())
+        return frame
+
+STAGES = {cls.name : cls for cls in (TransformStage, VoxelizeStage, TileStage, WriteStage, EncodeStage)}
+
+class ReadStage:
+    """Source of the chain: reads all ply, cwipcdump and image files in a directory (or a single file), in sorted order.
+    PLY files are read with plyreader, images become a vertical plane of points pointsize meters apart"""
+    name = "read"
+
+    def __init__(self, input : str, time_increment : int = 33, pointsize : float = 0.01):
+        self.input = input
+        self.time_increment = time_increment
+        self.pointsize = pointsize
+
+    def frames(self) -> Iterator[Frame]:
+        if os.path.isdir(self.input):
+            filenames = sorted(os.listdir(self.input))
+            pathnames = [os.path.join(self.input, fn) for fn in filenames]
+        else:
+            pathnames = [self.input]
+        timestamp = 0
+        for pathname in pathnames:
+            name, ext = os.path.splitext(os.path.basename(pathname))
+            ext = ext.lower()
+            if ext == ".ply":
+                frame = Frame(name, plyreader.read_ply(pathname), timestamp)
+            elif ext == ".cwipcdump":
+                frame = self._read_debugdump(name, pathname, timestamp)
+            elif ext in (".png", ".jpg", ".jpeg"):
+                frame = Frame(name, self._read_image(pathname), timestamp)
+            else:
+                continue
+            yield frame
+            timestamp += self.time_increment
+
+    def _read_debugdump(self, name : str, pathname : str, timestamp : int) -> Frame:
+        import cwipc
+        pc = cwipc.cwipc_read_debugdump(pathname)
+        points = cwipc_numpy.cwipc_to_numpy(pc)
+        if not points.flags.writeable:
+            points = points.copy()
+        frame = Frame(name, points, timestamp, pc.cellsize())
+        pc.free()
+        return frame
+
+    def _read_image(self, pathname : str) -> np.ndarray:
+        import convert_image
+        return convert_image.image_to_points(convert_image.read_image(pathname), self.pointsize)
+
+def parse_stage_spec(spec : str) -> Dict[str, Any]:
+    """Parse name:key=value,key=value into a stage config dict. Values are JSON if possible"""
+    name, _, rest = spec.partition(":")
+    rv : Dict[str, Any] = dict(stage=name)
+    # Split on commas not inside brackets, so lists can be passed as values
+    for item in re.findall(r'(?:[^,\[]|\[[^\]]*\])+', rest):
+        key, _, value = item.partition("=")
+        try:
+            rv[key] = json.loads(value)
+        except ValueError:
+            rv[key] = value
+    return rv
+
+def build_stages(stage_configs : List[Dict[str, Any]]) -> List[Stage]:
+    """Instantiate the stages from their config dicts"""
+    rv = []
+    for config in stage_configs:
+        config = dict(config)
+        name = config.pop("stage")
+        if not name in STAGES:
+            raise ValueError(f"Unknown stage {name}, known stages: {', '.join(STAGES)}")
+        rv.append(STAGES[name](**config))
+    return rv
+
+def build_reader(stage_configs : List[Dict[str, Any]], defaults : Dict[str, Any]) -> Tuple[Optional[ReadStage], List[Dict[str, Any]]]:
+    """Instantiate the reader from defaults updated with any read stage configs.
+    Returns the reader (None if there is no input) and the remaining stage configs"""
+    reader_config = dict(defaults)
+    rest = []
+    for config in stage_configs:
+        if config["stage"] == ReadStage.name:
+            reader_config.update(config)
+        else:
+            rest.append(config)
+    reader_config.pop("stage", None)
+    if not reader_config.get("input"):
+        return None, rest
+    return ReadStage(**reader_config), rest
+
+class StageProfile:
+    """Accumulated wall time, points and largest RSS increase for a single stage"""
+
+    def __init__(self, name : str):
+        self.name = name
+        self.seconds = 0.0
+        self.points = 0
+        self.rss_growth = 0
+
+    def add(self, seconds : float, npoints : int, rss_before : int, rss_after : int) -> None:
+        self.seconds += seconds
+        self.points += npoints
+        self.rss_growth = max(self.rss_growth, rss_after - rss_before)
+
+def current_rss() -> int:
+    """Current resident set size of this process in bytes, or 0 if unknown"""
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    return 0
+
+def peak_rss() -> int:
+    """Peak resident set size of this process in bytes, or 0 if unknown"""
+    if resource is None:
+        return 0
+    rv = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rv if sys.platform == "darwin" else rv*1024
+
+def print_profile(profiles : List[StageProfile], file=sys.stdout) -> None:
+    print(f"{'stage':12s} {'seconds':>9s} {'points/s':>12s} {'RSS growth':>10s}", file=file)
+    for p in profiles:
+        pps = p.points / p.seconds if p.seconds else 0
+        print(f"{p.name:12s} {p.seconds:9.2f} {pps:12.0f} {p.rss_growth/(1<<20):8.0f}MB", file=file)
+    print(f"process peak RSS {peak_rss()/(1<<20):.0f}MB", file=file)
+
+def convert(reader : ReadStage, stages : List[Stage], profile : bool = False) -> int:
+    """Run all frames from the reader through the stages. Returns number of frames converted"""
+    profiles = [StageProfile(reader.name)] + [StageProfile(stage.name) for stage in stages]
+    count = 0
+    frames = reader.frames()
+    while True:
+        rss = current_rss() if profile else 0
+        t0 = time.perf_counter()
+        frame = next(frames, None)
+        if frame is None:
+            break
+        t1 = time.perf_counter()
+        rss_after = current_rss() if profile else 0
+        profiles[0].add(t1-t0, len(frame.points), rss, rss_after)
+        print(f"{frame.name} ...")
+        for stage, prof in zip(stages, profiles[1:]):
+            rss = rss_after
+            t0 = time.perf_counter()
+            frame = stage.process(frame)
+            t1 = time.perf_counter()
+            rss_after = current_rss() if profile else 0
+            prof.add(t1-t0, len(frame.points), rss, rss_after)
+        frame.invalidate()
+        count += 1
+    for stage in stages:
+        stage.close()
+    if profile:
+        print_profile(profiles)
+    return count
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert point cloud sequence through a chain of stages", epilog=f"Stages: {', '.join([ReadStage.name] + list(STAGES))}")
+    parser.add_argument("--config", help="JSON file with input, time_increment and stages")
+    parser.add_argument("--stage", action="append", default=[], metavar="NAME:KEY=VALUE,...", help="Add a stage (after those from --config). A read stage configures the reader")
+    parser.add_argument("--time-increment", type=int, help="Timestamp increment between frames in ms (default: 33)")
+    parser.add_argument("--profile", action="store_true", help="Print wall time, points/s and largest RSS increase per stage")
+    parser.add_argument("input", nargs="?", help="Input directory or file (ply, cwipcdump or image)")
+    args = parser.parse_args()
+    config : Dict[str, Any] = {}
+    if args.config:
+        with open(args.config) as fp:
+            config = json.load(fp)
+    defaults = {key : config[key] for key in ("input", "time_increment") if key in config}
+    stage_configs = config.get("stages", []) + [parse_stage_spec(spec) for spec in args.stage]
+    if args.input:
+        stage_configs.append(dict(stage=ReadStage.name, input=args.input))
+    if args.time_increment is not None:
+        stage_configs.append(dict(stage=ReadStage.name, time_increment=args.time_increment))
+    reader, stage_configs = build_reader(stage_configs, defaults)
+    if reader is None:
+        parser.error("No input specified")
+    stages = build_stages(stage_configs)
+    startTime = time.time()
+    count = convert(reader, stages, args.profile)
+    print(f"Converted {count} pointclouds in {time.time()-startTime:f} seconds")
+
+if __name__ == "__main__":
+    main()
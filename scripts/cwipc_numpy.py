@@ -0,0 +1,140 @@
+"""Move point data between cwipc, open3d and NumPy as whole arrays.
+
+All conversions work on a NumPy structured array with the same memory layout
+as a cwipc_point (x, y, z as float32, r, g, b, tile as uint8, 16 bytes per point),
+so there are no per-point Python objects and at most one copy per conversion.
+
+cwipc and open3d are only imported when a function that needs them is called.
+"""
+import numpy as np
+
+POINT_DTYPE = np.dtype([
+    ('x', np.float32),
+    ('y', np.float32),
+    ('z', np.float32),
+    ('r', np.uint8),
+    ('g', np.uint8),
+    ('b', np.uint8),
+    ('tile', np.uint8),
+])
+assert POINT_DTYPE.itemsize == 16
+
+def empty_points(npoints):
+    """Return an uninitialized structured point array of npoints points"""
+    return np.empty(npoints, dtype=POINT_DTYPE)
+
+def xyz_view(points):
+    """Return an (N, 3) float32 view (no copy) on the coordinates of a point array"""
+    assert points.dtype == POINT_DTYPE and points.flags.c_contiguous
+    return np.ndarray((len(points), 3), dtype=np.float32, buffer=points, strides=(POINT_DTYPE.itemsize, 4))
+
+def rgb_view(points):
+    """Return an (N, 3) uint8 view (no copy) on the colors of a point array"""
+    assert points.dtype == POINT_DTYPE and points.flags.c_contiguous
+    return np.ndarray((len(points), 3), dtype=np.uint8, buffer=points, offset=POINT_DTYPE.fields['r'][1], strides=(POINT_DTYPE.itemsize, 1))
+
+def quadrant_tiles(points, maxtiles):
+    """Compute legacy tile numbers (1..maxtiles) from the sign of x (and z) for a whole point array"""
+    if maxtiles == 2:
+        return np.where(points['x'] < 0, 1, 2).astype(np.uint8)
+    if maxtiles == 4:
+        # x<0,z<0 -> 1; x<0,z>=0 -> 2; x>=0,z<0 -> 3; x>=0,z>=0 -> 4
+        return (1 + 2*(points['x'] >= 0) + (points['z'] >= 0)).astype(np.uint8)
+    return np.zeros(len(points), dtype=np.uint8)
+
+def cwipc_to_numpy(pc):
+    """Return the points of a cwipc pointcloud as a structured array.
+
+    The single copy is the one cwipc makes from its internal representation into
+    the buffer returned by get_bytes(); the array is a view on that buffer and stays
+    valid after pc.free().
+    """
+    return np.frombuffer(pc.get_bytes(), dtype=POINT_DTYPE)
+
+def numpy_to_cwipc(points, timestamp, cellsize=None):
+    """Create a cwipc pointcloud from a structured point array.
+
+    The array is handed to cwipc as a ctypes array sharing its memory, the only
+    copy is the one cwipc makes into its own pointcloud.
+    """
+    import cwipc
+    import cwipc.util
+    points = np.require(points, dtype=POINT_DTYPE, requirements=['C', 'W'])
+    cpoints = (cwipc.util.cwipc_point * len(points)).from_buffer(points)
+    rv = cwipc.cwipc_from_points(cpoints, timestamp)
+    if cellsize is not None:
+        rv._set_cellsize(cellsize)
+    return rv
+
+def voxel_down_sample(points, voxel_size):
+    """Voxel downsample a point array the way open3d's voxel_down_sample does, without open3d.
+
+    The grid starts half a voxel below the minimum coordinate. Every occupied voxel
+    becomes one point with the mean position and color of its points, where colors
+    are averaged as 0..1 values and truncated back to 0..255, like a round trip
+    through o3d_to_numpy would. Tiles are set to 0. Points come out in voxel order,
+    not in open3d's (unspecified) order.
+    """
+    npoints = len(points)
+    if npoints == 0:
+        return empty_points(0)
+    # Voxel keys are built one axis at a time so only one float64 coordinate column exists at once
+    keys = np.zeros(npoints, dtype=np.int64)
+    for field in 'xyz':
+        coord = points[field].astype(np.float64)
+        cell = np.floor((coord - (coord.min() - voxel_size * 0.5)) / voxel_size).astype(np.int64)
+        keys *= int(cell.max()) + 1
+        keys += cell
+    del coord, cell
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    del keys
+    inverse = inverse.ravel()
+    nvoxels = len(counts)
+    rv = empty_points(nvoxels)
+    for field in 'xyz':
+        rv[field] = np.bincount(inverse, points[field], nvoxels) / counts
+    for field in 'rgb':
+        np.multiply(np.bincount(inverse, points[field] / 255.0, nvoxels) / counts, 255, out=rv[field], casting='unsafe')
+    rv['tile'] = 0
+    return rv
+
+def o3d_to_numpy(o3dpc, tiles=None):
+    """Convert open3d pointcloud to a structured point array.
+
+    Coordinates and colors are converted straight from the open3d buffers into the
+    fields of the result, without intermediate arrays.
+    """
+    points = np.asarray(o3dpc.points)
+    colors = np.asarray(o3dpc.colors)
+    rv = empty_points(len(points))
+    xyz_view(rv)[:] = points
+    if len(colors) == len(points):
+        np.multiply(colors, 255, out=rgb_view(rv), casting='unsafe')
+    else:
+        rgb_view(rv)[:] = 0
+    rv['tile'] = 0 if tiles is None else tiles
+    return rv
+
+def numpy_to_o3d(points):
+    """Convert a structured point array to an open3d pointcloud.
+
+    open3d only accepts (N, 3) float64 data and always copies it, so this makes one
+    float64 array for coordinates and one for colors and lets open3d copy those.
+    """
+    import open3d
+    xyz = np.empty((len(points), 3), dtype=np.float64)
+    xyz[:] = xyz_view(points)
+    rgb = np.empty((len(points), 3), dtype=np.float64)
+    np.divide(rgb_view(points), 255.0, out=rgb)
+    rv = open3d.geometry.PointCloud()
+    rv.points = open3d.utility.Vector3dVector(xyz)
+    rv.colors = open3d.utility.Vector3dVector(rgb)
+    return rv
+
+def cwipc_to_o3d(pc):
+    """Convert cwipc pointcloud to open3d pointcloud"""
+    return numpy_to_o3d(cwipc_to_numpy(pc))
+
+def o3d_to_cwipc(o3dpc, timestamp, tiles=None, cellsize=None):
+    """Convert open3d pointcloud to cwipc pointcloud"""
+    return numpy_to_cwipc(o3d_to_numpy(o3dpc, tiles), timestamp, cellsize)
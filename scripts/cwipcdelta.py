@@ -0,0 +1,326 @@
+"""Lossless keyframe + delta storage (.cwipcdelta) for uncompressed point cloud sequences.
+
+Voxelized sequences like loot-150K-4tiles store every frame as a full .cwipcdump,
+while most voxels are the same as in the previous frame. A .cwipcdelta file stores
+every --keyframe-interval'th frame whole, and for the frames in between only what
+changed since the previous frame:
+
+    removed     points of the previous frame that are gone (indices into it)
+    recolored   points at the same position with another color or tile (index and r, g, b, tile)
+    added       new points (whole 16-byte points)
+
+Every frame is kept sorted on the 16 bytes of its points, so unchanged points are
+found with a binary search of one sorted frame in the other, and points with the same
+position (the first 12 bytes: one voxel) but another color in the same way. Decoding
+only sorts the added and recolored points and merges them into the previous frame. All frame payloads are zlib compressed with the 16 bytes of a point
+stored as byte planes. Decoding is exact, except that points come out in sorted order
+instead of the original order.
+
+The file layout is like .cwipcseq (see cwipcseq.py): a 64-byte header, the frame
+payloads, an index (offset, length, timestamp, cellsize, point count, kind per frame)
+and JSON metadata. Random access decodes from the preceding keyframe, sequential access
+applies one delta per frame.
+
+    python cwipcdelta.py encode ../Samples/loot-150K-4tiles loot-150K-4tiles.cwipcdelta
+    python cwipcdelta.py info loot-150K-4tiles.cwipcdelta
+    python cwipcdelta.py decode loot-150K-4tiles.cwipcdelta loot-copy
+"""
+import os
+import mmap
+import json
+import zlib
+import time
+import struct
+import argparse
+from typing import List, Optional, Tuple
+import numpy as np
+import cwipc_numpy
+
+MAGIC = b"CWIPCDLT"
+VERSION = 1
+# magic, version, nframes, keyframe_interval, index_offset, metadata_offset, metadata_length
+HEADER = struct.Struct("<8sIIIQQQ")
+HEADER_SIZE = 64
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8'), ('timestamp', '<i8'), ('cellsize', '<f8'), ('npoints', '<u4'), ('kind', '<u4')])
+KEYFRAME = 0
+DELTA = 1
+# nremoved, nrecolored, nadded
+DELTA_HEADER = struct.Struct("<III")
+KEYFRAME_INTERVAL = 30
+FRAME_EXTENSIONS = ('.cwipcdump', '.ply')
+POINT_SIZE = cwipc_numpy.POINT_DTYPE.itemsize
+RECORD_DTYPE = np.dtype('V16')
+POSITION_DTYPE = np.dtype('V12')
+
+def _records(points : np.ndarray) -> np.ndarray:
+    """View a point array as 16-byte records, which sort in a fixed order (the bytes of x, y, z, r, g, b, tile)"""
+    return np.ascontiguousarray(points).view(RECORD_DTYPE).reshape(len(points))
+
+def _positions(records : np.ndarray) -> np.ndarray:
+    """View (no copy) on the first 12 bytes (x, y, z) of records"""
+    return np.ndarray(len(records), dtype=POSITION_DTYPE, buffer=records, strides=(POINT_SIZE,))
+
+def sort_points(points : np.ndarray) -> np.ndarray:
+    """Return the points as records, sorted"""
+    return np.sort(_records(points))
+
+def match_sorted(a : np.ndarray, b : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return boolean masks of the elements of sorted a and sorted b that have a partner in the other.
+
+    Equal elements are paired in order, so with duplicates only as many are matched as
+    the other array has.
+    """
+    left = np.searchsorted(a, b, side='left')
+    right = np.searchsorted(a, b, side='right')
+    # Occurrence of every element of b among its equals
+    occurrence = np.arange(len(b)) - np.searchsorted(b, b, side='left')
+    b_matched = occurrence < right - left
+    a_matched = np.zeros(len(a), dtype=bool)
+    a_matched[left[b_matched] + occurrence[b_matched]] = True
+    return a_matched, b_matched
+
+def _planes(points : np.ndarray) -> bytes:
+    """The bytes of a point array as 16 byte planes, which compress much better than whole points"""
+    return np.ascontiguousarray(points).view(np.uint8).reshape(len(points), POINT_SIZE).T.tobytes()
+
+def _from_planes(data, count : int) -> np.ndarray:
+    planes = np.frombuffer(data, dtype=np.uint8, count=count*POINT_SIZE).reshape(POINT_SIZE, count)
+    return np.ascontiguousarray(planes.T).view(cwipc_numpy.POINT_DTYPE).reshape(count)
+
+def _encode_indices(indices : np.ndarray) -> bytes:
+    """Sorted indices as uint32 differences"""
+    return np.diff(indices, prepend=0).astype('<u4').tobytes()
+
+def _decode_indices(data, count : int, offset : int) -> np.ndarray:
+    return np.cumsum(np.frombuffer(data, dtype='<u4', count=count, offset=offset), dtype=np.int64)
+
+def encode_delta(previous : np.ndarray, current : np.ndarray) -> bytes:
+    """Return the (uncompressed) delta from previous to current, both sorted records"""
+    unchanged_previous, unchanged_current = match_sorted(previous, current)
+    removed = np.flatnonzero(~unchanged_previous)
+    added = current[~unchanged_current]
+    # A removed and an added point at the same position is a recolor (or new tile)
+    recolor_removed, recolor_added = match_sorted(_positions(previous[removed]), _positions(added))
+    recolored = removed[recolor_removed]
+    colors = added[recolor_added].view(np.uint8).reshape(-1, POINT_SIZE)[:, 12:16]
+    removed = removed[~recolor_removed]
+    added = added[~recolor_added]
+    return b"".join((
+        DELTA_HEADER.pack(len(removed), len(recolored), len(added)),
+        _encode_indices(removed),
+        _encode_indices(recolored),
+        colors.T.tobytes(),
+        _planes(added),
+    ))
+
+def apply_delta(previous : np.ndarray, data) -> np.ndarray:
+    """Return the frame after previous (sorted records) from an uncompressed delta, as sorted records"""
+    nremoved, nrecolored, nadded = DELTA_HEADER.unpack_from(data, 0)
+    offset = DELTA_HEADER.size
+    removed = _decode_indices(data, nremoved, offset)
+    offset += 4*nremoved
+    recolored = _decode_indices(data, nrecolored, offset)
+    offset += 4*nrecolored
+    colors = np.frombuffer(data, dtype=np.uint8, count=4*nrecolored, offset=offset).reshape(4, nrecolored).T
+    offset += 4*nrecolored
+    added = _records(_from_planes(memoryview(data)[offset:], nadded))
+    changed = previous[recolored].copy()
+    changed.view(np.uint8).reshape(-1, POINT_SIZE)[:, 12:16] = colors
+    keep = np.ones(len(previous), dtype=bool)
+    keep[removed] = False
+    keep[recolored] = False
+    # Only the few new and recolored points need sorting, the rest stays in order
+    kept = previous[keep]
+    inserted = np.sort(np.concatenate((changed, added)))
+    return np.insert(kept, np.searchsorted(kept, inserted), inserted)
+
+class DeltaWriter:
+    """Write frames to a new .cwipcdelta file, one at a time"""
+
+    def __init__(self, filename : str, keyframe_interval : int = KEYFRAME_INTERVAL, level : int = 6):
+        self.filename = filename
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.level = level
+        self.fp = open(filename, 'wb')
+        self.fp.write(bytes(HEADER_SIZE))
+        self.offset = HEADER_SIZE
+        self.index : List[Tuple] = []
+        self.names : List[str] = []
+        self.previous : Optional[np.ndarray] = None
+        self.raw_bytes = 0
+
+    def add_frame(self, points : np.ndarray, timestamp : int, cellsize : float = 0, name : str = "") -> None:
+        """Append one frame"""
+        current = sort_points(points)
+        if len(self.index) % self.keyframe_interval == 0:
+            kind = KEYFRAME
+            payload = _planes(current)
+        else:
+            kind = DELTA
+            payload = encode_delta(self.previous, current)
+        data = zlib.compress(payload, self.level)
+        self.fp.write(data)
+        self.index.append((self.offset, len(data), timestamp, cellsize, len(points), kind))
+        self.names.append(name)
+        self.offset += len(data)
+        self.raw_bytes += len(points) * POINT_SIZE
+        self.previous = current
+
+    def close(self) -> None:
+        """Write index, metadata and header"""
+        index = np.array(self.index, dtype=INDEX_DTYPE)
+        index_offset = self.offset
+        self.fp.write(index.tobytes())
+        metadata_offset = index_offset + index.nbytes
+        metadata = json.dumps(dict(names=self.names)).encode('utf8')
+        self.fp.write(metadata)
+        self.fp.seek(0)
+        self.fp.write(HEADER.pack(MAGIC, VERSION, len(self.index), self.keyframe_interval, index_offset, metadata_offset, len(metadata)))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class DeltaSequence:
+    """Memory-mapped random access to a .cwipcdelta file"""
+
+    def __init__(self, filename : str):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nframes, self.keyframe_interval, index_offset, metadata_offset, metadata_length = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename}: not a cwipcdelta file")
+        if version != VERSION:
+            raise ValueError(f"{filename}: unsupported cwipcdelta version {version}")
+        self.index = np.frombuffer(self.mmap, dtype=INDEX_DTYPE, count=nframes, offset=index_offset).copy()
+        self.metadata = json.loads(bytes(self.mmap[metadata_offset:metadata_offset+metadata_length]))
+        self.keyframes = np.flatnonzero(self.index['kind'] == KEYFRAME)
+        # The last decoded frame, so sequential access applies one delta per frame
+        self._cached : Optional[Tuple[int, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _payload(self, i : int) -> bytes:
+        offset, length = int(self.index['offset'][i]), int(self.index['length'][i])
+        return zlib.decompress(self.mmap[offset:offset+length])
+
+    def _decode(self, i : int) -> np.ndarray:
+        """Return frame i as sorted records"""
+        if i < 0 or i >= len(self):
+            raise IndexError(f"frame {i} out of range")
+        keyframe = int(self.keyframes[np.searchsorted(self.keyframes, i, side='right') - 1])
+        if self._cached is not None and keyframe <= self._cached[0] <= i:
+            start, current = self._cached
+        else:
+            start = keyframe
+            current = _records(_from_planes(self._payload(start), int(self.index['npoints'][start])))
+        for j in range(start+1, i+1):
+            current = apply_delta(current, self._payload(j))
+        self._cached = (i, current)
+        return current
+
+    def points(self, i : int) -> np.ndarray:
+        """Return frame i as a point array (in sorted order). Do not modify it, it is cached"""
+        return self._decode(i).view(cwipc_numpy.POINT_DTYPE)
+
+    def frame(self, i : int) -> Tuple[np.ndarray, int, float]:
+        """Return (points, timestamp, cellsize) of frame i"""
+        return self.points(i), int(self.index['timestamp'][i]), float(self.index['cellsize'][i])
+
+    def name(self, i : int) -> str:
+        return self.metadata['names'][i]
+
+    def close(self) -> None:
+        self._cached = None
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_frame(filename : str) -> Tuple[np.ndarray, int, float]:
+    """Read a .cwipcdump or .ply file. Returns points, timestamp and cellsize"""
+    if filename.endswith('.ply'):
+        import plyreader
+        return plyreader.read_ply(filename), 0, 0
+    import cwipc
+    pc = cwipc.cwipc_read_debugdump(filename)
+    points = cwipc_numpy.cwipc_to_numpy(pc)
+    rv = points, pc.timestamp(), pc.cellsize()
+    pc.free()
+    return rv
+
+def encode(dirname : str, filename : str, keyframe_interval : int = KEYFRAME_INTERVAL, level : int = 6) -> Tuple[int, int]:
+    """Encode all frames of a directory. Returns number of frames and bytes of uncompressed points"""
+    frames = [fn for fn in sorted(os.listdir(dirname)) if os.path.splitext(fn)[1] in FRAME_EXTENSIONS]
+    with DeltaWriter(filename, keyframe_interval, level) as writer:
+        for fn in frames:
+            points, timestamp, cellsize = read_frame(os.path.join(dirname, fn))
+            writer.add_frame(points, timestamp, cellsize, fn)
+    return len(frames), writer.raw_bytes
+
+def decode(filename : str, dirname : str) -> int:
+    """Write all frames as .cwipcdump files. Returns number of frames"""
+    import cwipc
+    os.makedirs(dirname, exist_ok=True)
+    with DeltaSequence(filename) as sequence:
+        for i in range(len(sequence)):
+            points, timestamp, cellsize = sequence.frame(i)
+            name = os.path.splitext(sequence.name(i) or f"pointcloud-{i:04d}")[0] + '.cwipcdump'
+            pc = cwipc_numpy.numpy_to_cwipc(points.copy(), timestamp, cellsize or None)
+            cwipc.cwipc_write_debugdump(os.path.join(dirname, name), pc)
+            pc.free()
+        return len(sequence)
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode, decode and inspect lossless keyframe+delta point cloud sequences")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("encode", help="Encode a directory of .cwipcdump (or .ply) frames")
+    p.add_argument("--keyframe-interval", type=int, default=KEYFRAME_INTERVAL, help=f"Store every this many frames whole (default: {KEYFRAME_INTERVAL})")
+    p.add_argument("--level", type=int, default=6, help="zlib compression level (default: 6)")
+    p.add_argument("dir")
+    p.add_argument("file")
+    p = subparsers.add_parser("decode", help="Decode to a directory of .cwipcdump files")
+    p.add_argument("file")
+    p.add_argument("dir")
+    p = subparsers.add_parser("info", help="Print frame kinds and sizes, and measure decoding speed")
+    p.add_argument("file")
+    args = parser.parse_args()
+    if args.command == "encode":
+        startTime = time.time()
+        count, raw = encode(args.dir, args.file, args.keyframe_interval, args.level)
+        size = os.path.getsize(args.file)
+        print(f"{args.file}: {count} frames, {size} bytes ({raw/max(size, 1):.1f}x smaller than the points) in {time.time()-startTime:.1f} seconds")
+    elif args.command == "decode":
+        count = decode(args.file, args.dir)
+        print(f"{args.dir}: {count} frames")
+    else:
+        with DeltaSequence(args.file) as sequence:
+            n = len(sequence)
+            raw = int(sequence.index['npoints'].sum()) * POINT_SIZE
+            size = os.path.getsize(args.file)
+            print(f"{args.file}: {n} frames ({len(sequence.keyframes)} keyframes), {size} bytes, {raw/max(size, 1):.1f}x smaller than the points")
+            if n:
+                kinds = sequence.index['kind']
+                for kind, label in ((KEYFRAME, "keyframe"), (DELTA, "delta")):
+                    lengths = sequence.index['length'][kinds == kind]
+                    if len(lengths):
+                        print(f"{label}: {len(lengths)} frames, mean {lengths.mean():.0f} bytes")
+                t0 = time.perf_counter()
+                for i in range(n):
+                    sequence.points(i)
+                sequential = time.perf_counter() - t0
+                t0 = time.perf_counter()
+                sequence._cached = None
+                sequence.points(n-1)
+                print(f"sequential decode: {n/sequential:.1f} frames/s, random access to frame {n-1}: {1000*(time.perf_counter()-t0):.1f} ms")
+
+if __name__ == '__main__':
+    main()
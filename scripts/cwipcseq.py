@@ -0,0 +1,228 @@
+"""Single-file point cloud sequence archive (.cwipcseq) with an offset/timestamp index.
+
+A sample set is normally a directory with hundreds of small .cwipcdump or .cwicpc
+files. A .cwipcseq archive holds all those frames in one file:
+
+    header      64 bytes: magic, version, frame count, index and metadata location
+    frames      each frame starts at a 64-byte aligned offset
+    index       per frame: offset, length, timestamp (little-endian uint64, uint64, int64)
+    metadata    JSON: original filenames, frame file extension, other small files
+                (like tileconfig.json)
+
+SequenceArchive mmaps the archive and hands out frames as memoryview slices of the
+mapping, so random access and looped playback need no system calls per frame.
+
+Usage:
+
+    python cwipcseq.py pack ../Samples/loot-compressed/depth7 depth7.cwipcseq
+    python cwipcseq.py unpack depth7.cwipcseq depth7-copy
+    python cwipcseq.py info depth7.cwipcseq
+"""
+import os
+import mmap
+import json
+import base64
+import struct
+import argparse
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+
+MAGIC = b"CWIPCSEQ"
+VERSION = 1
+ALIGNMENT = 64
+# magic, version, nframes, index_offset, metadata_offset, metadata_length
+HEADER = struct.Struct("<8sIIQQQ")
+HEADER_SIZE = 64
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u8'), ('timestamp', '<i8')])
+FRAME_EXTENSIONS = ('.cwipcdump', '.cwicpc', '.ply')
+MAX_EXTRA_FILE_SIZE = 1<<20
+
+def _align(offset : int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class SequenceWriter:
+    """Write frames to a new archive, one at a time"""
+
+    def __init__(self, filename : str):
+        self.filename = filename
+        self.fp = open(filename, 'wb')
+        self.fp.write(bytes(HEADER_SIZE))
+        self.offset = HEADER_SIZE
+        self.index : List[Tuple[int, int, int]] = []
+        self.names : List[str] = []
+        self.extension : Optional[str] = None
+        self.extra : Dict[str, str] = {}
+
+    def add_frame(self, data : bytes, timestamp : int, name : str = "") -> None:
+        """Append one frame"""
+        padding = _align(self.offset) - self.offset
+        if padding:
+            self.fp.write(bytes(padding))
+            self.offset += padding
+        self.fp.write(data)
+        self.index.append((self.offset, len(data), timestamp))
+        self.names.append(name)
+        self.offset += len(data)
+
+    def add_extra_file(self, name : str, data : bytes) -> None:
+        """Store a small non-frame file (like tileconfig.json) in the metadata"""
+        self.extra[name] = base64.b64encode(data).decode('ascii')
+
+    def close(self) -> None:
+        """Write index, metadata and header"""
+        padding = _align(self.offset) - self.offset
+        self.fp.write(bytes(padding))
+        index_offset = self.offset + padding
+        index = np.array(self.index, dtype=INDEX_DTYPE)
+        self.fp.write(index.tobytes())
+        metadata_offset = index_offset + index.nbytes
+        metadata = json.dumps(dict(names=self.names, extension=self.extension, extra=self.extra)).encode('utf8')
+        self.fp.write(metadata)
+        self.fp.seek(0)
+        self.fp.write(HEADER.pack(MAGIC, VERSION, len(self.index), index_offset, metadata_offset, len(metadata)))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class SequenceArchive:
+    """Memory-mapped read access to an archive. Frames are zero-copy memoryview slices"""
+
+    def __init__(self, filename : str):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nframes, index_offset, metadata_offset, metadata_length = HEADER.unpack_from(self.mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{filename}: not a cwipcseq archive")
+        if version != VERSION:
+            raise ValueError(f"{filename}: unsupported cwipcseq version {version}")
+        self.index = np.frombuffer(self.mmap, dtype=INDEX_DTYPE, count=nframes, offset=index_offset)
+        self.metadata = json.loads(bytes(self.mmap[metadata_offset:metadata_offset+metadata_length]))
+        self.view = memoryview(self.mmap)
+        # Plain Python lists make per-frame lookups cheaper than indexing the numpy array
+        self._offsets = self.index['offset'].tolist()
+        self._ends = (self.index['offset'] + self.index['length']).tolist()
+        self._timestamps = self.index['timestamp'].tolist()
+        if hasattr(self.mmap, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+            self.mmap.madvise(mmap.MADV_WILLNEED)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def frame(self, i : int) -> memoryview:
+        """Return frame i as a memoryview on the mapping (no copy)"""
+        return self.view[self._offsets[i]:self._ends[i]]
+
+    def timestamp(self, i : int) -> int:
+        return self._timestamps[i]
+
+    def name(self, i : int) -> str:
+        return self.metadata['names'][i]
+
+    def find(self, timestamp : int) -> int:
+        """Return index of the last frame with a timestamp not after the given one"""
+        return max(0, int(np.searchsorted(self.index['timestamp'], timestamp, side='right')) - 1)
+
+    def frames(self, loop : bool = False) -> Iterator[Tuple[int, memoryview]]:
+        """Yield (timestamp, data) for all frames, forever if loop is True"""
+        while True:
+            for i in range(len(self)):
+                yield self._timestamps[i], self.view[self._offsets[i]:self._ends[i]]
+            if not loop or len(self) == 0:
+                break
+
+    def extra_files(self) -> Dict[str, bytes]:
+        return {name : base64.b64decode(data) for name, data in self.metadata.get('extra', {}).items()}
+
+    def close(self) -> None:
+        """Close the mapping. If frames handed out are still referenced it is unmapped when they are released"""
+        self.index = None
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def pack(dirname : str, filename : str, time_increment : int = 33) -> int:
+    """Pack all frames (and small other files) of a directory into an archive. Returns number of frames"""
+    allfiles = sorted(os.listdir(dirname))
+    frames = [fn for fn in allfiles if os.path.splitext(fn)[1] in FRAME_EXTENSIONS]
+    frame_set = set(frames)
+    extensions = set(os.path.splitext(fn)[1] for fn in frames)
+    if len(extensions) > 1:
+        raise ValueError(f"{dirname}: mixed frame types {', '.join(sorted(extensions))}")
+    with SequenceWriter(filename) as writer:
+        writer.extension = extensions.pop() if extensions else None
+        for i, fn in enumerate(frames):
+            with open(os.path.join(dirname, fn), 'rb') as fp:
+                writer.add_frame(fp.read(), i*time_increment, fn)
+        for fn in allfiles:
+            pathname = os.path.join(dirname, fn)
+            if fn in frame_set or not os.path.isfile(pathname) or os.path.getsize(pathname) > MAX_EXTRA_FILE_SIZE:
+                continue
+            with open(pathname, 'rb') as fp:
+                writer.add_extra_file(fn, fp.read())
+    return len(frames)
+
+def unpack(filename : str, dirname : str) -> int:
+    """Recreate the directory layout from an archive. Returns number of frames"""
+    os.makedirs(dirname, exist_ok=True)
+    with SequenceArchive(filename) as archive:
+        extension = archive.metadata.get('extension') or ''
+        for i in range(len(archive)):
+            name = archive.name(i) or f"pointcloud-{i:04d}{extension}"
+            with open(os.path.join(dirname, name), 'wb') as fp:
+                fp.write(archive.frame(i))
+        for name, data in archive.extra_files().items():
+            with open(os.path.join(dirname, name), 'wb') as fp:
+                fp.write(data)
+        return len(archive)
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack, unpack and inspect single-file point cloud sequence archives")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("pack", help="Pack a directory of .cwipcdump/.cwicpc/.ply frames into an archive")
+    p.add_argument("--time-increment", type=int, default=33, help="Timestamp increment between frames in ms (default: 33)")
+    p.add_argument("dir")
+    p.add_argument("archive")
+    p = subparsers.add_parser("unpack", help="Unpack an archive into a directory")
+    p.add_argument("archive")
+    p.add_argument("dir")
+    p = subparsers.add_parser("info", help="Print archive contents, and measure frame access speed")
+    p.add_argument("archive")
+    args = parser.parse_args()
+    if args.command == "pack":
+        count = pack(args.dir, args.archive, args.time_increment)
+        print(f"{args.archive}: {count} frames")
+    elif args.command == "unpack":
+        count = unpack(args.archive, args.dir)
+        print(f"{args.dir}: {count} frames")
+    else:
+        with SequenceArchive(args.archive) as archive:
+            n = len(archive)
+            total = int(archive.index['length'].sum())
+            print(f"{args.archive}: {n} frames ({archive.metadata.get('extension')}), {total} bytes of frame data")
+            if n:
+                print(f"timestamps {archive.timestamp(0)}..{archive.timestamp(n-1)}, extra files: {', '.join(archive.extra_files()) or 'none'}")
+                t0 = time.perf_counter()
+                count = 0
+                for _, data in archive.frames(loop=True):
+                    count += 1
+                    if count >= 10*n:
+                        break
+                elapsed = time.perf_counter() - t0
+                print(f"looped access: {count/elapsed:.0f} frames/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+"""Create sample sets at several voxel sizes from one pass over a source sequence.
+
+Every source frame is read and transformed once, and its points are sorted in
+Morton order (see morton.py). All requested voxel sizes are then produced from that
+sorted array; sizes that are a power-of-two multiple of the smallest (--base) need
+no further sorting. Each voxel size gets its own output directory, with a
+tileconfig.json if tiles are used.
+
+The source coordinates are multiplied by --scale and then --translate is added, or
+the transform made by analyze_bounds.py is used with --transform.
+
+Example, making loot at 2.1, 4.2 and 8.4 mm (and one odd size) with the 4 tiles of
+the existing samples:
+
+    python lod_pyramid.py --scale 0.0018 --translate=-0.36,0,-0.54 --voxel 0.0021,0.0042,0.0084,0.0039 \\
+        --tileconfig ../Samples/loot-150K-4tiles/tileconfig.json ../../loot 'loot-{voxel}'
+"""
+import sys
+import os
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import cwipc_numpy
+import morton
+import tiling
+import analyze_bounds
+
+SOURCE_EXTENSIONS = ('.ply', '.cwipcdump')
+TIME_INCREMENT = 33 # Increment in timestamp between successive pointclouds
+
+def parse_floatlist(value : str) -> List[float]:
+    return [float(v) for v in value.split(',')]
+
+def read_points(filename : str) -> Tuple[np.ndarray, int]:
+    """Read a ply or cwipcdump file. Returns the point array and timestamp"""
+    import cwipc
+    if filename.endswith('.cwipcdump'):
+        pc = cwipc.cwipc_read_debugdump(filename)
+    else:
+        pc = cwipc.cwipc_read(filename, 0)
+    points = cwipc_numpy.cwipc_to_numpy(pc)
+    timestamp = pc.timestamp()
+    pc.free()
+    return points, timestamp
+
+def write_points(filename : str, points : np.ndarray, timestamp : int, cellsize : float) -> None:
+    import cwipc
+    pc = cwipc_numpy.numpy_to_cwipc(points, timestamp, cellsize)
+    if filename.endswith('.ply'):
+        cwipc.cwipc_write(filename, pc)
+    else:
+        cwipc.cwipc_write_debugdump(filename, pc)
+    pc.free()
+
+def transform(points : np.ndarray, scale : float, translate : List[float], noise : float, seed : int) -> np.ndarray:
+    """Scale and then translate all points, and optionally add gaussian noise of noise meters"""
+    points = points.copy()
+    xyz = cwipc_numpy.xyz_view(points)
+    xyz *= scale
+    xyz += np.array(translate, dtype=np.float32)
+    if noise > 0:
+        # Seeded per frame so reruns give identical output
+        xyz += np.random.default_rng(seed).normal(0, noise, xyz.shape).astype(np.float32)
+    return points
+
+def add_transform_arguments(parser : argparse.ArgumentParser) -> None:
+    parser.add_argument("--scale", type=float, help="Multiply source coordinates by this, so 1/SCALE_FACTOR of convert_loot.py (default: 1)")
+    parser.add_argument("--translate", type=parse_floatlist, help="Add x,y,z (in meters, after scaling) to source coordinates (default: 0,0,0)")
+    parser.add_argument("--transform", help="Use SCALE_FACTOR and TRANSLATE_X/Y/Z from this JSON file, made with analyze_bounds.py, instead of --scale and --translate")
+
+def resolve_transform(parser : argparse.ArgumentParser, args : argparse.Namespace) -> None:
+    """Set args.scale and args.translate, from --transform if given.
+
+    analyze_bounds.py and convert_loot.py divide by SCALE_FACTOR (scaled = source / SCALE_FACTOR + TRANSLATE),
+    transform() multiplies by scale.
+    """
+    if args.transform:
+        if args.scale is not None or args.translate is not None:
+            parser.error("--transform cannot be combined with --scale or --translate")
+        transform = analyze_bounds.load_transform(args.transform)
+        args.scale = 1.0 / transform['SCALE_FACTOR']
+        args.translate = [transform['TRANSLATE_X'], transform['TRANSLATE_Y'], transform['TRANSLATE_Z']]
+    if args.scale is None:
+        args.scale = 1.0
+    if args.translate is None:
+        args.translate = [0, 0, 0]
+
+def level_dirname(dest : str, voxel : float) -> str:
+    if '{' in dest:
+        return dest.format(voxel=voxel)
+    return os.path.join(dest, f"voxel-{voxel}")
+
+class Options:
+    """Conversion parameters, passed to worker processes once"""
+
+    def __init__(self, args : argparse.Namespace, voxels : List[float], dirnames : List[str], tileinfo : Optional[List[Dict[str, Any]]]):
+        self.scale = args.scale
+        self.translate = args.translate
+        self.noise = args.noise
+        self.base = args.base or min(voxels)
+        self.voxels = voxels
+        self.dirnames = dirnames
+        self.tileinfo = tileinfo
+        self.overlap = args.overlap
+        self.extension = '.ply' if args.ply else '.cwipcdump'
+
+_options : Optional[Options] = None
+
+def _worker_init(options : Options) -> None:
+    global _options
+    _options = options
+
+def convert_frame(task : Tuple[int, str]) -> List[int]:
+    """Read, transform and sort one source frame, and write it at every voxel size. Returns point counts"""
+    index, filename = task
+    options = _options
+    points, timestamp = read_points(filename)
+    if not timestamp:
+        timestamp = index * TIME_INCREMENT
+    points = transform(points, options.scale, options.translate, options.noise, index)
+    levels = max(0, int(np.ceil(np.log2(max(options.voxels) / options.base))))
+    sorted_points = morton.SortedPoints(points, options.base, max_levels=levels)
+    basename = os.path.splitext(os.path.basename(filename))[0] + options.extension
+    counts = []
+    for voxel, dirname in zip(options.voxels, options.dirnames):
+        voxelized = sorted_points.voxelize(voxel)
+        if options.tileinfo is not None:
+            voxelized['tile'] = tiling.assign_tiles(voxelized, options.tileinfo, options.overlap)
+        write_points(os.path.join(dirname, basename), voxelized, timestamp, voxel)
+        counts.append(len(voxelized))
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Create sample sets at several voxel sizes from one pass over a source ply or cwipcdump sequence")
+    parser.add_argument("--voxel", type=parse_floatlist, required=True, help="Comma-separated voxel sizes in meters")
+    parser.add_argument("--base", type=float, default=0, help="Base grid size for the Morton sort (default: smallest voxel size). Voxel sizes that are base*2**k are fastest")
+    add_transform_arguments(parser)
+    parser.add_argument("--noise", type=float, default=0, help="Add gaussian noise with this standard deviation (meters) before voxelizing (default: none)")
+    parser.add_argument("--tileconfig", help="Assign tiles using this tileconfig.json (default: keep source tiles, OR-ed per voxel)")
+    parser.add_argument("--overlap", type=float, default=0, help="With --tileconfig: tile overlap in degrees (default: 0)")
+    parser.add_argument("--ply", action="store_true", help="Write .ply instead of .cwipcdump")
+    parser.add_argument("--jobs", type=int, default=0, help="Number of frames to convert in parallel (default: 0, number of cores)")
+    parser.add_argument("--json", help="Write mean point count per voxel size to this JSON file")
+    parser.add_argument("source", help="Directory with source .ply or .cwipcdump files")
+    parser.add_argument("dest", help="Output directory per voxel size: a pattern with {voxel}, or a parent directory for voxel-SIZE subdirectories")
+    args = parser.parse_args()
+    resolve_transform(parser, args)
+
+    sources = [os.path.join(args.source, fn) for fn in sorted(os.listdir(args.source)) if os.path.splitext(fn)[1] in SOURCE_EXTENSIONS]
+    if not sources:
+        print(f"{sys.argv[0]}: no .ply or .cwipcdump files in {args.source}", file=sys.stderr)
+        sys.exit(1)
+    tileinfo = tiling.load_tileconfig(args.tileconfig) if args.tileconfig else None
+    tileconfig = args.tileconfig or os.path.join(args.source, 'tileconfig.json')
+    dirnames = [level_dirname(args.dest, voxel) for voxel in args.voxel]
+    for dirname in dirnames:
+        os.makedirs(dirname, exist_ok=True)
+        if os.path.exists(tileconfig):
+            shutil.copyfile(tileconfig, os.path.join(dirname, 'tileconfig.json'))
+    options = Options(args, args.voxel, dirnames, tileinfo)
+
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    tasks = list(enumerate(sources))
+    startTime = time.time()
+    totals = np.zeros(len(args.voxel), dtype=np.int64)
+    if jobs == 1:
+        _worker_init(options)
+        results = map(convert_frame, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, _worker_init, (options,))
+        results = pool.imap(convert_frame, tasks)
+    for (index, filename), counts in zip(tasks, results):
+        print(filename, 'done', counts)
+        totals += counts
+    if jobs != 1:
+        pool.close()
+        pool.join()
+    print(f"Converted {len(tasks)} frames to {len(args.voxel)} voxel sizes in {time.time()-startTime:.1f} seconds ({jobs} jobs)")
+    summary = []
+    for voxel, dirname, total in zip(args.voxel, dirnames, totals):
+        mean = total / len(tasks)
+        print(f"{dirname}: voxel {voxel}, mean {mean:.0f} points per frame")
+        summary.append(dict(voxel=voxel, dir=dirname, mean_points=mean))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(summary, fp, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Morton (Z-order) codes for point arrays, and voxelization from one sorted array.
+
+Points are quantized to a base grid of cellsize meters and sorted by the Morton code
+of their cell, once. In that order all points of a voxel of cellsize * 2**k are
+consecutive (they share the code with its lowest 3*k bits dropped), so every such
+voxel level is a single np.*.reduceat over the sorted array, without sorting again.
+Other voxel sizes fall back to np.unique on the quantized coordinates.
+
+Voxels are aligned to multiples of the voxel size (from coordinate 0), like the
+PCL VoxelGrid filter behind cwipc's voxelize, and a voxel gets the mean position
+and color of its points and the OR of their tile masks.
+"""
+import math
+from typing import Optional
+import numpy as np
+import cwipc_numpy
+
+BITS = 21   # per axis, so a code fits in 63 bits
+
+def _spread_bits(v : np.ndarray) -> np.ndarray:
+    """Insert two zero bits between each of the low 21 bits of v (uint64)"""
+    v = v & np.uint64(0x1fffff)
+    v = (v | (v << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x1249249249249249)
+    return v
+
+def morton_encode(ijk : np.ndarray) -> np.ndarray:
+    """Return Morton codes (uint64) for an (N, 3) array of non-negative integer cell coordinates"""
+    ijk = ijk.astype(np.uint64)
+    return _spread_bits(ijk[:, 0]) | (_spread_bits(ijk[:, 1]) << np.uint64(1)) | (_spread_bits(ijk[:, 2]) << np.uint64(2))
+
+class SortedPoints:
+    """A point array sorted in Morton order of a base grid, for fast voxelization at many sizes"""
+
+    def __init__(self, points : np.ndarray, cellsize : float, max_levels : int = 10):
+        """cellsize is the base grid (the smallest voxel size that will be asked for).
+        The grid origin is aligned to cellsize * 2**max_levels so all levels up to that are aligned"""
+        self.cellsize = cellsize
+        self.max_levels = max_levels
+        xyz = cwipc_numpy.xyz_view(points).astype(np.float64) if len(points) else np.zeros((0, 3))
+        cells = np.floor(xyz / cellsize).astype(np.int64)
+        alignment = 1 << max_levels
+        self.origin = (cells.min(axis=0) // alignment * alignment) if len(points) else np.zeros(3, dtype=np.int64)
+        cells -= self.origin
+        if len(points) and cells.max() >= (1 << BITS):
+            raise ValueError(f"cellsize {cellsize} too small for the extent of this point cloud")
+        codes = morton_encode(cells)
+        order = np.argsort(codes, kind='stable')
+        self.codes = codes[order]
+        self.cells = cells[order]
+        self.points = points[order]
+        self.xyz = xyz[order]
+        self.rgb = cwipc_numpy.rgb_view(np.ascontiguousarray(self.points)).astype(np.float64)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def level_for(self, voxelsize : float) -> Optional[int]:
+        """Return k if voxelsize is cellsize * 2**k (within rounding), else None"""
+        k = math.log2(voxelsize / self.cellsize)
+        if abs(k - round(k)) < 1e-6 and 0 <= round(k) <= self.max_levels:
+            return int(round(k))
+        return None
+
+    def _groups(self, voxelsize : float):
+        """Return (starts, inverse): first index of every voxel in sorted order (or None) and,
+        for the np.unique fallback, the voxel index of every point"""
+        k = self.level_for(voxelsize)
+        if k is not None:
+            keys = self.codes >> np.uint64(3*k)
+            starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.zeros(0, dtype=np.int64)
+            return starts, None
+        cells = np.floor(self.xyz / voxelsize).astype(np.int64)
+        cells -= cells.min(axis=0)
+        extent = cells.max(axis=0) + 1
+        keys = (cells[:, 0] * extent[1] + cells[:, 1]) * extent[2] + cells[:, 2]
+        _, inverse = np.unique(keys, return_inverse=True)
+        return None, inverse.ravel()
+
+    def count(self, voxelsize : float) -> int:
+        """Number of points after voxelizing at voxelsize"""
+        if len(self) == 0:
+            return 0
+        starts, inverse = self._groups(voxelsize)
+        if starts is not None:
+            return len(starts)
+        return int(inverse.max()) + 1
+
+    def voxelize(self, voxelsize : float) -> np.ndarray:
+        """Return a new point array with one point per occupied voxel of voxelsize"""
+        if len(self) == 0:
+            return cwipc_numpy.empty_points(0)
+        starts, inverse = self._groups(voxelsize)
+        if starts is not None:
+            npoints = np.diff(np.append(starts, len(self)))[:, None]
+            xyz = np.add.reduceat(self.xyz, starts, axis=0) / npoints
+            rgb = np.add.reduceat(self.rgb, starts, axis=0) / npoints
+            tiles = np.bitwise_or.reduceat(self.points['tile'], starts)
+        else:
+            nvoxels = int(inverse.max()) + 1
+            npoints = np.bincount(inverse, minlength=nvoxels)[:, None]
+            xyz = np.stack([np.bincount(inverse, self.xyz[:, i], nvoxels) for i in range(3)], axis=1) / npoints
+            rgb = np.stack([np.bincount(inverse, self.rgb[:, i], nvoxels) for i in range(3)], axis=1) / npoints
+            tiles = np.zeros(nvoxels, dtype=np.uint8)
+            np.bitwise_or.at(tiles, inverse, self.points['tile'])
+        rv = cwipc_numpy.empty_points(len(xyz))
+        cwipc_numpy.xyz_view(rv)[:] = xyz
+        cwipc_numpy.rgb_view(rv)[:] = np.rint(rgb)
+        rv['tile'] = tiles
+        return rv
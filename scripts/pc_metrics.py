@@ -0,0 +1,255 @@
+"""Objective quality of decoded point cloud sequences, compared with their originals.
+
+For every frame the original (reference, usually .cwipcdump) is read once and gets a
+KD-tree (scipy cKDTree) and per-point normals, estimated from its --knn nearest
+neighbours. Every degraded version of that frame (.cwicpc files are decoded, .ply
+and .cwipcdump are read) is compared with it, in both directions, with:
+
+    D1      point-to-point: squared distance to the nearest point in the other cloud
+    D2      point-to-plane: that distance vector projected on the reference normal
+    Hausdorff   largest nearest-point distance (meters)
+    Y, U, V color error against the nearest point, after BT.709 RGB to YCbCr
+
+The symmetric error of a frame is the worse of the two directions. Geometry PSNR is
+10*log10(3*peak**2/mse), as in MPEG pc_error, with peak the largest extent of the
+first reference frame unless --peak is given; color PSNR uses a peak of 255. Frames
+are processed in parallel, and the means per degraded sequence, together with the
+mean compressed size, give one point of a rate-distortion curve:
+
+    python pc_metrics.py --csv loot-rd.csv ../Samples/loot-150K-4tiles \\
+        ../Samples/loot-compressed/depth6 ../Samples/loot-compressed/depth7 ../Samples/loot-compressed/depth8
+
+scipy is only imported by the worker processes.
+"""
+import sys
+import os
+import csv
+import json
+import math
+import time
+import argparse
+import multiprocessing
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+import cwipc_numpy
+
+FRAME_EXTENSIONS = ('.cwipcdump', '.cwicpc', '.ply')
+KNN = 12    # Neighbours used to estimate normals
+NORMALS_CHUNK = 1<<16
+# BT.709 RGB to YCbCr, for 0..255 values
+YUV_MATRIX = np.array([
+    [0.2126, 0.7152, 0.0722],
+    [-0.1146, -0.3854, 0.5],
+    [0.5, -0.4542, -0.0458],
+])
+YUV_OFFSET = np.array([0, 128, 128])
+
+def read_points(filename : str) -> np.ndarray:
+    """Read a .cwipcdump, .ply or (decoding it) .cwicpc file into a point array"""
+    ext = os.path.splitext(filename)[1]
+    if ext == '.ply':
+        import plyreader
+        return plyreader.read_ply(filename)
+    import cwipc
+    if ext == '.cwicpc':
+        import cwipc.codec
+        with open(filename, 'rb') as fp:
+            data = fp.read()
+        decoder = cwipc.codec.cwipc_new_decoder()
+        try:
+            decoder.feed(data)
+            if not decoder.available(True):
+                raise RuntimeError(f"{filename}: cannot decode")
+            pc = decoder.get()
+        finally:
+            decoder.free()
+    else:
+        pc = cwipc.cwipc_read_debugdump(filename)
+    points = cwipc_numpy.cwipc_to_numpy(pc)
+    pc.free()
+    return points
+
+def to_yuv(points : np.ndarray) -> np.ndarray:
+    return cwipc_numpy.rgb_view(points).astype(np.float64) @ YUV_MATRIX.T + YUV_OFFSET
+
+def estimate_normals(xyz : np.ndarray, tree : Any, knn : int) -> np.ndarray:
+    """Return unit normals: the direction of least variance of every point's knn nearest neighbours"""
+    knn = min(knn, len(xyz))
+    rv = np.empty_like(xyz)
+    # In chunks, the neighbourhoods take knn times the memory of the points
+    for start in range(0, len(xyz), NORMALS_CHUNK):
+        chunk = xyz[start:start+NORMALS_CHUNK]
+        _, neighbours = tree.query(chunk, k=knn)
+        local = xyz[neighbours.reshape(len(chunk), knn)]
+        local -= local.mean(axis=1, keepdims=True)
+        covariance = np.einsum('nki,nkj->nij', local, local)
+        # eigh sorts eigenvalues ascending, so the first eigenvector is the normal
+        _, vectors = np.linalg.eigh(covariance)
+        rv[start:start+len(chunk)] = vectors[:, :, 0]
+    return rv
+
+class Reference:
+    """A reference frame with its KD-tree and normals, built once and compared with any number of degraded versions"""
+
+    def __init__(self, points : np.ndarray, knn : int = KNN):
+        from scipy.spatial import cKDTree
+        self.xyz = cwipc_numpy.xyz_view(np.ascontiguousarray(points)).astype(np.float64)
+        self.yuv = to_yuv(np.ascontiguousarray(points))
+        self.tree = cKDTree(self.xyz)
+        self.normals = estimate_normals(self.xyz, self.tree, knn)
+
+    def __len__(self) -> int:
+        return len(self.xyz)
+
+def _direction_errors(xyz : np.ndarray, yuv : np.ndarray, target_tree : Any, target_xyz : np.ndarray, target_yuv : np.ndarray, normals : np.ndarray, normals_at_source : bool) -> Dict[str, Any]:
+    """Errors of every point of a cloud against its nearest point in target"""
+    distances, nearest = target_tree.query(xyz)
+    error = xyz - target_xyz[nearest]
+    normal = normals if normals_at_source else normals[nearest]
+    plane = np.einsum('ni,ni->n', error, normal)
+    color = yuv - target_yuv[nearest]
+    return dict(
+        d1_mse=float(np.mean(distances**2)),
+        d2_mse=float(np.mean(plane**2)),
+        hausdorff=float(distances.max()),
+        yuv_mse=np.mean(color**2, axis=0),
+    )
+
+def psnr(mse : float, peak : float, factor : float = 1) -> float:
+    if mse <= 0:
+        return math.inf
+    return 10 * math.log10(factor * peak * peak / mse)
+
+def compare(reference : Reference, points : np.ndarray, peak : float) -> Dict[str, Any]:
+    """Compare a degraded frame with its reference. Returns symmetric errors and PSNRs"""
+    from scipy.spatial import cKDTree
+    points = np.ascontiguousarray(points)
+    xyz = cwipc_numpy.xyz_view(points).astype(np.float64)
+    if len(xyz) == 0 or len(reference) == 0:
+        raise ValueError("cannot compare empty point clouds")
+    yuv = to_yuv(points)
+    # Degraded to reference uses the normal of the nearest reference point, reference
+    # to degraded the normal of the reference point itself, so only reference normals are needed
+    b_to_a = _direction_errors(xyz, yuv, reference.tree, reference.xyz, reference.yuv, reference.normals, False)
+    a_to_b = _direction_errors(reference.xyz, reference.yuv, cKDTree(xyz), xyz, yuv, reference.normals, True)
+    d1_mse = max(a_to_b['d1_mse'], b_to_a['d1_mse'])
+    d2_mse = max(a_to_b['d2_mse'], b_to_a['d2_mse'])
+    yuv_mse = np.maximum(a_to_b['yuv_mse'], b_to_a['yuv_mse'])
+    return dict(
+        points=len(xyz),
+        reference_points=len(reference),
+        d1_mse=d1_mse,
+        d2_mse=d2_mse,
+        d1_psnr=psnr(d1_mse, peak, 3),
+        d2_psnr=psnr(d2_mse, peak, 3),
+        hausdorff=max(a_to_b['hausdorff'], b_to_a['hausdorff']),
+        y_psnr=psnr(yuv_mse[0], 255),
+        u_psnr=psnr(yuv_mse[1], 255),
+        v_psnr=psnr(yuv_mse[2], 255),
+    )
+
+def list_frames(dirname : str) -> Dict[str, str]:
+    """Return a mapping from frame basename (without extension) to pathname"""
+    rv = {}
+    for filename in sorted(os.listdir(dirname)):
+        base, ext = os.path.splitext(filename)
+        if ext in FRAME_EXTENSIONS:
+            rv[base] = os.path.join(dirname, filename)
+    return rv
+
+def reference_peak(filename : str) -> float:
+    """Largest bounding box extent of a frame"""
+    xyz = cwipc_numpy.xyz_view(np.ascontiguousarray(read_points(filename)))
+    return float((xyz.max(axis=0) - xyz.min(axis=0)).max())
+
+_options : Optional[Tuple[float, int]] = None
+
+def _worker_init(peak : float, knn : int) -> None:
+    global _options
+    _options = (peak, knn)
+
+def compare_frame(task : Tuple[int, str, List[Optional[str]]]) -> Tuple[int, List[Optional[Dict[str, Any]]]]:
+    """Read one reference frame, index it once and compare all its degraded versions (None where missing)"""
+    index, reference_path, degraded_paths = task
+    peak, knn = _options
+    reference = Reference(read_points(reference_path), knn)
+    results = []
+    for path in degraded_paths:
+        if path is None:
+            results.append(None)
+            continue
+        result = compare(reference, read_points(path), peak)
+        result['bytes'] = os.path.getsize(path)
+        results.append(result)
+    return index, results
+
+SUMMARY_KEYS = ('bytes', 'points', 'd1_psnr', 'd2_psnr', 'hausdorff', 'y_psnr', 'u_psnr', 'v_psnr')
+
+def summarize(results : List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Mean over frames (PSNRs are averaged per frame, infinite ones are left out)"""
+    rv : Dict[str, Any] = dict(frames=len(results))
+    for key in SUMMARY_KEYS:
+        values = [r[key] for r in results if math.isfinite(r[key])]
+        rv[key] = sum(values) / len(values) if values else math.inf
+    rv['hausdorff_max'] = max((r['hausdorff'] for r in results), default=0)
+    return rv
+
+def run(reference_dir : str, degraded_dirs : List[str], jobs : int, peak : float = 0, knn : int = KNN, maxframes : int = 0) -> Tuple[float, List[Dict[str, Any]], List[List[Optional[Dict[str, Any]]]]]:
+    """Compare all frames. Returns peak used, summary per degraded directory and per-frame results"""
+    references = list_frames(reference_dir)
+    names = sorted(references)[:maxframes] if maxframes else sorted(references)
+    if not names:
+        raise ValueError(f"{reference_dir}: no frames")
+    degraded = [list_frames(d) for d in degraded_dirs]
+    if not peak:
+        peak = reference_peak(references[names[0]])
+    tasks = [(i, references[name], [frames.get(name) for frames in degraded]) for i, name in enumerate(names)]
+    per_frame : List[List[Optional[Dict[str, Any]]]] = [None] * len(tasks)
+    with multiprocessing.Pool(min(jobs, len(tasks)), _worker_init, (peak, knn)) as pool:
+        for index, results in pool.imap_unordered(compare_frame, tasks):
+            per_frame[index] = results
+    summaries = []
+    for j, dirname in enumerate(degraded_dirs):
+        results = [frame[j] for frame in per_frame if frame[j] is not None]
+        summary = summarize(results) if results else dict(frames=0)
+        summary['dir'] = dirname
+        summaries.append(summary)
+    return peak, summaries, per_frame
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute D1/D2 PSNR, Hausdorff distance and color PSNR of decoded sequences against their originals")
+    parser.add_argument("--peak", type=float, default=0, help="Peak value for geometry PSNR in meters (default: largest extent of the first reference frame)")
+    parser.add_argument("--knn", type=int, default=KNN, help=f"Neighbours used to estimate reference normals for D2 (default: {KNN})")
+    parser.add_argument("--frames", type=int, default=0, help="Only compare the first this many frames (default: 0, all)")
+    parser.add_argument("--jobs", type=int, default=0, help="Number of frames to compare in parallel (default: 0, number of cores)")
+    parser.add_argument("--csv", help="Write the summary per degraded directory to this CSV file")
+    parser.add_argument("--json", help="Write summary and per-frame results to this JSON file")
+    parser.add_argument("reference", help="Directory with original frames (.cwipcdump or .ply)")
+    parser.add_argument("degraded", nargs="+", help="Directories with degraded frames (.cwicpc, .cwipcdump or .ply) with the same basenames")
+    args = parser.parse_args()
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    startTime = time.time()
+    try:
+        peak, summaries, per_frame = run(args.reference, args.degraded, jobs, args.peak, args.knn, args.frames)
+    except ValueError as e:
+        print(f"{sys.argv[0]}: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"{args.reference}: {len(per_frame)} frames compared in {time.time()-startTime:.1f} seconds ({jobs} jobs), peak {peak:.4f}", file=sys.stderr)
+    print(f"{'frames':>6s} {'bytes':>9s} {'points':>8s} {'D1 PSNR':>8s} {'D2 PSNR':>8s} {'Hausdorff':>9s} {'Y PSNR':>7s}  dir")
+    for s in summaries:
+        if not s['frames']:
+            print(f"{0:6d} {'-':>9s} {'-':>8s} {'-':>8s} {'-':>8s} {'-':>9s} {'-':>7s}  {s['dir']}")
+            continue
+        print(f"{s['frames']:6d} {s['bytes']:9.0f} {s['points']:8.0f} {s['d1_psnr']:8.2f} {s['d2_psnr']:8.2f} {s['hausdorff']:9.5f} {s['y_psnr']:7.2f}  {s['dir']}")
+    if args.csv:
+        with open(args.csv, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['dir', 'frames'] + list(SUMMARY_KEYS) + ['hausdorff_max'])
+            writer.writeheader()
+            for s in summaries:
+                writer.writerow(s)
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(dict(reference=args.reference, peak=peak, summary=summaries, frames=per_frame), fp, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""Read PLY point clouds (like the 8i sequences) straight into NumPy point arrays.
+
+Binary PLY files are memory-mapped and the vertex element is used as a structured
+array on the mapping, so the only copy made is into the cwipc_numpy point array
+that is returned. ASCII PLY files are mapped too and parsed in chunks of lines, so
+at most a chunk of parsed text is held next to the result.
+
+    points = plyreader.read_ply("loot_vox10_1000.ply")
+
+iter_ply() yields the vertices as a series of smaller point arrays instead, for
+code that only needs to look at every point once (bounds, histograms):
+
+    for chunk in plyreader.iter_ply("loot_vox10_1000.ply"):
+        ...
+
+Run as a script to measure the read throughput of a sequence:
+
+    python plyreader.py ../../loot/loot/Ply
+"""
+import os
+import io
+import mmap
+import time
+import argparse
+from typing import List, Tuple
+import numpy as np
+import cwipc_numpy
+
+PLY_TYPES = {
+    'char' : 'i1', 'int8' : 'i1', 'uchar' : 'u1', 'uint8' : 'u1',
+    'short' : 'i2', 'int16' : 'i2', 'ushort' : 'u2', 'uint16' : 'u2',
+    'int' : 'i4', 'int32' : 'i4', 'uint' : 'u4', 'uint32' : 'u4',
+    'float' : 'f4', 'float32' : 'f4', 'double' : 'f8', 'float64' : 'f8',
+}
+ASCII_CHUNK = 1<<24
+CHUNK_POINTS = 1<<20    # Points per array yielded by iter_ply() for binary files
+
+class PlyHeader:
+    """Format and elements of a PLY file"""
+
+    def __init__(self):
+        self.format = None
+        self.size = 0
+        # (name, count, [(property name, ply type)]); list properties make an element variable-size
+        self.elements : List[Tuple[str, int, List[Tuple[str, str]]]] = []
+
+    def element_dtype(self, index : int) -> np.dtype:
+        name, _, properties = self.elements[index]
+        if any(ptype.startswith('list') for _, ptype in properties):
+            raise ValueError(f"PLY element {name} has list properties, only fixed-size elements can be read")
+        byteorder = '>' if self.format == 'binary_big_endian' else '<'
+        return np.dtype([(pname, byteorder + PLY_TYPES[ptype]) for pname, ptype in properties])
+
+def read_header(buf) -> PlyHeader:
+    """Parse the header at the start of buf (bytes or mmap)"""
+    end = buf.find(b"end_header")
+    if buf[:3] != b"ply" or end < 0:
+        raise ValueError("not a PLY file")
+    header = PlyHeader()
+    header.size = buf.find(b"\n", end) + 1
+    for line in bytes(buf[:end]).decode('ascii').splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0] == 'format':
+            header.format = words[1]
+        elif words[0] == 'element':
+            header.elements.append((words[1], int(words[2]), []))
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                header.elements[-1][2].append((words[4], 'list ' + words[2] + ' ' + words[3]))
+            else:
+                header.elements[-1][2].append((words[2], words[1]))
+    if header.format not in ('ascii', 'binary_little_endian', 'binary_big_endian'):
+        raise ValueError(f"unsupported PLY format {header.format}")
+    return header
+
+def _vertex_index(header : PlyHeader) -> int:
+    for i, (name, _, _) in enumerate(header.elements):
+        if name == 'vertex':
+            return i
+    raise ValueError("PLY file has no vertex element")
+
+COLOR_NAMES = (('red', 'r', 'diffuse_red'), ('green', 'g', 'diffuse_green'), ('blue', 'b', 'diffuse_blue'))
+PACKED_NAMES = ('rgb', 'rgba')
+
+class VertexLayout:
+    """Which vertex properties hold the coordinates and colors"""
+
+    def __init__(self, properties : List[Tuple[str, str]]):
+        types = dict(properties)
+        if not all(c in types for c in 'xyz'):
+            raise ValueError("PLY vertex element has no x, y and z")
+        self.colors = [next((c for c in candidates if c in types), None) for candidates in COLOR_NAMES]
+        self.packed = None
+        self.packed_float = False
+        if None in self.colors:
+            self.colors = None
+            # PCL style 0x00RRGGBB, in the bits of a float or in an int
+            self.packed = next((p for p in PACKED_NAMES if p in types), None)
+            self.packed_float = self.packed is not None and types[self.packed] in ('float', 'float32')
+
+    def used(self) -> List[str]:
+        return ['x', 'y', 'z'] + (self.colors or []) + ([self.packed] if self.packed else [])
+
+    def fill(self, points : np.ndarray, columns, start : int = 0) -> None:
+        """Copy coordinates and colors from columns (a structured array or dict of arrays) into points[start:]"""
+        end = start + len(columns['x'])
+        for field in 'xyz':
+            points[field][start:end] = columns[field]
+        if self.colors is not None:
+            for field, name in zip('rgb', self.colors):
+                points[field][start:end] = columns[name]
+        elif self.packed is not None:
+            if self.packed_float:
+                value = np.ascontiguousarray(columns[self.packed], dtype=np.float32).view(np.uint32)
+            else:
+                value = np.asarray(columns[self.packed]).astype(np.uint32)
+            for field, shift in zip('rgb', (16, 8, 0)):
+                points[field][start:end] = (value >> shift) & 0xff
+        else:
+            cwipc_numpy.rgb_view(points)[start:end] = 0
+
+def _vertex_offset(header : PlyHeader, index : int) -> int:
+    """Byte offset of the vertex element in a binary PLY file"""
+    offset = header.size
+    for i in range(index):
+        offset += header.elements[i][1] * header.element_dtype(i).itemsize
+    return offset
+
+def read_ply(filename : str) -> np.ndarray:
+    """Read the vertices of a PLY file into a cwipc_numpy point array (tile 0)"""
+    with open(filename, 'rb') as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header = read_header(buf)
+        index = _vertex_index(header)
+        _, count, properties = header.elements[index]
+        layout = VertexLayout(properties)
+        dtype = header.element_dtype(index)
+        points = cwipc_numpy.empty_points(count)
+        points['tile'] = 0
+        if header.format == 'ascii':
+            if index != 0:
+                raise ValueError("ASCII PLY files with elements before the vertices are not supported")
+            done = 0
+            for rows in _ascii_chunks(buf, header.size, count, list(dtype.names), layout):
+                layout.fill(points, rows, done)
+                done += len(rows['x'])
+        else:
+            offset = _vertex_offset(header, index)
+            if offset + count * dtype.itemsize > len(buf):
+                raise ValueError(f"PLY file is truncated, header says {count} vertices")
+            vertices = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+            layout.fill(points, vertices)
+            # The mapping can only be closed when no arrays refer to it
+            del vertices
+        return points
+    finally:
+        buf.close()
+
+def vertex_count(filename : str) -> int:
+    """Return the number of vertices of a PLY file, from its header"""
+    with open(filename, 'rb') as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header = read_header(buf)
+        return header.elements[_vertex_index(header)][1]
+    finally:
+        buf.close()
+
+def iter_ply(filename : str, chunk_points : int = CHUNK_POINTS):
+    """Yield the vertices of a PLY file as point arrays (tile 0) of at most chunk_points points.
+
+    Binary files are converted a slice of the mapping at a time, ASCII files a chunk of
+    ASCII_CHUNK bytes at a time, so only one chunk of points is held in memory.
+    """
+    with open(filename, 'rb') as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        header = read_header(buf)
+        index = _vertex_index(header)
+        _, count, properties = header.elements[index]
+        layout = VertexLayout(properties)
+        dtype = header.element_dtype(index)
+        if header.format == 'ascii':
+            if index != 0:
+                raise ValueError("ASCII PLY files with elements before the vertices are not supported")
+            for rows in _ascii_chunks(buf, header.size, count, list(dtype.names), layout):
+                points = cwipc_numpy.empty_points(len(rows['x']))
+                points['tile'] = 0
+                layout.fill(points, rows)
+                yield points
+            return
+        offset = _vertex_offset(header, index)
+        if offset + count * dtype.itemsize > len(buf):
+            raise ValueError(f"PLY file is truncated, header says {count} vertices")
+        for start in range(0, count, chunk_points):
+            n = min(chunk_points, count - start)
+            vertices = np.frombuffer(buf, dtype=dtype, count=n, offset=offset + start*dtype.itemsize)
+            points = cwipc_numpy.empty_points(n)
+            points['tile'] = 0
+            layout.fill(points, vertices)
+            del vertices
+            yield points
+    finally:
+        buf.close()
+
+def _ascii_chunks(buf, offset : int, count : int, columns : List[str], layout : VertexLayout):
+    """Parse count lines of ASCII vertices a chunk of lines at a time. Yields a column dict per chunk"""
+    used = layout.used()
+    usecols = [columns.index(name) for name in used]
+    done = 0
+    while done < count and offset < len(buf):
+        end = buf.find(b"\n", min(offset + ASCII_CHUNK, len(buf)))
+        end = len(buf) if end < 0 else end + 1
+        rows = np.loadtxt(io.BytesIO(buf[offset:end]), dtype=np.float64, usecols=usecols, ndmin=2, max_rows=count-done)
+        yield {name : rows[:, i] for i, name in enumerate(used)}
+        done += len(rows)
+        offset = end
+    if done != count:
+        raise ValueError(f"PLY file has {done} vertices, header says {count}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Read PLY files into point arrays and report the read throughput")
+    parser.add_argument("files", nargs="+", help="PLY files, or directories with PLY files")
+    args = parser.parse_args()
+    filenames = []
+    for name in args.files:
+        if os.path.isdir(name):
+            filenames += [os.path.join(name, fn) for fn in sorted(os.listdir(name)) if fn.endswith('.ply')]
+        else:
+            filenames.append(name)
+    nbytes = npoints = 0
+    startTime = time.time()
+    for filename in filenames:
+        points = read_ply(filename)
+        nbytes += os.path.getsize(filename)
+        npoints += len(points)
+    duration = max(time.time() - startTime, 1e-9)
+    print(f"{len(filenames)} files, {npoints} points, {nbytes/1e6:.1f} MB in {duration:.2f} seconds: {nbytes/1e6/duration:.1f} MB/s, {npoints/duration/1e6:.2f} Mpoints/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Read the frames of a sample sequence ahead of time, optionally decoded and paced.
+
+A sequence is a directory of .cwipcdump, .cwicpc or .ply files (in sorted order), or
+a .cwipcseq archive (see cwipcseq.py). A background thread reads the next --prefetch
+frames while the consumer works on the current one, and with decode=True also turns
+them into cwipc pointclouds (.cwicpc with cwipc.codec, .ply and .cwipcdump with the
+cwipc readers), so a test harness or encoder does not wait for the disk or the decoder.
+
+Frames are handed out as fast as possible, or paced at interval ms per frame (frame n
+is due at start + n*interval, like pcserver.py does):
+
+    source = SequenceSource("../Samples/loot-compressed/depth7", prefetch=8, decode=True, interval=33)
+    for frame in source:
+        use(frame.pc)
+        frame.free()
+    print(source.stalls, "frames were not read in time")
+
+Run as a script to measure how fast a sequence can be read (and decoded).
+"""
+import sys
+import os
+import re
+import time
+import queue
+import argparse
+import threading
+from typing import Any, Iterator, List, Optional, Pattern, Tuple
+
+FRAME_EXTENSIONS = ('.cwipcdump', '.cwicpc', '.ply')
+TIME_INCREMENT = 33 # Timestamp increment between frames when the filenames have none
+GRAB_TIMESTAMP = re.compile(r'pointcloud-([0-9]+)\.ply$')   # cwipc_grab filenames
+
+class Frame:
+    """One frame: its file data (None when a reader needs the pathname) and, if decoded, the cwipc pointcloud"""
+
+    def __init__(self, index : int, name : str, pathname : Optional[str], timestamp : int, data : Any = None, pc : Any = None):
+        self.index = index
+        self.name = name
+        self.pathname = pathname
+        self.timestamp = timestamp
+        self.data = data
+        self.pc = pc
+
+    def free(self) -> None:
+        """Free the decoded pointcloud, if any"""
+        if self.pc is not None:
+            self.pc.free()
+            self.pc = None
+
+def list_frames(path : str, extensions=FRAME_EXTENSIONS, timestamp_pattern : Optional[Pattern] = None, time_increment : int = TIME_INCREMENT) -> List[Tuple[str, str, int]]:
+    """Return (name, pathname, timestamp) for all frame files of a directory, in sorted order.
+
+    With timestamp_pattern the timestamp is taken from the first group of a (compiled)
+    regular expression on the filename, relative to the first frame, otherwise frame n
+    gets n*time_increment.
+    """
+    rv = []
+    epoch = None
+    for filename in sorted(os.listdir(path)):
+        if os.path.splitext(filename)[1] not in extensions:
+            continue
+        if timestamp_pattern is not None:
+            match = timestamp_pattern.search(filename)
+            if not match:
+                continue
+            timestamp = int(match.group(1))
+            if epoch is None:
+                epoch = timestamp
+            timestamp -= epoch
+        else:
+            timestamp = len(rv) * time_increment
+        rv.append((filename, os.path.join(path, filename), timestamp))
+    return rv
+
+_END = object()
+
+class _Error:
+    def __init__(self, exc : BaseException):
+        self.exc = exc
+
+class SequenceSource:
+    """Iterate over the frames of a directory or .cwipcseq archive, read ahead on a background thread"""
+
+    def __init__(self, path : str, prefetch : int = 4, decode : bool = False, interval : float = 0, loop : bool = False,
+            extensions=FRAME_EXTENSIONS, timestamp_pattern : Optional[Pattern] = None, time_increment : int = TIME_INCREMENT, maxframes : int = 0):
+        self.path = path
+        self.prefetch = max(1, prefetch)
+        self.decode = decode
+        self.interval = interval
+        self.loop = loop
+        self.archive = None
+        if path.endswith('.cwipcseq'):
+            import cwipcseq
+            self.archive = cwipcseq.SequenceArchive(path)
+            extension = self.archive.metadata.get('extension') or ''
+            self.frames = [(self.archive.name(i), None, self.archive.timestamp(i)) for i in range(len(self.archive))]
+            if decode and extension != '.cwicpc':
+                raise ValueError(f"{path}: only .cwicpc frames in an archive can be decoded, not {extension}")
+        else:
+            self.frames = list_frames(path, extensions, timestamp_pattern, time_increment)
+        if maxframes:
+            self.frames = self.frames[:maxframes]
+        # Timestamps keep increasing when looping, the loop takes one mean frame interval longer than the sequence
+        self.duration = 0
+        if self.frames:
+            span = self.frames[-1][2] - self.frames[0][2]
+            self.duration = span + (span // (len(self.frames)-1) if len(self.frames) > 1 else time_increment)
+        self.stalls = 0             # Frames the consumer had to wait for
+        self.stall_seconds = 0.0
+        self.late = 0               # Frames handed out after their due time when pacing
+        self._stop = threading.Event()
+        self._queue : Optional[queue.Queue] = None
+        self._thread : Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def _load(self, index : int, decoder : Any) -> Frame:
+        """Read (and decode) frame index, in the background thread"""
+        name, pathname, timestamp = self.frames[index % len(self.frames)]
+        frame = Frame(index, name, pathname, timestamp + (index // len(self.frames)) * self.duration)
+        ext = os.path.splitext(name)[1]
+        if self.decode and ext in ('.ply', '.cwipcdump'):
+            # The cwipc readers want a filename, so the data is not read here
+            import cwipc
+            if ext == '.ply':
+                frame.pc = cwipc.cwipc_read(pathname, frame.timestamp)
+            else:
+                frame.pc = cwipc.cwipc_read_debugdump(pathname)
+            return frame
+        if self.archive is not None:
+            frame.data = self.archive.frame(index % len(self.frames))
+        else:
+            with open(pathname, 'rb') as fp:
+                frame.data = fp.read()
+        if self.decode and ext == '.cwicpc':
+            decoder.feed(bytes(frame.data))
+            if not decoder.available(True):
+                raise RuntimeError(f"{name}: cannot decode")
+            frame.pc = decoder.get()
+        return frame
+
+    def _put(self, item : Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self) -> None:
+        decoder = None
+        try:
+            if self.decode:
+                import cwipc.codec
+                decoder = cwipc.codec.cwipc_new_decoder()
+            index = 0
+            while index < len(self.frames) or (self.loop and self.frames):
+                frame = self._load(index, decoder)
+                if not self._put(frame):
+                    frame.free()
+                    return
+                index += 1
+            self._put(_END)
+        except BaseException as exc:
+            self._put(_Error(exc))
+        finally:
+            if decoder is not None:
+                decoder.free()
+
+    def __iter__(self) -> Iterator[Frame]:
+        self._stop.clear()
+        self._queue = queue.Queue(self.prefetch)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        start = None
+        number = 0
+        try:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    t0 = time.perf_counter()
+                    item = self._queue.get()
+                    if item is not _END and number > 0:
+                        self.stalls += 1
+                        self.stall_seconds += time.perf_counter() - t0
+                if item is _END:
+                    break
+                if isinstance(item, _Error):
+                    raise item.exc
+                if self.interval > 0:
+                    now = time.perf_counter()
+                    if start is None:
+                        start = now
+                    delay = start + number*self.interval/1000.0 - now
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif number > 0 and delay < -0.001:
+                        self.late += 1
+                number += 1
+                yield item
+        finally:
+            self._shutdown()
+
+    def _shutdown(self) -> None:
+        """Stop the background thread and free frames it read but nobody consumed"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        while self._queue is not None and not self._queue.empty():
+            item = self._queue.get_nowait()
+            if isinstance(item, Frame):
+                item.free()
+
+    def close(self) -> None:
+        self._shutdown()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Read a sequence with read-ahead, and report frame rate and stalls")
+    parser.add_argument("--prefetch", type=int, default=4, help="Number of frames read ahead (default: 4)")
+    parser.add_argument("--decode", action="store_true", help="Also decode frames to cwipc pointclouds")
+    parser.add_argument("--interval", type=float, default=0, help=f"Pace frames at this many ms, {TIME_INCREMENT} is the dataset rate (default: 0, as fast as possible)")
+    parser.add_argument("--work", type=float, default=0, help="Simulate this many ms of work per frame in the consumer (default: 0)")
+    parser.add_argument("--frames", type=int, default=0, help="Stop after this many frames, looping if needed (default: 0, the whole sequence once)")
+    parser.add_argument("sequence", help="Directory with .cwipcdump, .cwicpc or .ply files, or .cwipcseq archive")
+    args = parser.parse_args()
+    with SequenceSource(args.sequence, args.prefetch, args.decode, args.interval, loop=args.frames > 0) as source:
+        if len(source) == 0:
+            print(f"{sys.argv[0]}: no frames in {args.sequence}", file=sys.stderr)
+            sys.exit(1)
+        count = 0
+        nbytes = 0
+        startTime = time.perf_counter()
+        for frame in source:
+            if frame.data is not None:
+                nbytes += len(frame.data)
+            if args.work:
+                time.sleep(args.work/1000.0)
+            frame.free()
+            count += 1
+            if args.frames and count >= args.frames:
+                break
+        duration = max(time.perf_counter() - startTime, 1e-9)
+        print(f"{args.sequence}: {count} frames, {nbytes} bytes in {duration:.2f} seconds: {count/duration:.1f} frames/s, {nbytes/1e6/duration:.1f} MB/s")
+        print(f"stalls: {source.stalls} frames ({1000*source.stall_seconds:.1f} ms), late: {source.late} frames")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,407 @@
+"""Octree index sidecars for point cloud frames, for frustum and box queries that only read what they need.
+
+The builder sorts the points of every frame in Morton order of an octree of --depth
+levels around the frame (see morton.py) and writes the frame back as a .cwipcdump in
+that order, so the points of every octree node are one contiguous byte range. Next to
+it goes a sidecar FRAME.spidx.npz with, per occupied leaf: its Morton code, first
+point and point count, tight bounding box and the number of points per tile bit.
+The ranges, counts and tile counts of all coarser nodes follow from the leaves, as
+the leaves of a node are consecutive.
+
+For a .cwipcseq destination all reordered frames go into one archive (see cwipcseq.py)
+with one sidecar ARCHIVE.spidx.npz for all frames, the byte ranges then being offsets
+in the archive.
+
+A query descends the octree, keeps nodes completely inside the box or frustum whole,
+drops nodes outside it (or without points of the wanted tiles) and only tests the
+points of leaves on the boundary. Only the byte ranges of the selected nodes are read
+from the (memory-mapped) frame file.
+
+    python spatial_index.py build ../Samples/loot-600K-4tiles loot-600K-indexed
+    python spatial_index.py query --box=-0.3,0,-0.3,0.3,1,0.3 loot-600K-indexed/frame-0000.cwipcdump
+
+    index = spatial_index.load("loot-600K-indexed/frame-0000.cwipcdump")[0]
+    points = index.query_frustum(spatial_index.frustum_planes(eye, forward, up, 90, 16/9, 0.1, 10))
+"""
+import sys
+import os
+import mmap
+import time
+import tempfile
+import argparse
+import multiprocessing
+from typing import List, Optional, Tuple
+import numpy as np
+import cwipc_numpy
+import morton
+
+SUFFIX = ".spidx.npz"
+VERSION = 1
+DEPTH = 6
+POINT_SIZE = cwipc_numpy.POINT_DTYPE.itemsize
+TILE_BITS = 8
+
+class FrameIndex:
+    """The octree leaves of one frame, and where its points are in the data file"""
+
+    def __init__(self, origin : np.ndarray, size : float, depth : int, codes : np.ndarray, starts : np.ndarray, counts : np.ndarray,
+            leaf_min : np.ndarray, leaf_max : np.ndarray, tile_counts : np.ndarray, data_offset : int, datafile : Optional[str] = None):
+        self.origin = np.asarray(origin, dtype=np.float64)   # Lowest corner of the root cube
+        self.size = float(size)                             # Edge of the root cube
+        self.depth = depth
+        self.codes = codes              # Morton code per occupied leaf, ascending
+        self.starts = starts            # First point of every leaf
+        self.counts = counts            # Points in every leaf
+        self.leaf_min = leaf_min        # Tight bounds of the points of every leaf
+        self.leaf_max = leaf_max
+        self.tile_counts = tile_counts  # (leaves, TILE_BITS): points with every tile bit set
+        self.data_offset = data_offset  # Byte offset of point 0 in the data file
+        self.datafile = datafile
+        self._mmap = None
+
+    @property
+    def npoints(self) -> int:
+        return int(self.counts.sum())
+
+    def byte_ranges(self, level : int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Return (codes, byte offsets, byte lengths, tile counts) of the occupied nodes at level (0 is the root)"""
+        keys = self.codes >> np.uint64(3 * (self.depth - level))
+        first = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1]))) if len(keys) else np.zeros(0, dtype=np.int64)
+        counts = np.add.reduceat(self.counts, first) if len(first) else np.zeros(0, dtype=np.int64)
+        tiles = np.add.reduceat(self.tile_counts, first, axis=0) if len(first) else np.zeros((0, TILE_BITS), dtype=np.int64)
+        return keys[first], self.data_offset + self.starts[first] * POINT_SIZE, counts * POINT_SIZE, tiles
+
+    def _cubes(self, keys : np.ndarray, level : int) -> Tuple[np.ndarray, np.ndarray]:
+        """Lower and upper corners of the nodes with these codes at level"""
+        cell = self.size / (1 << level)
+        ijk = np.stack([_compact_bits(keys >> np.uint64(axis)) for axis in range(3)], axis=1).astype(np.float64)
+        lo = self.origin + ijk * cell
+        return lo, lo + cell
+
+    def select(self, classify, tiles : int = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Descend the octree with classify(lo, hi) -> (outside, inside) masks for boxes.
+
+        Returns (leaf indices fully inside, leaf indices on the boundary). Leaves without
+        points of the tiles mask (0 for all points) are skipped.
+        """
+        nleaves = len(self.codes)
+        if nleaves == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        wanted = np.ones(nleaves, dtype=bool)
+        if tiles:
+            bits = [b for b in range(TILE_BITS) if tiles & (1 << b)]
+            wanted = self.tile_counts[:, bits].sum(axis=1) > 0
+        inside = []
+        # The frontier is a list of leaf ranges [first, end) that share a node at level
+        first = np.zeros(1, dtype=np.int64)
+        end = np.full(1, nleaves, dtype=np.int64)
+        for level in range(0, self.depth + 1):
+            keys = self.codes[first] >> np.uint64(3 * (self.depth - level))
+            if level == self.depth:
+                lo, hi = self.leaf_min[first].astype(np.float64), self.leaf_max[first].astype(np.float64)
+            else:
+                lo, hi = self._cubes(keys, level)
+            outside, complete = classify(lo, hi)
+            for f, e in zip(first[complete], end[complete]):
+                inside.append(np.arange(f, e))
+            keep = ~outside & ~complete
+            first, end = first[keep], end[keep]
+            if level == self.depth or len(first) == 0:
+                break
+            # Split every node into its occupied children
+            leaves = np.concatenate([np.arange(f, e) for f, e in zip(first, end)])
+            child = self.codes[leaves] >> np.uint64(3 * (self.depth - level - 1))
+            split = np.flatnonzero(np.concatenate(([True], child[1:] != child[:-1])))
+            first = leaves[split]
+            end = np.append(leaves[split[1:] - 1] + 1, leaves[-1] + 1)
+        complete_leaves = np.concatenate(inside) if inside else np.zeros(0, dtype=np.int64)
+        boundary_leaves = first if len(first) else np.zeros(0, dtype=np.int64)
+        return complete_leaves[wanted[complete_leaves]], boundary_leaves[wanted[boundary_leaves]]
+
+    def _buffer(self):
+        if self._mmap is None:
+            with open(self.datafile, 'rb') as fp:
+                self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def read_leaves(self, leaves : np.ndarray) -> np.ndarray:
+        """Read the points of these leaves (consecutive leaves in one go) into a new point array"""
+        leaves = np.sort(leaves)
+        rv = cwipc_numpy.empty_points(int(self.counts[leaves].sum()))
+        if len(leaves) == 0:
+            return rv
+        buf = self._buffer()
+        # Merge runs of consecutive leaves into single reads
+        breaks = np.flatnonzero(np.diff(leaves) != 1) + 1
+        done = 0
+        for run in np.split(leaves, breaks):
+            start = int(self.starts[run[0]])
+            count = int(self.starts[run[-1]] + self.counts[run[-1]]) - start
+            rv[done:done+count] = np.frombuffer(buf, dtype=cwipc_numpy.POINT_DTYPE, count=count, offset=self.data_offset + start * POINT_SIZE)
+            done += count
+        return rv
+
+    def query(self, classify, contains, tiles : int = 0) -> np.ndarray:
+        """Return the points for which contains(xyz) is true, reading only the leaves that can have them"""
+        complete, boundary = self.select(classify, tiles)
+        partial = self.read_leaves(boundary)
+        partial = partial[contains(cwipc_numpy.xyz_view(partial).astype(np.float64))]
+        points = np.concatenate((self.read_leaves(complete), partial))
+        if tiles:
+            points = points[(points['tile'] & tiles) != 0]
+        return points
+
+    def query_box(self, lo, hi, tiles : int = 0) -> np.ndarray:
+        """Return the points inside the axis-aligned box lo..hi"""
+        lo = np.asarray(lo, dtype=np.float64)
+        hi = np.asarray(hi, dtype=np.float64)
+        def classify(nlo, nhi):
+            outside = np.any((nhi < lo) | (nlo > hi), axis=1)
+            inside = np.all((nlo >= lo) & (nhi <= hi), axis=1)
+            return outside, inside
+        def contains(xyz):
+            return np.all((xyz >= lo) & (xyz <= hi), axis=1)
+        return self.query(classify, contains, tiles)
+
+    def query_frustum(self, planes : np.ndarray, tiles : int = 0) -> np.ndarray:
+        """Return the points inside a frustum given as (6, 4) planes a, b, c, d with a*x + b*y + c*z + d >= 0 inside"""
+        planes = np.asarray(planes, dtype=np.float64)
+        normals = planes[:, :3]
+        def classify(nlo, nhi):
+            # Per plane the box corner furthest along the normal (p) and furthest against it (n)
+            positive = normals >= 0
+            p = np.where(positive[None, :, :], nhi[:, None, :], nlo[:, None, :])
+            n = np.where(positive[None, :, :], nlo[:, None, :], nhi[:, None, :])
+            outside = np.any(np.einsum('bpi,pi->bp', p, normals) + planes[:, 3] < 0, axis=1)
+            inside = np.all(np.einsum('bpi,pi->bp', n, normals) + planes[:, 3] >= 0, axis=1)
+            return outside, inside
+        def contains(xyz):
+            return np.all(xyz @ normals.T + planes[:, 3] >= 0, axis=1)
+        return self.query(classify, contains, tiles)
+
+    def close(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+def _compact_bits(v : np.ndarray) -> np.ndarray:
+    """Inverse of morton._spread_bits: every third bit of v, packed"""
+    v = v & np.uint64(0x1249249249249249)
+    v = (v | (v >> np.uint64(2))) & np.uint64(0x10c30c30c30c30c3)
+    v = (v | (v >> np.uint64(4))) & np.uint64(0x100f00f00f00f00f)
+    v = (v | (v >> np.uint64(8))) & np.uint64(0x1f0000ff0000ff)
+    v = (v | (v >> np.uint64(16))) & np.uint64(0x1f00000000ffff)
+    v = (v | (v >> np.uint64(32))) & np.uint64(0x1fffff)
+    return v
+
+def frustum_planes(eye, forward, up, fov : float, aspect : float, near : float, far : float) -> np.ndarray:
+    """Return the (6, 4) planes of a perspective view frustum. fov is the vertical field of view in degrees"""
+    eye = np.asarray(eye, dtype=np.float64)
+    f = np.asarray(forward, dtype=np.float64)
+    f /= np.linalg.norm(f)
+    r = np.cross(np.asarray(up, dtype=np.float64), f)
+    r /= np.linalg.norm(r)
+    u = np.cross(f, r)
+    half_v = np.radians(fov) / 2
+    half_h = np.arctan(np.tan(half_v) * aspect)
+    normals = [
+        f, -f,
+        np.cos(half_h) * r + np.sin(half_h) * f,    # left
+        -np.cos(half_h) * r + np.sin(half_h) * f,   # right
+        np.cos(half_v) * u + np.sin(half_v) * f,    # bottom
+        -np.cos(half_v) * u + np.sin(half_v) * f,   # top
+    ]
+    points = [eye + near * f, eye + far * f, eye, eye, eye, eye]
+    return np.array([np.append(n, -np.dot(n, p)) for n, p in zip(normals, points)])
+
+def build_index(points : np.ndarray, depth : int = DEPTH) -> Tuple[np.ndarray, FrameIndex]:
+    """Return the points in octree order and their index (data_offset still 0)"""
+    xyz = cwipc_numpy.xyz_view(np.ascontiguousarray(points)).astype(np.float64)
+    if len(xyz):
+        lo = xyz.min(axis=0)
+        size = float((xyz.max(axis=0) - lo).max()) or 1.0
+    else:
+        lo = np.zeros(3)
+        size = 1.0
+    # Slightly larger than the extent, so the highest points fall in the last cell
+    size *= 1 + 1e-6
+    cells = np.clip(np.floor((xyz - lo) / (size / (1 << depth))), 0, (1 << depth) - 1).astype(np.int64)
+    codes = morton.morton_encode(cells)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    points = np.ascontiguousarray(points[order])
+    xyz = cwipc_numpy.xyz_view(points)
+    if len(codes):
+        starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+        counts = np.diff(np.append(starts, len(codes)))
+        leaf_min = np.minimum.reduceat(xyz, starts, axis=0)
+        leaf_max = np.maximum.reduceat(xyz, starts, axis=0)
+        bits = ((points['tile'][:, None] >> np.arange(TILE_BITS, dtype=np.uint8)) & 1).astype(np.uint32)
+        tile_counts = np.add.reduceat(bits, starts, axis=0)
+    else:
+        starts = counts = np.zeros(0, dtype=np.int64)
+        leaf_min = leaf_max = np.zeros((0, 3), dtype=np.float32)
+        tile_counts = np.zeros((0, TILE_BITS), dtype=np.uint32)
+    index = FrameIndex(lo, size, depth, codes[starts], starts, counts, leaf_min, leaf_max, tile_counts, 0)
+    return points, index
+
+def save(indexes : List[FrameIndex], filename : str, names : List[str]) -> None:
+    """Save the indexes of one or more frames in one sidecar"""
+    nleaves = np.cumsum([0] + [len(ix.codes) for ix in indexes])
+    np.savez(filename,
+        version=np.array(VERSION),
+        names=np.array(names, dtype=np.str_),
+        leaf_offsets=nleaves,
+        origin=np.array([ix.origin for ix in indexes]).reshape(-1, 3),
+        size=np.array([ix.size for ix in indexes]),
+        depth=np.array([ix.depth for ix in indexes]),
+        data_offset=np.array([ix.data_offset for ix in indexes], dtype=np.int64),
+        codes=np.concatenate([ix.codes for ix in indexes]).astype(np.uint64),
+        starts=np.concatenate([ix.starts for ix in indexes]).astype(np.uint32),
+        counts=np.concatenate([ix.counts for ix in indexes]).astype(np.uint32),
+        leaf_min=np.concatenate([ix.leaf_min for ix in indexes]).astype(np.float32),
+        leaf_max=np.concatenate([ix.leaf_max for ix in indexes]).astype(np.float32),
+        tile_counts=np.concatenate([ix.tile_counts for ix in indexes]).astype(np.uint32),
+    )
+
+def load(datafile : str, sidecar : Optional[str] = None) -> List[FrameIndex]:
+    """Load the index of a frame (.cwipcdump, one FrameIndex) or archive (.cwipcseq, one per frame)"""
+    sidecar = sidecar or datafile + SUFFIX
+    with np.load(sidecar) as data:
+        if int(data['version']) != VERSION:
+            raise ValueError(f"{sidecar}: unsupported version {int(data['version'])}")
+        columns = {k : data[k] for k in data.files}
+    rv = []
+    offsets = columns['leaf_offsets']
+    for i in range(len(offsets) - 1):
+        leaves = slice(offsets[i], offsets[i+1])
+        rv.append(FrameIndex(columns['origin'][i], columns['size'][i], int(columns['depth'][i]),
+            columns['codes'][leaves], columns['starts'][leaves].astype(np.int64), columns['counts'][leaves].astype(np.int64),
+            columns['leaf_min'][leaves], columns['leaf_max'][leaves], columns['tile_counts'][leaves], int(columns['data_offset'][i]), datafile))
+    return rv
+
+def read_frame(filename : str) -> Tuple[np.ndarray, int, float]:
+    """Read a .cwipcdump or .ply frame. Returns points, timestamp and cellsize"""
+    if filename.endswith('.ply'):
+        import plyreader
+        return plyreader.read_ply(filename), 0, 0
+    import cwipc
+    pc = cwipc.cwipc_read_debugdump(filename)
+    rv = cwipc_numpy.cwipc_to_numpy(pc), pc.timestamp(), pc.cellsize()
+    pc.free()
+    return rv
+
+def dump_bytes(points : np.ndarray, timestamp : int, cellsize : float) -> Tuple[bytes, int]:
+    """Return the .cwipcdump file contents for points, and the offset of the points in it"""
+    import cwipc
+    pc = cwipc_numpy.numpy_to_cwipc(points, timestamp, cellsize or None)
+    fd, tmpname = tempfile.mkstemp(suffix='.cwipcdump')
+    os.close(fd)
+    try:
+        cwipc.cwipc_write_debugdump(tmpname, pc)
+        with open(tmpname, 'rb') as fp:
+            data = fp.read()
+    finally:
+        pc.free()
+        os.unlink(tmpname)
+    # The points are stored as-is at the end of the dump, after a header
+    offset = len(data) - len(points) * POINT_SIZE
+    if offset < 0 or data[offset:] != np.ascontiguousarray(points).tobytes():
+        raise RuntimeError("cwipcdump does not store the points contiguously, cannot index byte ranges")
+    return data, offset
+
+def build_frame(task : Tuple[str, str, int]) -> Tuple[str, int, int]:
+    """Reorder one frame into dest (a .cwipcdump) and write its sidecar. Returns dest, points and leaves"""
+    source, dest, depth = task
+    points, timestamp, cellsize = read_frame(source)
+    points, index = build_index(points, depth)
+    data, index.data_offset = dump_bytes(points, timestamp, cellsize)
+    with open(dest, 'wb') as fp:
+        fp.write(data)
+    save([index], dest + SUFFIX, [os.path.basename(dest)])
+    return dest, len(points), len(index.codes)
+
+def _reorder_frame(task : Tuple[str, int]) -> Tuple[bytes, int, FrameIndex, int]:
+    source, depth = task
+    points, timestamp, cellsize = read_frame(source)
+    points, index = build_index(points, depth)
+    data, index.data_offset = dump_bytes(points, timestamp, cellsize)
+    return data, timestamp, index, len(points)
+
+def build_archive(sources : List[str], dest : str, depth : int, jobs : int, time_increment : int = 33) -> int:
+    """Reorder all frames into one .cwipcseq archive with one sidecar. Returns number of frames"""
+    import cwipcseq
+    indexes = []
+    names = []
+    with multiprocessing.Pool(jobs) as pool, cwipcseq.SequenceWriter(dest) as writer:
+        writer.extension = '.cwipcdump'
+        tasks = [(source, depth) for source in sources]
+        for i, (source, (data, timestamp, index, npoints)) in enumerate(zip(sources, pool.imap(_reorder_frame, tasks))):
+            name = os.path.splitext(os.path.basename(source))[0] + '.cwipcdump'
+            writer.add_frame(data, timestamp or i * time_increment, name)
+            # Offsets in the archive instead of in the dump
+            index.data_offset += writer.index[-1][0]
+            indexes.append(index)
+            names.append(name)
+            print(name, npoints, 'points', len(index.codes), 'leaves')
+    save(indexes, dest + SUFFIX, names)
+    return len(indexes)
+
+def parse_floatlist(value : str) -> List[float]:
+    return [float(v) for v in value.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Build octree index sidecars for point cloud frames, and query them")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    p = subparsers.add_parser("build", help="Reorder frames in octree order and write their sidecars")
+    p.add_argument("--depth", type=int, default=DEPTH, help=f"Octree depth (default: {DEPTH})")
+    p.add_argument("--jobs", type=int, default=0, help="Number of frames to index in parallel (default: 0, number of cores)")
+    p.add_argument("source", help="Directory with .cwipcdump or .ply frames")
+    p.add_argument("dest", help="Output directory, or a .cwipcseq archive for all frames with one sidecar")
+    p = subparsers.add_parser("query", help="Count and time the points in a box or frustum")
+    p.add_argument("--box", type=parse_floatlist, help="xmin,ymin,zmin,xmax,ymax,zmax")
+    p.add_argument("--view", type=parse_floatlist, help="Frustum from eye x,y,z, forward x,y,z, vertical fov, near and far (up is +y, aspect 16:9)")
+    p.add_argument("--tiles", type=int, default=0, help="Only points with one of these tile bits (default: 0, all)")
+    p.add_argument("--frame", type=int, default=-1, help="For an archive: only this frame (default: all)")
+    p.add_argument("file", help="Indexed .cwipcdump or .cwipcseq")
+    args = parser.parse_args()
+    if args.command == "build":
+        sources = [os.path.join(args.source, fn) for fn in sorted(os.listdir(args.source)) if os.path.splitext(fn)[1] in ('.cwipcdump', '.ply')]
+        if not sources:
+            print(f"{sys.argv[0]}: no .cwipcdump or .ply files in {args.source}", file=sys.stderr)
+            sys.exit(1)
+        jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+        startTime = time.time()
+        if args.dest.endswith('.cwipcseq'):
+            count = build_archive(sources, args.dest, args.depth, jobs)
+        else:
+            os.makedirs(args.dest, exist_ok=True)
+            tasks = [(source, os.path.join(args.dest, os.path.splitext(os.path.basename(source))[0] + '.cwipcdump'), args.depth) for source in sources]
+            with multiprocessing.Pool(jobs) as pool:
+                for dest, npoints, nleaves in pool.imap(build_frame, tasks):
+                    print(dest, npoints, 'points', nleaves, 'leaves')
+            count = len(tasks)
+        print(f"Indexed {count} frames in {time.time()-startTime:.1f} seconds ({jobs} jobs)")
+    else:
+        if (args.box is None) == (args.view is None):
+            print(f"{sys.argv[0]}: give --box or --view", file=sys.stderr)
+            sys.exit(1)
+        indexes = load(args.file)
+        if args.frame >= 0:
+            indexes = [indexes[args.frame]]
+        total = selected = 0
+        startTime = time.perf_counter()
+        for index in indexes:
+            if args.box:
+                points = index.query_box(args.box[:3], args.box[3:], args.tiles)
+            else:
+                planes = frustum_planes(args.view[0:3], args.view[3:6], [0, 1, 0], args.view[6], 16/9, args.view[7], args.view[8])
+                points = index.query_frustum(planes, args.tiles)
+            total += index.npoints
+            selected += len(points)
+            index.close()
+        duration = time.perf_counter() - startTime
+        print(f"{args.file}: {len(indexes)} frames, {selected} of {total} points selected in {1000*duration:.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Run a sequence of processing stages in threads connected by bounded queues.
+
+Every stage runs in its own thread. Between stages there are queues of limited
+size, so a fast stage blocks when the next one cannot keep up and memory use stays
+capped at a few items in flight. For each stage the time spent working (busy) and
+waiting for input or output space (blocked) is recorded, so the bottleneck can be found.
+
+Usage:
+
+    stats = run_pipeline(filenames, [("read", read_func), ("encode", encode_func), ("write", write_func)])
+    print_stats(stats)
+
+The first stage gets the items from the source iterable, every stage gets the
+return value of the previous one. The return value of the last stage is discarded.
+"""
+import sys
+import time
+import threading
+import queue
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+_END = object()
+
+class StageStats:
+    """Timing information for a single stage"""
+
+    def __init__(self, name : str):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.blocked_input = 0.0
+        self.blocked_output = 0.0
+
+    def __repr__(self):
+        return f"StageStats({self.name}, count={self.count}, busy={self.busy:.3f}, blocked_input={self.blocked_input:.3f}, blocked_output={self.blocked_output:.3f})"
+
+class _Aborted(Exception):
+    pass
+
+class Pipeline:
+    """Threaded pipeline of named stages connected by bounded queues"""
+
+    def __init__(self, source : Iterable[Any], stages : List[Tuple[str, Callable[[Any], Any]]], maxsize : int = 2):
+        self.source = source
+        self.stages = stages
+        self.maxsize = maxsize
+        self.stats = [StageStats("source")] + [StageStats(name) for name, _ in stages]
+        self.queues = [queue.Queue(maxsize) for _ in stages]
+        self.error : Optional[BaseException] = None
+        self.abort = threading.Event()
+        self.wall = 0.0
+
+    def _get(self, q : queue.Queue, stats : StageStats) -> Any:
+        t0 = time.perf_counter()
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.abort.is_set():
+                    raise _Aborted()
+        stats.blocked_input += time.perf_counter() - t0
+        return item
+
+    def _put(self, q : queue.Queue, item : Any, stats : StageStats) -> None:
+        t0 = time.perf_counter()
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                if self.abort.is_set():
+                    raise _Aborted()
+        stats.blocked_output += time.perf_counter() - t0
+
+    def _run_source(self) -> None:
+        stats = self.stats[0]
+        try:
+            it = iter(self.source)
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                stats.busy += time.perf_counter() - t0
+                stats.count += 1
+                self._put(self.queues[0], item, stats)
+            self._put(self.queues[0], _END, stats)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _run_stage(self, index : int) -> None:
+        stats = self.stats[index+1]
+        _, func = self.stages[index]
+        inq = self.queues[index]
+        outq = self.queues[index+1] if index+1 < len(self.queues) else None
+        try:
+            while True:
+                item = self._get(inq, stats)
+                if item is _END:
+                    break
+                t0 = time.perf_counter()
+                result = func(item)
+                stats.busy += time.perf_counter() - t0
+                stats.count += 1
+                if outq is not None:
+                    self._put(outq, result, stats)
+            if outq is not None:
+                self._put(outq, _END, stats)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            self._fail(e)
+
+    def _fail(self, e : BaseException) -> None:
+        if self.error is None:
+            self.error = e
+        self.abort.set()
+
+    def run(self) -> List[StageStats]:
+        """Run the pipeline to completion. Re-raises the first exception raised by any stage."""
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=self._run_source, name="source")]
+        for i in range(len(self.stages)):
+            threads.append(threading.Thread(target=self._run_stage, args=(i,), name=self.stages[i][0]))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.wall = time.perf_counter() - t0
+        if self.error is not None:
+            raise self.error
+        return self.stats
+
+def run_pipeline(source : Iterable[Any], stages : List[Tuple[str, Callable[[Any], Any]]], maxsize : int = 2) -> List[StageStats]:
+    """Run source items through stages, each stage in its own thread. Returns per-stage statistics."""
+    return Pipeline(source, stages, maxsize).run()
+
+def print_stats(stats : List[StageStats], file=sys.stdout) -> None:
+    """Print busy and blocked time per stage. The stage with the highest busy time is the bottleneck."""
+    bottleneck = max(stats, key=lambda s: s.busy)
+    print(f"{'stage':12s} {'items':>6s} {'busy':>9s} {'wait-in':>9s} {'wait-out':>9s}", file=file)
+    for s in stats:
+        marker = "  <- bottleneck" if s is bottleneck else ""
+        print(f"{s.name:12s} {s.count:6d} {s.busy:8.2f}s {s.blocked_input:8.2f}s {s.blocked_output:8.2f}s{marker}", file=file)
@@ -0,0 +1,72 @@
+"""Assign tiles to points using the tileInfo in a tileconfig.json.
+
+Every tile with a non-zero normal takes the points whose direction from the center
+of the cloud is closest to that normal. The tile value stored in a point is the
+cameraMask of its tile, so points in the overlap region between tiles (within
+overlap degrees of the best tile) get the OR of the camera masks of all those tiles,
+just like points seen by multiple cameras in a cwipc capture.
+
+The whole cloud is processed at once with NumPy, for any number of tiles.
+"""
+import json
+import math
+import numpy as np
+import cwipc_numpy
+
+def load_tileconfig(filename):
+    """Return the tileInfo list from a tileconfig.json file"""
+    with open(filename) as fp:
+        return json.load(fp)["tileInfo"]
+
+def tile_normals(tileinfo):
+    """Return (normals, masks, indices) for all tiles with a non-zero normal.
+
+    normals is a (T, 3) float32 array of unit vectors, masks the cameraMask per tile
+    and indices the position of each tile in tileinfo.
+    """
+    normals = []
+    masks = []
+    indices = []
+    for i, tile in enumerate(tileinfo):
+        n = tile["normal"]
+        normal = np.array([n["x"], n["y"], n["z"]], dtype=np.float32)
+        length = np.linalg.norm(normal)
+        if length == 0:
+            continue
+        normals.append(normal / length)
+        masks.append(tile["cameraMask"])
+        indices.append(i)
+    return np.array(normals, dtype=np.float32).reshape(-1, 3), np.array(masks, dtype=np.uint8), indices
+
+def assign_tiles(points, tileinfo, overlap=0.0, center=None):
+    """Return tile mask per point for a structured point array.
+
+    overlap is in degrees: a point also belongs to every tile whose normal is at most
+    overlap degrees further away from the point's direction than the best tile.
+    center defaults to the (approximate) centroid of the points.
+    """
+    normals, masks, _ = tile_normals(tileinfo)
+    if len(normals) == 0 or len(points) == 0:
+        return np.zeros(len(points), dtype=np.uint8)
+    xyz = cwipc_numpy.xyz_view(points) if points.dtype == cwipc_numpy.POINT_DTYPE else np.asarray(points, dtype=np.float32)
+    if center is None:
+        # A regular subsample gives the centroid to well within a voxel, at a fraction of the cost
+        center = xyz[::max(1, len(xyz)//65536)].mean(axis=0, dtype=np.float64)
+    center = np.asarray(center, dtype=np.float32)
+    dots = xyz @ normals.T
+    dots -= center @ normals.T
+    best = dots.argmax(axis=1)
+    rv = masks[best]
+    if overlap > 0 and len(normals) > 1:
+        # Compare cosines, not angles: cos(a + overlap) = cos(a)cos(overlap) - sin(a)sin(overlap)
+        directions = xyz - center
+        lengths = np.sqrt(np.einsum('ij,ij->i', directions, directions))
+        lengths[lengths == 0] = 1
+        cosines = dots / lengths[:, None]
+        best_cos = np.clip(cosines[np.arange(len(best)), best], -1, 1)
+        best_sin = np.sqrt(1 - best_cos*best_cos)
+        o = math.radians(overlap)
+        limit = np.where(best_cos > math.cos(math.pi - o), best_cos*math.cos(o) - best_sin*math.sin(o), -1)
+        selected = cosines >= limit[:, None] - 1e-6
+        rv = np.bitwise_or.reduce(np.where(selected, masks, 0).astype(np.uint8), axis=1)
+    return rv.astype(np.uint8)
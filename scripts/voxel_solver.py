@@ -0,0 +1,143 @@
+"""Find the voxel size that gives a target mean point count, and optionally convert with it.
+
+A number of frames evenly spread over the source sequence is read, transformed and
+Morton sorted once (see morton.py). The voxel sizes base*2**k are counted first,
+which only takes a pass over the sorted codes, to bracket the target. Then a
+bisection (on a log scale) between the two bracketing sizes finds the size whose mean
+point count over the sampled frames is within --tolerance of the target.
+
+With a dest argument lod_pyramid.py is run with the solved voxel sizes. For example
+to make 110K, 150K and 200K point loot sets in one go:
+
+    python voxel_solver.py --target 110000,150000,200000 --scale 0.0018 --translate=-0.36,0,-0.54 \\
+        --tileconfig ../Samples/loot-150K-4tiles/tileconfig.json ../../loot 'loot-{voxel}-4tiles'
+"""
+import sys
+import os
+import json
+import math
+import argparse
+import subprocess
+import multiprocessing
+from typing import List, Tuple
+import numpy as np
+import morton
+import lod_pyramid
+
+BASE_VOXEL = 0.0005
+MAX_LEVELS = 10
+
+def parse_intlist(value : str) -> List[int]:
+    return [int(v) for v in value.split(',')]
+
+def sample_files(dirname : str, nsamples : int) -> List[Tuple[int, str]]:
+    """Return (frame index, pathname) of nsamples source files evenly spread over the sequence.
+
+    The frame index is the position in the whole sorted sequence, as used by lod_pyramid.py
+    (for example to seed the noise).
+    """
+    sources = [os.path.join(dirname, fn) for fn in sorted(os.listdir(dirname)) if os.path.splitext(fn)[1] in lod_pyramid.SOURCE_EXTENSIONS]
+    if nsamples <= 0 or nsamples >= len(sources):
+        return list(enumerate(sources))
+    return [(int(i), sources[int(i)]) for i in np.linspace(0, len(sources)-1, nsamples)]
+
+def load_sorted(task : Tuple[str, float, List[float], float, int, float]) -> morton.SortedPoints:
+    filename, scale, translate, noise, seed, base = task
+    points, _ = lod_pyramid.read_points(filename)
+    points = lod_pyramid.transform(points, scale, translate, noise, seed)
+    return morton.SortedPoints(points, base, MAX_LEVELS)
+
+def mean_count(frames : List[morton.SortedPoints], voxel : float) -> float:
+    return sum(f.count(voxel) for f in frames) / len(frames)
+
+def solve(frames : List[morton.SortedPoints], target : int, tolerance : float, max_iterations : int = 40, verbose : bool = False) -> Tuple[float, float]:
+    """Return (voxel size, mean point count) for the target mean point count"""
+    base = frames[0].cellsize
+    # Bracket with the cheap power-of-two levels. Counts decrease with voxel size
+    lo, lo_count = base, mean_count(frames, base)
+    if lo_count <= target:
+        return lo, lo_count
+    hi = hi_count = None
+    for k in range(1, MAX_LEVELS+1):
+        size = base * 2**k
+        count = mean_count(frames, size)
+        if verbose:
+            print(f"voxel {size:.6f}: {count:.0f} points", file=sys.stderr)
+        if count <= target:
+            hi, hi_count = size, count
+            break
+        lo, lo_count = size, count
+    if hi is None:
+        return lo, lo_count
+    best = min(((lo, lo_count), (hi, hi_count)), key=lambda vc: abs(vc[1]-target))
+    for _ in range(max_iterations):
+        if abs(best[1] - target) <= tolerance * target:
+            break
+        mid = math.sqrt(lo * hi)
+        count = mean_count(frames, mid)
+        if verbose:
+            print(f"voxel {mid:.6f}: {count:.0f} points", file=sys.stderr)
+        if count > target:
+            lo = mid
+        else:
+            hi = mid
+        if abs(count - target) < abs(best[1] - target):
+            best = (mid, count)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Find the voxel size for a target mean point count, and optionally run lod_pyramid.py with it")
+    parser.add_argument("--target", type=parse_intlist, required=True, help="Comma-separated target mean point counts")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Relative tolerance of the mean point count (default: 0.01)")
+    parser.add_argument("--samples", type=int, default=10, help="Number of frames to sample, 0 for all (default: 10)")
+    parser.add_argument("--base", type=float, default=BASE_VOXEL, help=f"Smallest voxel size considered (default: {BASE_VOXEL})")
+    lod_pyramid.add_transform_arguments(parser)
+    parser.add_argument("--noise", type=float, default=0, help="Gaussian noise (meters) added before voxelizing (default: none)")
+    parser.add_argument("--tileconfig", help="Passed to lod_pyramid.py")
+    parser.add_argument("--overlap", type=float, default=0, help="Passed to lod_pyramid.py")
+    parser.add_argument("--ply", action="store_true", help="Passed to lod_pyramid.py")
+    parser.add_argument("--jobs", type=int, default=0, help="Number of processes (default: 0, number of cores)")
+    parser.add_argument("--json", help="Write the solved voxel sizes to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Print every voxel size tried")
+    parser.add_argument("source", help="Directory with source .ply or .cwipcdump files")
+    parser.add_argument("dest", nargs="?", help="If given, run lod_pyramid.py with the solved voxel sizes to this destination")
+    args = parser.parse_args()
+    lod_pyramid.resolve_transform(parser, args)
+
+    files = sample_files(args.source, args.samples)
+    if not files:
+        print(f"{sys.argv[0]}: no .ply or .cwipcdump files in {args.source}", file=sys.stderr)
+        sys.exit(1)
+    jobs = args.jobs if args.jobs > 0 else multiprocessing.cpu_count()
+    # Seeded with the frame index, so the noise is the same as lod_pyramid.py adds to that frame
+    tasks = [(fn, args.scale, args.translate, args.noise, index, args.base) for index, fn in files]
+    with multiprocessing.Pool(min(jobs, len(tasks))) as pool:
+        frames = pool.map(load_sorted, tasks)
+    print(f"{args.source}: {len(frames)} frames sampled, mean {sum(len(f) for f in frames)/len(frames):.0f} source points", file=sys.stderr)
+    results = []
+    for target in args.target:
+        voxel, count = solve(frames, target, args.tolerance, verbose=args.verbose)
+        ok = abs(count - target) <= args.tolerance * target
+        print(f"target {target}: voxel {voxel:.6f} gives mean {count:.0f} points{'' if ok else ' (not within tolerance)'}")
+        results.append(dict(target=target, voxel=round(voxel, 7), mean_points=count, within_tolerance=ok))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(dict(source=args.source, samples=len(frames), results=results), fp, indent=1)
+    if args.dest:
+        cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lod_pyramid.py'),
+            '--voxel', ','.join(str(r['voxel']) for r in results),
+            '--noise', str(args.noise), '--overlap', str(args.overlap), '--jobs', str(args.jobs)]
+        if args.transform:
+            cmd += ['--transform', args.transform]
+        else:
+            cmd += ['--scale', str(args.scale), '--translate=' + ','.join(str(t) for t in args.translate)]
+        if args.tileconfig:
+            cmd += ['--tileconfig', args.tileconfig]
+        if args.ply:
+            cmd.append('--ply')
+        cmd += [args.source, args.dest]
+        print(' '.join(cmd), file=sys.stderr)
+        sys.exit(subprocess.call(cmd))
+
+if __name__ == '__main__':
+    main()
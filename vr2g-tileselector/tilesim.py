@@ -0,0 +1,301 @@
+"""Offline tile selection and bandwidth simulator, driven by viewerPosition traces.
+
+A viewer trace (like viewerPosition-2-receiver.json, for the VR2Gather PositionTracker)
+is replayed against a tiled, compressed sample set as written by convert_loot.py:
+one directory per tile and quality, DIR1..DIRn for the tiles and DIR1-low..DIRn-low
+for the low quality. For every frame (at --interval ms, looping trace and sequence)
+each policy decides which tiles to fetch, and at which quality, from where the viewer
+is and looks. The tile normals come from the tileconfig.json of the sample set; the
+point cloud stands at the origin, or where the --sender trace puts it (turned with it).
+
+Per policy the bitrate, the stability of the selection (switches per second) and the
+time the policy took per frame are reported:
+
+    python tilesim.py --tileconfig ../Samples/loot-150K-4tiles/tileconfig.json \\
+        --frames 9000 viewerPosition-2-receiver.json ../lootCwicpc
+
+Without compressed data --synthetic gives every tile a random size around a typical
+high and low quality frame size, which is enough to compare the policies.
+"""
+import sys
+import os
+import json
+import math
+import time
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import tiling
+
+INTERVAL = 33   # ms per frame, as TIME_INCREMENT in convert_loot.py
+QUALITY_SUFFIXES = ('', '-low')    # Best first, as in convert_loot.py
+CENTER_HEIGHT = 0.9 # Height of the middle of the point cloud above its position
+FOV = 90            # Horizontal field of view in degrees
+SKIP = -1
+
+def _vectors(positions : List[Dict[str, Any]], key : str, fields : str) -> np.ndarray:
+    return np.array([[p[key][f] for f in fields] for p in positions], dtype=np.float64)
+
+class Trace:
+    """A PositionTracker trace: timestamps, camera positions and rotations"""
+
+    def __init__(self, filename : str):
+        with open(filename) as fp:
+            positions = json.load(fp)["positions"]
+        if not positions:
+            raise ValueError(f"{filename}: no positions")
+        self.ts = np.array([p["ts"] for p in positions], dtype=np.float64)
+        self.position = _vectors(positions, "c_pos", "xyz")
+        self.rotation = _vectors(positions, "c_rot", "xyzw")
+        self.player_position = _vectors(positions, "p_pos", "xyz")
+        self.player_rotation = _vectors(positions, "p_rot", "xyzw")
+
+    def duration(self) -> float:
+        return float(self.ts[-1]) if len(self.ts) > 1 else 1.0
+
+    def sample(self, times : np.ndarray, positions : np.ndarray) -> np.ndarray:
+        """Linearly interpolate (N, k) values at times (ms, looping over the trace)"""
+        t = np.mod(times, self.duration()) if self.ts[-1] > 0 else np.zeros_like(times)
+        return np.stack([np.interp(t, self.ts, positions[:, i]) for i in range(positions.shape[1])], axis=1)
+
+def rotate(quaternions : np.ndarray, vectors : np.ndarray) -> np.ndarray:
+    """Rotate (N, 3) vectors by (N, 4) x, y, z, w quaternions (need not be normalized)"""
+    q = quaternions / np.linalg.norm(quaternions, axis=1, keepdims=True)
+    u = q[:, :3]
+    w = q[:, 3:4]
+    t = 2 * np.cross(u, vectors)
+    return vectors + w * t + np.cross(u, t)
+
+class Viewpoints:
+    """Per frame: the tile scores (cosine between tile normal and direction to the viewer) and whether the cloud is in view"""
+
+    def __init__(self, trace : Trace, nframes : int, normals : np.ndarray, sender : Optional[Trace] = None, interval : float = INTERVAL, fov : float = FOV, center_height : float = CENTER_HEIGHT):
+        times = np.arange(nframes) * interval
+        camera = trace.sample(times, trace.position)
+        # Unity: forward is +z rotated by the camera rotation. Rotations are interpolated
+        # as forward vectors, which is plenty at the sample rate of a trace
+        forward = rotate(trace.rotation, np.tile([0.0, 0.0, 1.0], (len(trace.ts), 1)))
+        forward = trace.sample(times, forward)
+        forward /= np.maximum(np.linalg.norm(forward, axis=1, keepdims=True), 1e-9)
+        if sender is not None:
+            origin = sender.sample(times, sender.player_position)
+            turn = sender.sample(times, sender.player_rotation)
+        else:
+            origin = np.zeros((nframes, 3))
+            turn = np.tile([0.0, 0.0, 0.0, 1.0], (nframes, 1))
+        center = origin + [0, center_height, 0]
+        to_viewer = camera - center
+        distance = np.maximum(np.linalg.norm(to_viewer, axis=1, keepdims=True), 1e-9)
+        to_viewer /= distance
+        # Tile normals turn with the sender
+        scores = np.empty((nframes, len(normals)))
+        for i, normal in enumerate(normals):
+            world_normal = rotate(turn, np.tile(normal, (nframes, 1)))
+            scores[:, i] = np.einsum('ij,ij->i', world_normal, to_viewer)
+        self.scores = scores
+        self.distance = distance[:, 0]
+        self.in_view = np.einsum('ij,ij->i', forward, -to_viewer) >= math.cos(math.radians(fov / 2))
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+def load_sizes(prefix : str, ntiles : int) -> Tuple[np.ndarray, List[str]]:
+    """Return sizes[frame, tile, quality] in bytes from the PREFIX{tile}{quality} directories, and the quality suffixes found"""
+    qualities = [q for q in QUALITY_SUFFIXES if os.path.isdir(f"{prefix}1{q}")]
+    if not qualities:
+        raise ValueError(f"{prefix}1: no per-tile directories")
+    columns = []
+    for q in qualities:
+        for tile in range(1, ntiles+1):
+            dirname = f"{prefix}{tile}{q}"
+            files = sorted(fn for fn in os.listdir(dirname) if fn.endswith('.cwicpc'))
+            columns.append([os.path.getsize(os.path.join(dirname, fn)) for fn in files])
+    nframes = min(len(c) for c in columns)
+    if nframes == 0:
+        raise ValueError(f"{prefix}: no .cwicpc files")
+    sizes = np.array([c[:nframes] for c in columns], dtype=np.int64)
+    return sizes.reshape(len(qualities), ntiles, nframes).transpose(2, 1, 0), qualities
+
+def synthetic_sizes(nframes : int, ntiles : int, high : float, low : float, seed : int = 0) -> Tuple[np.ndarray, List[str]]:
+    """Random sizes[frame, tile, quality] around high and low bytes per tile"""
+    rng = np.random.default_rng(seed)
+    base = np.array([high, low]) / ntiles
+    sizes = base * rng.uniform(0.8, 1.2, (nframes, ntiles, 1))
+    return sizes.astype(np.int64), list(QUALITY_SUFFIXES)
+
+class Policy:
+    """Chooses a quality index (or SKIP) per tile for one frame"""
+    name = "all"
+
+    def __init__(self, nqualities : int, budget : float):
+        self.nqualities = nqualities
+        self.budget = budget    # bytes per frame, 0 for unlimited
+
+    def select(self, scores : np.ndarray, in_view : bool, sizes : np.ndarray) -> np.ndarray:
+        return np.zeros(len(scores), dtype=np.int64)
+
+class LowPolicy(Policy):
+    """Every tile at the lowest quality"""
+    name = "low"
+
+    def select(self, scores, in_view, sizes):
+        return np.full(len(scores), self.nqualities-1, dtype=np.int64)
+
+class FacingPolicy(Policy):
+    """Tiles facing the viewer at the best quality, the others at the lowest (or skipped with skip=True)"""
+    name = "facing"
+
+    def __init__(self, nqualities : int, budget : float, threshold : float = 0, skip : bool = False):
+        super().__init__(nqualities, budget)
+        self.threshold = threshold
+        self.skip = skip
+
+    def select(self, scores, in_view, sizes):
+        other = SKIP if self.skip else self.nqualities-1
+        if not in_view:
+            return np.full(len(scores), other, dtype=np.int64)
+        return np.where(scores > self.threshold, 0, other)
+
+class VisiblePolicy(FacingPolicy):
+    """Only the tiles facing the viewer, at the best quality"""
+    name = "visible"
+
+    def __init__(self, nqualities : int, budget : float):
+        super().__init__(nqualities, budget, skip=True)
+
+class HysteresisPolicy(FacingPolicy):
+    """Like facing, but a tile only switches when its score passes the threshold by margin, for a stable selection"""
+    name = "hysteresis"
+
+    def __init__(self, nqualities : int, budget : float, margin : float = 0.15):
+        super().__init__(nqualities, budget)
+        self.margin = margin
+        self.previous : Optional[np.ndarray] = None
+
+    def select(self, scores, in_view, sizes):
+        wanted = super().select(scores, in_view, sizes)
+        if self.previous is None or not in_view:
+            self.previous = wanted
+            return wanted
+        # Keep the previous choice for tiles within the margin of the threshold
+        undecided = np.abs(scores - self.threshold) < self.margin
+        rv = np.where(undecided, self.previous, wanted)
+        self.previous = rv
+        return rv
+
+class GreedyPolicy(Policy):
+    """Within the budget: tiles in order of score get the best quality that still fits, tiles facing away may be skipped"""
+    name = "greedy"
+
+    def select(self, scores, in_view, sizes):
+        ntiles = len(scores)
+        rv = np.full(ntiles, self.nqualities-1, dtype=np.int64)
+        if not in_view:
+            return rv
+        spent = sizes[np.arange(ntiles), rv].sum()
+        budget = self.budget if self.budget > 0 else math.inf
+        if spent > budget:
+            # Not even everything at low quality fits: drop the tiles facing away first
+            for tile in np.argsort(scores):
+                if spent <= budget:
+                    break
+                spent -= sizes[tile, rv[tile]]
+                rv[tile] = SKIP
+            return rv
+        for tile in np.argsort(-scores):
+            for quality in range(self.nqualities-1):
+                extra = sizes[tile, quality] - sizes[tile, rv[tile]]
+                if spent + extra <= budget:
+                    spent += extra
+                    rv[tile] = quality
+                    break
+        return rv
+
+POLICIES = {cls.name : cls for cls in (Policy, LowPolicy, FacingPolicy, VisiblePolicy, HysteresisPolicy, GreedyPolicy)}
+
+def simulate(policy : Policy, viewpoints : Viewpoints, sizes : np.ndarray, interval : float = INTERVAL) -> Dict[str, Any]:
+    """Run a policy over all frames. Returns bitrate, stability and decision time statistics"""
+    nframes = len(viewpoints)
+    ntiles = sizes.shape[1]
+    choices = np.empty((nframes, ntiles), dtype=np.int64)
+    decision_ns = np.empty(nframes, dtype=np.int64)
+    scores = viewpoints.scores
+    in_view = viewpoints.in_view.tolist()
+    nsizes = len(sizes)
+    for frame in range(nframes):
+        frame_sizes = sizes[frame % nsizes]
+        t0 = time.perf_counter_ns()
+        choices[frame] = policy.select(scores[frame], in_view[frame], frame_sizes)
+        decision_ns[frame] = time.perf_counter_ns() - t0
+    fetched = choices != SKIP
+    frame_index = np.arange(nframes) % nsizes
+    tile_sizes = sizes[frame_index[:, None], np.arange(ntiles)[None, :], np.where(fetched, choices, 0)]
+    frame_bytes = np.where(fetched, tile_sizes, 0).sum(axis=1)
+    seconds = nframes * interval / 1000
+    switches = (choices[1:] != choices[:-1]).sum()
+    facing = scores > 0
+    visible_best = ((choices == 0) & facing).sum() / max(1, facing.sum())
+    return dict(
+        policy=policy.name,
+        frames=nframes,
+        mean_kbps=float(frame_bytes.sum() * 8 / 1000 / seconds),
+        peak_kbps=float(frame_bytes.max() * 8 / interval),
+        switches_per_second=float(switches / seconds),
+        changed_frames=float((choices[1:] != choices[:-1]).any(axis=1).mean()) if nframes > 1 else 0.0,
+        facing_at_best=float(visible_best),
+        tiles_per_frame=float(fetched.sum(axis=1).mean()),
+        decision_us_mean=float(decision_ns.mean() / 1000),
+        decision_us_max=float(decision_ns.max() / 1000),
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a viewerPosition trace against a tiled compressed sample set and compare tile selection policies")
+    parser.add_argument("--tileconfig", required=True, help="tileconfig.json with the tile normals of the sample set")
+    parser.add_argument("--sender", help="Trace of the sender (viewerPosition-1-sender.json): position and rotation of the point cloud (default: at the origin)")
+    parser.add_argument("--policy", default=",".join(POLICIES), help=f"Comma-separated policies to run (default: all of {','.join(POLICIES)})")
+    parser.add_argument("--budget", type=float, default=0, help="Bandwidth budget in kbps for the greedy policy (default: 0, unlimited)")
+    parser.add_argument("--frames", type=int, default=0, help="Number of frames to simulate, looping trace and sequence (default: 0, one pass over the trace)")
+    parser.add_argument("--interval", type=float, default=INTERVAL, help=f"Time between frames in ms (default: {INTERVAL})")
+    parser.add_argument("--fov", type=float, default=FOV, help=f"Field of view in degrees, outside of it only the lowest quality is fetched (default: {FOV})")
+    parser.add_argument("--synthetic", type=float, nargs=2, metavar=("HIGH", "LOW"), help="Use random tile sizes around HIGH and LOW bytes per frame instead of a sample set")
+    parser.add_argument("--json", help="Write results to this JSON file")
+    parser.add_argument("trace", help="Viewer trace (viewerPosition-2-receiver.json)")
+    parser.add_argument("cwicpc", nargs="?", help="Prefix of the per-tile directories, as given to convert_loot.py (like lootCwicpc for lootCwicpc1..4 and lootCwicpc1-low..4-low)")
+    args = parser.parse_args()
+
+    normals, _, _ = tiling.tile_normals(tiling.load_tileconfig(args.tileconfig))
+    trace = Trace(args.trace)
+    sender = Trace(args.sender) if args.sender else None
+    nframes = args.frames or max(1, int(trace.duration() / args.interval))
+    if args.synthetic:
+        sizes, qualities = synthetic_sizes(min(nframes, 300), len(normals), args.synthetic[0], args.synthetic[1])
+    elif args.cwicpc:
+        try:
+            sizes, qualities = load_sizes(args.cwicpc, len(normals))
+        except ValueError as e:
+            print(f"{sys.argv[0]}: {e}", file=sys.stderr)
+            sys.exit(1)
+    else:
+        print(f"{sys.argv[0]}: give a cwicpc directory prefix or --synthetic", file=sys.stderr)
+        sys.exit(1)
+    startTime = time.time()
+    viewpoints = Viewpoints(trace, nframes, normals, sender, args.interval, args.fov)
+    print(f"{args.trace}: {nframes} frames, {len(normals)} tiles, qualities {qualities}, viewpoints in {time.time()-startTime:.2f} seconds", file=sys.stderr)
+    budget = args.budget * 1000 / 8 * args.interval / 1000
+    results = []
+    print(f"{'policy':>10s} {'kbps':>8s} {'peak':>8s} {'switch/s':>8s} {'changed':>7s} {'best':>5s} {'tiles':>5s} {'us/frame':>8s} {'us max':>8s}")
+    for name in args.policy.split(','):
+        if name not in POLICIES:
+            print(f"{sys.argv[0]}: unknown policy {name}", file=sys.stderr)
+            sys.exit(1)
+        result = simulate(POLICIES[name](len(qualities), budget), viewpoints, sizes, args.interval)
+        results.append(result)
+        print(f"{name:>10s} {result['mean_kbps']:8.0f} {result['peak_kbps']:8.0f} {result['switches_per_second']:8.2f} {result['changed_frames']:7.3f} {result['facing_at_best']:5.2f} {result['tiles_per_frame']:5.2f} {result['decision_us_mean']:8.1f} {result['decision_us_max']:8.1f}")
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(dict(trace=args.trace, sender=args.sender, cwicpc=args.cwicpc, qualities=qualities, budget_kbps=args.budget, results=results), fp, indent=1)
+
+if __name__ == '__main__':
+    main()